@@ -0,0 +1,228 @@
+"""
+Frame pipeline benchmark of the camera plugins
+
+Drives the frame path of the TSI, TSI autocorrelator and DCx viewer plugins against synthetic frame sources (the
+simulated TLCamera for the TSI plugins, a synthetic uc480 camera for the DCx one) for each combination of resolution,
+output color and binning. For each configuration it reports the sustained throughput (frames per second through the
+whole read -> process -> emit path), the latency of each stage and the memory allocated per frame, and writes the
+results to a json file so that they can be compared between releases:
+
+    python benchmarks/bench_camera_pipeline.py --frames 200 --output bench_1.2.0.json
+    python benchmarks/bench_camera_pipeline.py --compare bench_1.2.0.json
+
+No hardware is needed but the plugin dependencies (pymodaq, pylablib, opencv...) must be installed. The DCx
+benchmark is skipped if the instrumental library is not.
+"""
+import argparse
+import json
+import platform
+import sys
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+from time import perf_counter
+
+import numpy as np
+from qtpy import QtWidgets, QtCore
+
+from pymodaq_plugins_thorlabs import __version__
+from pymodaq_plugins_thorlabs.hardware.simulated_tlcamera import SimulatedTLCamera
+
+RESOLUTIONS = {'VGA': (640, 480), '1.6MP': (1440, 1080), '5MP': (2448, 2048)}
+
+
+class StageTimer:
+    """Accumulate the duration and the memory allocated by the calls of a pipeline stage"""
+
+    def __init__(self):
+        self.durations = []
+        self.allocated = []
+
+    def __call__(self, func, *args):
+        tracemalloc.reset_peak()
+        current, _ = tracemalloc.get_traced_memory()
+        start = perf_counter()
+        result = func(*args)
+        self.durations.append(perf_counter() - start)
+        self.allocated.append(tracemalloc.get_traced_memory()[1] - current)
+        return result
+
+    def summary(self):
+        durations = np.array(self.durations) * 1e3
+        return dict(mean_ms=float(np.mean(durations)), median_ms=float(np.median(durations)),
+                    p95_ms=float(np.percentile(durations, 95)),
+                    allocated_bytes=float(np.mean(self.allocated)))
+
+
+class SyntheticUC480:
+    """Stand-in for the instrumental uc480 camera, returning a synthetic spot image"""
+
+    def __init__(self, width, height):
+        yy, xx = np.mgrid[:height, :width]
+        spot = np.exp(-2 * ((xx - width / 2) ** 2 + (yy - height / 2) ** 2) / (min(width, height) / 8) ** 2)
+        self.image = (200 * spot + 10).astype(np.uint8)
+        self.width = width
+        self.height = height
+
+    def grab_image(self, **kwargs):
+        return self.image.copy()
+
+    def start_live_video(self, **kwargs):
+        pass
+
+    def stop_live_video(self):
+        pass
+
+    def wait_for_frame(self, timeout=None):
+        return True
+
+    def latest_frame(self, copy=True):
+        return self.image.copy() if copy else self.image
+
+
+def collect(signal):
+    """Connect a counting slot to a plugin signal, called directly from the emitting thread"""
+    received = []
+    signal.connect(received.append, QtCore.Qt.DirectConnection)
+    return received
+
+
+def bench_tsi(plugin_class, serial, width, height, color, binning, nframes):
+    camera = SimulatedTLCamera(serial, sensor='Bayer' if color != 'Mono sensor' else 'Monochrome',
+                               width=width, height=height, frame_rate=1e6)
+    camera.set_exposure(1e-6)
+    camera.set_roi(0, width, 0, height, binning, binning)
+
+    plugin = plugin_class()
+    plugin.settings.child('sensor').setValue('Monochrome' if color == 'Mono sensor' else 'Bayer')
+    plugin.settings.child('output_color').setValue('RGB' if color == 'RGB' else 'MonoChrome')
+    plugin.settings.child('buffer_opts', 'read_mode').setValue('Newest')
+    plugin.controller = camera
+    plugin._prepare_view()
+    received = collect(plugin.dte_signal)
+
+    stages = {name: StageTimer() for name in ['read', 'convert', 'process', 'emit']}
+    errors = 0
+    camera.start_acquisition(nframes=10)
+    for ind in range(nframes):  # stage by stage
+        camera.wait_for_frame()
+        frames = stages['read'](plugin.read_frames)
+        stages['convert'](plugin.convert_frame, frames[0])
+        try:
+            dte = stages['process'](plugin.process_frame, frames[0])
+        except Exception:  # a failed fit for instance, the frame is lost as in the plugin
+            errors += 1
+            continue
+        stages['emit'](plugin.dte_signal.emit, dte)
+
+    start = perf_counter()
+    for ind in range(nframes):  # whole path
+        camera.wait_for_frame()
+        for frame in plugin.read_frames():
+            try:
+                plugin.emit_frame(frame)
+            except Exception:
+                errors += 1
+    throughput = nframes / (perf_counter() - start)
+    camera.clear_acquisition()
+
+    return dict(throughput_fps=throughput, emitted=len(received), errors=errors,
+                stages={name: timer.summary() for name, timer in stages.items() if timer.durations})
+
+
+def bench_dcx(width, height, nframes):
+    from pymodaq_plugins_thorlabs.daq_viewer_plugins.plugins_2D.daq_2Dviewer_Thorlabs_DCx import \
+        DAQ_2DViewer_Thorlabs_DCx
+
+    plugin = DAQ_2DViewer_Thorlabs_DCx()
+    plugin.controller = SyntheticUC480(width, height)
+    plugin.start_live()
+    received = collect(plugin.dte_signal)
+
+    timer = StageTimer()
+    for ind in range(nframes):
+        plugin.wait_for_frame()
+        timer(plugin.emit_data)
+    start = perf_counter()
+    for ind in range(nframes):  # what the callback thread does for each grab
+        if plugin.wait_for_frame():
+            plugin.emit_data()
+    throughput = nframes / (perf_counter() - start)
+    plugin.stop_live()
+    return dict(throughput_fps=throughput, emitted=len(received), stages={'emit': timer.summary()})
+
+
+def run(args):
+    from pymodaq_plugins_thorlabs.daq_viewer_plugins.plugins_2D.daq_2Dviewer_Thorlabs_TSI import \
+        DAQ_2DViewer_Thorlabs_TSI
+    from pymodaq_plugins_thorlabs.daq_viewer_plugins.plugins_2D.daq_2Dviewer_Thorlabs_TSI_autocorrelator import \
+        DAQ_2DViewer_Thorlabs_TSI_autocorrelator
+
+    tsi_plugins = {'TSI': (DAQ_2DViewer_Thorlabs_TSI, 'Simulated Spot'),
+                   'TSI_autocorrelator': (DAQ_2DViewer_Thorlabs_TSI_autocorrelator, 'Simulated Autocorrelation')}
+
+    results = []
+    tracemalloc.start()
+    for resolution in args.resolutions:
+        width, height = RESOLUTIONS[resolution]
+        for name in args.plugins:
+            if name == 'DCx':
+                try:
+                    result = bench_dcx(width, height, args.frames)
+                except ImportError as e:
+                    print(f'Skipping DCx: {e}')
+                    continue
+                results.append(dict(plugin=name, resolution=resolution, color='Mono', binning=1, **result))
+                print(f'{name:20} {resolution:6} {"Mono":12} bin 1: {result["throughput_fps"]:8.1f} fps')
+                continue
+            plugin_class, serial = tsi_plugins[name]
+            for color in args.colors:
+                for binning in args.binnings:
+                    result = bench_tsi(plugin_class, serial, width, height, color, binning, args.frames)
+                    results.append(dict(plugin=name, resolution=resolution, color=color, binning=binning,
+                                        **result))
+                    print(f'{name:20} {resolution:6} {color:12} bin {binning}: '
+                          f'{result["throughput_fps"]:8.1f} fps')
+    tracemalloc.stop()
+    return results
+
+
+def key(result):
+    return result['plugin'], result['resolution'], result['color'], result['binning']
+
+
+def compare(results, reference_path):
+    reference = {key(result): result for result in json.loads(Path(reference_path).read_text())['results']}
+    print(f'\nThroughput compared to {reference_path}:')
+    for result in results:
+        if key(result) in reference:
+            ratio = result['throughput_fps'] / reference[key(result)]['throughput_fps']
+            print(f'{" ".join(str(k) for k in key(result)):45}: x{ratio:.2f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--frames', type=int, default=100, help='number of frames per configuration')
+    parser.add_argument('--plugins', nargs='+', default=['TSI', 'TSI_autocorrelator', 'DCx'],
+                        choices=['TSI', 'TSI_autocorrelator', 'DCx'])
+    parser.add_argument('--resolutions', nargs='+', default=['VGA', '1.6MP'], choices=list(RESOLUTIONS))
+    parser.add_argument('--colors', nargs='+', default=['RGB', 'MonoChrome', 'Mono sensor'],
+                        choices=['RGB', 'MonoChrome', 'Mono sensor'])
+    parser.add_argument('--binnings', nargs='+', type=int, default=[1, 2])
+    parser.add_argument('--output', default=f'bench_camera_{__version__}.json', help='json file of the results')
+    parser.add_argument('--compare', default=None, help='json file of previous results to compare with')
+    args = parser.parse_args()
+
+    app = QtWidgets.QApplication.instance() or QtWidgets.QApplication(sys.argv)
+    results = run(args)
+
+    Path(args.output).write_text(json.dumps(dict(version=__version__, date=datetime.now().isoformat(),
+                                                 python=sys.version, platform=platform.platform(),
+                                                 frames=args.frames, results=results), indent=2))
+    print(f'Results written to {args.output}')
+    if args.compare is not None:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+"""
+Power reading benchmark of the TLPM power meters
+
+Times a single power measurement through each layer of the stack, from the raw call of the TLPM dll to the methods of
+CustomTLPM used by the plugins, and reports the overhead of each layer over the raw call:
+
+* dll: TLPM_measPower of the dll, called directly with the session of the TLPM.py wrapper
+* wrapper: measPower of the TLPM.py wrapper
+* get_power: CustomTLPM.get_power (error handling decorator and reused ctypes value)
+* read_powers: CustomTLPM.read_powers into a preallocated array, per measurement
+* read_batch: CustomTLPM.read_batch allocating its array, per measurement
+
+    python benchmarks/bench_tlpm.py --reads 2000 --output bench_tlpm.json
+    python benchmarks/bench_tlpm.py --synthetic
+
+A power meter must be connected, unless --synthetic is given: a stand-in for the TLPM wrapper answering immediately
+is then used, so that the results are the python overhead of each layer only.
+"""
+import argparse
+import ctypes
+import json
+import platform
+import sys
+import types
+from datetime import datetime
+from pathlib import Path
+from time import perf_counter
+
+import numpy as np
+
+from pymodaq_plugins_thorlabs import __version__
+from pymodaq_plugins_thorlabs.hardware import powermeter
+
+
+class SyntheticDLL:
+    """Stand-in for the TLPM dll, returning a constant power"""
+
+    def TLPM_measPower(self, session, power):
+        power._obj.value = 1e-3
+        return 0
+
+
+class SyntheticTLPM:
+    """Stand-in for the TLPM class of the TLPM.py wrapper, with the calls used by CustomTLPM"""
+
+    def __init__(self):
+        self.dll = SyntheticDLL()
+        self.devSession = ctypes.c_long(0)
+
+    def findRsrc(self, count):
+        count._obj.value = 1
+
+    def getRsrcName(self, index, name):
+        name.value = b'USB0::0x1313::0x8078::SYNTHETIC::INSTR'
+
+    def open(self, resource, id_query, reset):
+        pass
+
+    def close(self):
+        pass
+
+    def measPower(self, power):
+        return self.dll.TLPM_measPower(self.devSession, power)
+
+
+def time_reads(func, reads, batch=1):
+    """Return the durations (s) of each measurement, func taking batch measurements per call"""
+    ncalls = max(1, reads // batch)
+    durations = np.zeros((ncalls,))
+    for ind in range(ncalls):
+        start = perf_counter()
+        func()
+        durations[ind] = perf_counter() - start
+    return durations / batch
+
+
+def run(args):
+    if args.synthetic:
+        powermeter.TLPM = types.SimpleNamespace(TLPM=SyntheticTLPM)
+        powermeter.discovery = powermeter.TLPMDiscovery()
+    names = powermeter.discovery.device_names()
+    if len(names) == 0:
+        raise SystemExit('No power meter connected, use --synthetic to benchmark the python overhead only')
+
+    tlpm = powermeter.CustomTLPM(args.device)
+    tlpm.open_by_index()
+    print(f'Reading {tlpm.resource_name}')
+    try:
+        wrapper = tlpm._tlpm
+        power = ctypes.c_double()
+        power_ref = ctypes.byref(power)
+        out = np.zeros((args.batch,))
+        stages = {'wrapper': (lambda: wrapper.measPower(power_ref), 1),
+                  'get_power': (tlpm.get_power, 1),
+                  'read_powers': (lambda: tlpm.read_powers(out), args.batch),
+                  'read_batch': (lambda: tlpm.read_batch(args.batch), args.batch)}
+        if hasattr(wrapper, 'dll'):
+            stages = {'dll': (lambda: wrapper.dll.TLPM_measPower(wrapper.devSession, power_ref), 1), **stages}
+
+        for func, batch in stages.values():  # warm up
+            time_reads(func, min(args.reads, 10 * batch), batch)
+        results = {}
+        for name, (func, batch) in stages.items():
+            durations = time_reads(func, args.reads, batch) * 1e6
+            results[name] = dict(mean_us=float(np.mean(durations)), median_us=float(np.median(durations)),
+                                 p95_us=float(np.percentile(durations, 95)))
+    finally:
+        tlpm.close()
+
+    reference = results[next(iter(results))]['median_us']
+    print(f'{"layer":<12} {"median (us)":>12} {"mean (us)":>10} {"p95 (us)":>10} {"overhead (us)":>14}')
+    for name, result in results.items():
+        print(f'{name:<12} {result["median_us"]:12.2f} {result["mean_us"]:10.2f} {result["p95_us"]:10.2f} '
+              f'{result["median_us"] - reference:14.2f}')
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--reads', type=int, default=1000, help='number of measurements per layer')
+    parser.add_argument('--batch', type=int, default=100, help='number of measurements per call of the batched reads')
+    parser.add_argument('--device', type=int, default=0, help='index of the power meter')
+    parser.add_argument('--synthetic', action='store_true', help='use a stand-in for the TLPM wrapper')
+    parser.add_argument('--output', default=None, help='json file of the results')
+    args = parser.parse_args()
+
+    results = run(args)
+    if args.output is not None:
+        Path(args.output).write_text(json.dumps(dict(version=__version__, date=datetime.now().isoformat(),
+                                                     python=sys.version, platform=platform.platform(),
+                                                     synthetic=args.synthetic, reads=args.reads, batch=args.batch,
+                                                     results=results), indent=2))
+        print(f'Results written to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
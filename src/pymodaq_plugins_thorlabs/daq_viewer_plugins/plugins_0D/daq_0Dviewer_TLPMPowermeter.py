@@ -15,7 +15,17 @@ VXIPNPPATH depending on your platform (32 or 64 bits) pointing to where the TLPM
 
 This plugin is making use of the TLPM.py script provided by thorlabs. An alternative is to use the TLPMPowermeterInst
 plugin using the Instrumental_lib package directly interfacing the C library with the nice Instrument wrapper
+
+Each grab reads Naverage power measurements back to back and emits their mean, standard deviation and number (failed
+measurements are not counted). Each measurement can itself be averaged over several samples by the console
+(hardware averaging), where supported.
+
+With background streaming enabled, the power meter is read continuously in its own thread at the streaming rate and
+each grab returns the statistics of the samples measured since the previous grab (Naverage is then not used), so that
+grabs do not wait for the meter.
 """
+from contextlib import nullcontext
+
 from easydict import EasyDict as edict
 from pymodaq.utils.daq_utils import ThreadCommand, getLineInfo
 from pymodaq.utils.data import DataFromPlugins
@@ -23,23 +33,32 @@ from pymodaq.control_modules.viewer_utility_classes import DAQ_Viewer_base, main
 
 import numpy as np
 from pymodaq.control_modules.viewer_utility_classes import comon_parameters
-from pymodaq_plugins_thorlabs.hardware.powermeter import CustomTLPM, DEVICE_NAMES
+from pymodaq_plugins_thorlabs.hardware.powermeter import CustomTLPM, PowerStream, TLPMDevicesMixin, discovery
 
 
-class DAQ_0DViewer_TLPMPowermeter(DAQ_Viewer_base):
+class DAQ_0DViewer_TLPMPowermeter(TLPMDevicesMixin, DAQ_Viewer_base):
 
     _controller_units = 'W'
-    devices = DEVICE_NAMES
+    hardware_averaging = True  # Naverage measurements are read by the plugin at each grab
 
     params = comon_parameters + [
-        {'title': 'Devices:', 'name': 'devices', 'type': 'list', 'limits': devices},
+        {'title': 'Devices:', 'name': 'devices', 'type': 'list', 'limits': []},
+        {'title': 'Refresh devices', 'name': 'refresh_devices', 'type': 'bool_push', 'value': False},
         {'title': 'Info:', 'name': 'info', 'type': 'str', 'value': '', 'readonly': True},
         {'title': 'Wavelength:', 'name': 'wavelength', 'type': 'float', 'value': 532.,},
+        {'title': 'Console averaging:', 'name': 'average_count', 'type': 'int', 'value': 1, 'min': 1,
+         'tip': 'Number of samples averaged by the console for each measurement'},
+        {'title': 'Background streaming:', 'name': 'streaming', 'type': 'bool', 'value': False},
+        {'title': 'Streaming rate (Hz):', 'name': 'stream_rate', 'type': 'float', 'value': 100., 'min': 0.,
+         'tip': '0 to read as fast as possible'},
+        {'title': 'Buffer size:', 'name': 'stream_size', 'type': 'int', 'value': 10000, 'min': 1},
         ]
 
     def __init__(self, parent=None, params_state=None):
         super().__init__(parent, params_state)
-
+        self._samples = np.zeros((1,))
+        self.stream: PowerStream = None
+        self.update_devices()
 
     def ini_detector(self, controller=None):
         """
@@ -63,7 +82,7 @@ class DAQ_0DViewer_TLPMPowermeter(DAQ_Viewer_base):
                 else:
                     self.controller = controller
             else:
-                index = DEVICE_NAMES.index(self.settings['devices'])
+                index = discovery.device_index(self.settings['devices'])
                 self.controller = CustomTLPM()
                 info = self.controller.infos.get_devices_info(index)
                 self.controller.open_by_index(index)
@@ -72,6 +91,9 @@ class DAQ_0DViewer_TLPMPowermeter(DAQ_Viewer_base):
             self.settings.child('wavelength').setOpts(limits=self.controller.wavelength_range)
             self.controller.wavelength = self.settings.child('wavelength').value()
             self.settings.child('wavelength').setValue(self.controller.wavelength)
+            self.controller.average_count = self.settings.child('average_count').value()
+            self.settings.child('average_count').setValue(self.controller.average_count)
+            self.setup_stream()
 
             self.status.initialized = True
             self.status.controller = self.controller
@@ -88,14 +110,44 @@ class DAQ_0DViewer_TLPMPowermeter(DAQ_Viewer_base):
     def commit_settings(self, param):
         """
         """
-        if param.name() == 'wavelength':
-            self.controller.wavelength = self.settings.child('wavelength').value()
-            self.settings.child('wavelength').setValue(self.controller.wavelength)
+        if param.name() == 'refresh_devices':
+            if param.value():
+                self.update_devices(refresh=True)
+                param.setValue(False)
+            return
+        elif param.name() in ['streaming', 'stream_size']:
+            self.setup_stream()
+            return
+        elif param.name() == 'stream_rate':
+            if self.stream is not None:
+                self.stream.rate = param.value()
+            return
+
+        # the meter must not be called while the stream is measuring
+        with self.stream.lock if self.stream is not None else nullcontext():
+            if param.name() == 'wavelength':
+                self.controller.wavelength = self.settings.child('wavelength').value()
+                self.settings.child('wavelength').setValue(self.controller.wavelength)
+            elif param.name() == 'average_count':
+                self.controller.average_count = param.value()
+                param.setValue(self.controller.average_count)
+
+    def setup_stream(self):
+        """(Re)start or stop the background streaming depending on the settings"""
+        if self.stream is not None:
+            self.stream.stop()
+            self.stream = None
+        if self.settings.child('streaming').value() and self.controller is not None:
+            self.stream = PowerStream(self.controller, self.settings.child('stream_rate').value(),
+                                      self.settings.child('stream_size').value())
 
     def close(self):
         """
             close the current instance of Keithley viewer.
         """
+        if self.stream is not None:
+            self.stream.stop()
+            self.stream = None
         self.controller.close()
 
     def grab_data(self, Naverage=1, **kwargs):
@@ -109,9 +161,18 @@ class DAQ_0DViewer_TLPMPowermeter(DAQ_Viewer_base):
             *Naverage*      int       Number of values to average
             =============== ======== ===============================================
         """
-        data = [np.array([self.controller.get_power()])]
+        if self.stream is not None:
+            _, samples = self.stream.read()
+        else:
+            if self._samples.size != Naverage:
+                self._samples = np.zeros((max(1, Naverage),))
+            samples = self.controller.read_powers(self._samples)
+        count = np.count_nonzero(~np.isnan(samples))
+        mean = np.nanmean(samples) if count > 0 else np.nan
+        std = np.nanstd(samples) if count > 1 else 0.
+        data = [np.array([mean]), np.array([std]), np.array([float(count)])]
         self.data_grabed_signal.emit([DataFromPlugins(name='Powermeter', data=data,
-                                                      dim='Data0D', labels=['Power (W)'],)])
+                                                      dim='Data0D', labels=['Power (W)', 'Std (W)', 'Samples'],)])
 
 
     def stop(self):
@@ -27,7 +27,7 @@ from pymodaq.control_modules.viewer_utility_classes import DAQ_Viewer_base, main
 import time
 import numpy as np
 from pymodaq.control_modules.viewer_utility_classes import comon_parameters
-from pymodaq_plugins_thorlabs.hardware.powermeter import CustomTLPM, DEVICE_NAMES
+from pymodaq_plugins_thorlabs.hardware.powermeter import CustomTLPM, TLPMDevicesMixin, discovery
 from typing import Union, List, Dict
 from pymodaq.control_modules.move_utility_classes import (DAQ_Move_base, comon_parameters_fun,
                                                           main, DataActuatorType, DataActuator)
@@ -65,23 +65,22 @@ class YoctoServoWrapper:
 
 
 
-class DAQ_0DViewer_TLPMPowermeterLockInServo(DAQ_Viewer_base):
+class DAQ_0DViewer_TLPMPowermeterLockInServo(TLPMDevicesMixin, DAQ_Viewer_base):
 
     _controller_units = 'W'
-    devices = DEVICE_NAMES
     servo: YoctoServoWrapper = None
 
     params = comon_parameters + [
-        {'title': 'Devices:', 'name': 'devices', 'type': 'list', 'limits': devices},
+        {'title': 'Devices:', 'name': 'devices', 'type': 'list', 'limits': []},
+        {'title': 'Refresh devices', 'name': 'refresh_devices', 'type': 'bool_push', 'value': False},
         {'title': 'Info:', 'name': 'info', 'type': 'str', 'value': '', 'readonly': True},
         {'title': 'Wavelength:', 'name': 'wavelength', 'type': 'float', 'value': 532.,},
         {'title': 'Nb of cycle:', 'name': 'nb_of_cycle', 'type': 'int', 'value':1, 'limits': (1, 300)},
         {'title': 'Servo time:', 'name': 'servo_time', 'type': 'float', 'value': 1.0, 'limits': (1.1, 30)},
         ]
 
-    def __init__(self, parent=None, params_state=None):
-        super().__init__(parent, params_state)
-
+    def ini_attributes(self):
+        self.update_devices()
 
     def ini_detector(self, controller=None):
         """
@@ -106,7 +105,7 @@ class DAQ_0DViewer_TLPMPowermeterLockInServo(DAQ_Viewer_base):
                 else:
                     self.controller = controller
             else:
-                index = DEVICE_NAMES.index(self.settings['devices'])
+                index = discovery.device_index(self.settings['devices'])
                 self.controller = CustomTLPM()
                 info = self.controller.infos.get_devices_info(index)
                 print('Trying to open device')
@@ -142,7 +141,11 @@ class DAQ_0DViewer_TLPMPowermeterLockInServo(DAQ_Viewer_base):
     def commit_settings(self, param):
         """
         """
-        if param.name() == 'wavelength':
+        if param.name() == 'refresh_devices':
+            if param.value():
+                self.update_devices(refresh=True)
+                param.setValue(False)
+        elif param.name() == 'wavelength':
             self.controller.wavelength = self.settings.child('wavelength').value()
             self.settings.child('wavelength').setValue(self.controller.wavelength)
 
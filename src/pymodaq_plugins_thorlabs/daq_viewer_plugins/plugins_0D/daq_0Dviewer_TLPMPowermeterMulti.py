@@ -0,0 +1,159 @@
+"""
+PyMoDAQ plugin reading several power meters of the TLPM library at once (see the TLPMPowermeter plugin for the
+compatible devices and the installation of the library)
+
+Each selected meter is opened in its own TLPM session and, at each grab, all of them are read at the same time from a
+pool of threads (one per meter): each one reads Naverage measurements back to back. The mean power of each meter is
+emitted as one channel of a single Data0D, along with the mean time of the measurements of each meter (in seconds
+since the initialization of the plugin) so that their synchronization can be checked.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+
+import numpy as np
+from pymodaq.utils.daq_utils import ThreadCommand
+from pymodaq.utils.data import DataFromPlugins, DataToExport
+from pymodaq.control_modules.viewer_utility_classes import DAQ_Viewer_base, comon_parameters, main
+
+from pymodaq_plugins_thorlabs.hardware.powermeter import CustomTLPM, TLPMDevicesMixin, discovery
+
+
+class DAQ_0DViewer_TLPMPowermeterMulti(TLPMDevicesMixin, DAQ_Viewer_base):
+
+    _controller_units = 'W'
+    hardware_averaging = True  # Naverage measurements are read from each meter at each grab
+
+    params = comon_parameters + [
+        {'title': 'Devices:', 'name': 'devices', 'type': 'itemselect',
+         'value': dict(all_items=[], selected=[])},
+        {'title': 'Refresh devices', 'name': 'refresh_devices', 'type': 'bool_push', 'value': False},
+        {'title': 'Info:', 'name': 'info', 'type': 'text', 'value': '', 'readonly': True},
+        {'title': 'Wavelength:', 'name': 'wavelength', 'type': 'float', 'value': 532.},
+        ]
+
+    def ini_attributes(self):
+        self.controller: list = None  # the CustomTLPM of the selected meters
+        self.labels = []
+        self.pool: ThreadPoolExecutor = None
+        self._samples = []
+        self._t0 = perf_counter()
+        self.update_devices()
+
+    def ini_detector(self, controller=None):
+        """Detector communication initialization
+
+        Parameters
+        ----------
+        controller: (object)
+            custom object of a PyMoDAQ plugin (Slave case). None if only one actuator/detector by controller
+            (Master case)
+
+        Returns
+        -------
+        info: str
+        initialized: bool
+            False if initialization failed otherwise True
+        """
+        names = self.settings['devices']['selected']
+        if len(names) == 0:
+            return 'No power meter selected', False
+        meters = []
+        indexes = [discovery.device_index(name) for name in names]
+        for name, index in zip(names, indexes):
+            meter = CustomTLPM()
+            if not meter.open_by_index(index):
+                for opened in meters:
+                    opened.close()
+                return f'The power meter {name} could not be opened', False
+            meters.append(meter)
+        self.ini_detector_init(old_controller=controller, new_controller=meters)
+
+        infos = [meter.infos.get_devices_info(index) for meter, index in zip(self.controller, indexes)]
+        self.labels = [f'{info.model_name} {info.serial_number}'.strip() or name for info, name in zip(infos, names)]
+        self.settings.child('info').setValue('\n'.join(str(info) for info in infos))
+        self.set_wavelength()
+
+        self.pool = ThreadPoolExecutor(max_workers=len(self.controller))
+        self._samples = [np.zeros((1,)) for _ in self.controller]
+        self._t0 = perf_counter()
+
+        info = f'{len(self.controller)} power meters initialized'
+        initialized = True
+        return info, initialized
+
+    def set_wavelength(self):
+        wavelength = self.settings['wavelength']
+        for meter in self.controller:
+            meter.wavelength = wavelength
+        # the first meter tells the wavelength actually set
+        self.settings.child('wavelength').setValue(self.controller[0].wavelength)
+
+    def commit_settings(self, param):
+        """Apply the consequences of a change of value in the detector settings
+
+        Parameters
+        ----------
+        param: Parameter
+            A given parameter (within detector_settings) whose value has been changed by the user
+        """
+        if param.name() == 'refresh_devices':
+            if param.value():
+                self.update_devices(refresh=True)
+                param.setValue(False)
+        elif param.name() == 'wavelength':
+            self.set_wavelength()
+
+    def read_meter(self, meter: CustomTLPM, samples: np.ndarray):
+        """Read a meter, called from the thread pool
+
+        Returns
+        -------
+        float: the mean power (W)
+        float: the mean time of the measurements (s)
+        """
+        start = perf_counter()
+        samples = meter.read_powers(samples)
+        timestamp = (start + perf_counter()) / 2 - self._t0
+        return np.nanmean(samples) if np.any(~np.isnan(samples)) else np.nan, timestamp
+
+    def grab_data(self, Naverage=1, **kwargs):
+        """Read all the meters at the same time and emit their powers and the times of the measurements
+
+        Parameters
+        ----------
+        Naverage: int
+            Number of measurements averaged for each meter
+        kwargs: dict
+            others optionals arguments
+        """
+        try:
+            Naverage = max(1, Naverage)
+            if self._samples[0].size != Naverage:
+                self._samples = [np.zeros((Naverage,)) for _ in self.controller]
+            futures = [self.pool.submit(self.read_meter, meter, samples)
+                       for meter, samples in zip(self.controller, self._samples)]
+            powers, timestamps = zip(*[future.result() for future in futures])
+
+            self.dte_signal.emit(DataToExport('Powermeters', data=[
+                DataFromPlugins(name='Powers', dim='Data0D', labels=[f'{label} (W)' for label in self.labels],
+                                data=[np.array([power]) for power in powers]),
+                DataFromPlugins(name='Timestamps', dim='Data0D', labels=[f'{label} (s)' for label in self.labels],
+                                data=[np.array([timestamp]) for timestamp in timestamps])]))
+        except Exception as e:
+            self.emit_status(ThreadCommand('Update_Status', [str(e), 'log']))
+
+    def close(self):
+        """Terminate the communication protocol"""
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+        for meter in self.controller or []:
+            meter.close()
+        self.controller = None
+
+    def stop(self):
+        return ''
+
+
+if __name__ == '__main__':
+    main(__file__)
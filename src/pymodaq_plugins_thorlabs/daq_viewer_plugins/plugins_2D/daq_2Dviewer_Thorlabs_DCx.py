@@ -1,8 +1,12 @@
 from easydict import EasyDict as edict
+import numpy as np
 from pymodaq.utils.daq_utils import ThreadCommand, getLineInfo
-from pymodaq.utils.data import DataFromPlugins, Axis
+from pymodaq.utils.data import DataFromPlugins, Axis, DataToExport
 from pymodaq.control_modules.viewer_utility_classes import DAQ_Viewer_base, comon_parameters, main
-from instrumental import instrument, list_instruments, Q_
+from instrumental import Q_
+from qtpy import QtWidgets, QtCore
+
+from pymodaq_plugins_thorlabs.hardware.uc480 import cameras, snap_aoi, BINNINGS, SUBSAMPLINGS
 
 # This is a (probably bad) way of importing the stuff needed to get exposure range
 import instrumental.drivers.cameras.uc480 as uc480module
@@ -29,24 +33,46 @@ class DAQ_2DViewer_Thorlabs_DCx(DAQ_Viewer_base):
             PATH variable.
         In principle the dependencies (pywin32, nicelib) should be installed
             automatically while installing the plugin.
-    """
 
-    # Look for plugged cameras and get the serial numbers
-    plugged_cameras = list_instruments(module='cameras.uc480')
-    serial_numbers = []
-    for paramset in plugged_cameras:
-        camera = instrument(paramset, reopen_policy='reuse')
-        serial_numbers.append(camera.serial.decode("utf-8"))
+        Acquisition
+        -----------
+        The camera runs in live video mode, started at the first grab and kept running between grabs: each grab
+            waits for the next frame (in a callback thread, as for the TSI plugin) and reads the newest one.
+            Exposure, gain and frame rate are only sent to the camera when changed in the settings.
+
+        ROI and binning
+        ---------------
+        The AOI (area of interest), binning and subsampling are handled on the camera side, so that smaller images
+            are read faster. As for the TSI plugin, select the region with the ROI selection area of the viewer
+            (icon with dashed rectangle) and click "Update ROI". "Clear ROI+Bin" goes back to the full frame. The
+            AOI is enlarged to the position and size steps allowed by the camera.
+
+        Cameras are listed when the plugin is created (or when refreshing the list), without being opened. An
+            opened camera is kept open until the plugin (the Master one if shared) is closed.
+    """
 
     params = comon_parameters + [
-        {'title': 'Serial number:', 'name': 'serial_number', 'type': 'list', 'limits': serial_numbers},
+        {'title': 'Serial number:', 'name': 'serial_number', 'type': 'list', 'limits': []},
+        {'title': 'Refresh cameras', 'name': 'refresh_cameras', 'type': 'bool_push', 'value': False},
         {'title': 'Exposure (ms):', 'name': 'exposure', 'type': 'float', 'value': 0},
+        {'title': 'Frame rate (Hz):', 'name': 'framerate', 'type': 'float', 'value': 0, 'min': 0,
+         'tip': '0 for the highest frame rate allowed by the exposure'},
         {'title': 'Gain:', 'name': 'master_gain', 'type': 'int', 'value': 0, "limits": [0, 100]},
         {'title': 'Gain Boost:', 'name': 'gain_boost', 'type': 'bool', 'value': False},
         {'title': 'gamma', 'name': 'gamma', 'type': 'int', 'value': 0},
         {'title': 'Color Mode', 'name': 'colormode', 'type': 'str', 'value': 'mono8', "readonly": True},
+        {'title': 'Update ROI', 'name': 'update_roi', 'type': 'bool_push', 'value': False},
+        {'title': 'Clear ROI+Bin', 'name': 'clear_roi', 'type': 'bool_push', 'value': False},
+        {'title': 'X binning', 'name': 'x_binning', 'type': 'list', 'limits': BINNINGS, 'value': 1},
+        {'title': 'Y binning', 'name': 'y_binning', 'type': 'list', 'limits': BINNINGS, 'value': 1},
+        {'title': 'X subsampling', 'name': 'x_subsampling', 'type': 'list', 'limits': SUBSAMPLINGS, 'value': 1},
+        {'title': 'Y subsampling', 'name': 'y_subsampling', 'type': 'list', 'limits': SUBSAMPLINGS, 'value': 1},
+        {'title': 'Image width', 'name': 'hdet', 'type': 'int', 'value': 1, 'readonly': True},
+        {'title': 'Image height', 'name': 'vdet', 'type': 'int', 'value': 1, 'readonly': True},
     ]
 
+    callback_signal = QtCore.Signal()
+
     def __init__(self, parent=None, params_state=None):
         super().__init__(parent, params_state)
 
@@ -54,18 +80,123 @@ class DAQ_2DViewer_Thorlabs_DCx(DAQ_Viewer_base):
         self.y_axis = None
 
         self.controller = None
+        self.callback_thread = None
+        self.live = False
+        self.aoi = None  # (x0, y0, x1, y1) in unbinned sensor pixels, None for the full frame
+        self.roi_kwds = dict(hbin=1, vbin=1, hsub=1, vsub=1)  # given to instrumental when starting the live video
+        self.update_serial_numbers()
+
+    def update_serial_numbers(self, refresh=False):
+        """Fill the list of cameras, keeping the selected one if still connected"""
+        try:
+            selected = self.settings['serial_number']
+            serial_numbers = cameras.serial_numbers(refresh)
+            self.settings.child('serial_number').setLimits(serial_numbers)
+            if selected in serial_numbers:
+                self.settings.child('serial_number').setValue(selected)
+        except Exception as e:  # uc480 library not found for instance
+            self.emit_status(ThreadCommand('Update_Status', [str(e), 'log']))
 
     def commit_settings(self, param):
         """
         """
-        if param.name() == 'exposure':
+        if param.name() == 'refresh_cameras':
+            if param.value():
+                self.update_serial_numbers(refresh=True)
+                param.setValue(False)
+        elif param.name() in ['exposure', 'framerate']:
             # For some reason exposure is dealt specially in the instrumental lib
-            self.controller._set_exposure(Q_(param.value(), 'ms'))
+            # the frame rate is set first, as it limits the exposure range
+            self.set_framerate()
+            self.controller._set_exposure(Q_(self.settings.child('exposure').value(), 'ms'))
             self.settings.child('exposure').setValue(self.controller._get_exposure().m_as('ms'))
         elif param.name() in ['master_gain', 'gain_boost', 'gamma']:
             # All settings without units can be dealt as a single case
             setattr(self.controller, param.name(), param.value())
             self.settings.child(param.name()).setValue(getattr(self.controller, param.name()))
+        elif param.name() == 'update_roi':
+            if param.value():
+                # The rectangle is given in pixels of the current image, relative to the current AOI
+                hfactor, vfactor = self.factors()
+                x0 = (self.roi_kwds.get('left', 0) + self.settings.child('ROIselect', 'x0').value()) * hfactor
+                y0 = (self.roi_kwds.get('top', 0) + self.settings.child('ROIselect', 'y0').value()) * vfactor
+                x1 = x0 + self.settings.child('ROIselect', 'width').value() * hfactor
+                y1 = y0 + self.settings.child('ROIselect', 'height').value() * vfactor
+                self.update_rois((x0, y0, x1, y1))
+                # recenter rectangle
+                self.settings.child('ROIselect', 'x0').setValue(0)
+                self.settings.child('ROIselect', 'y0').setValue(0)
+                param.setValue(False)
+        elif param.name() in ['x_binning', 'y_binning', 'x_subsampling', 'y_subsampling']:
+            self.update_rois(self.aoi)
+        elif param.name() == 'clear_roi':
+            if param.value():
+                for name in ['x_binning', 'y_binning', 'x_subsampling', 'y_subsampling']:
+                    self.settings.child(name).setValue(1)
+                self.update_rois(None)
+                param.setValue(False)
+
+    def factors(self):
+        """Return the horizontal and vertical size of the image pixels, in sensor pixels"""
+        return (self.roi_kwds['hbin'] * self.roi_kwds['hsub'], self.roi_kwds['vbin'] * self.roi_kwds['vsub'])
+
+    def update_rois(self, aoi):
+        """Set the AOI, binning and subsampling of the camera, does nothing if they are already set
+
+        Parameters
+        ----------
+        aoi: tuple of int or None
+            (x0, y0, x1, y1) in unbinned sensor pixels, None for the full frame
+        """
+        try:
+            if aoi is not None:
+                aoi = tuple(int(value) for value in aoi)
+            roi_kwds = dict(hbin=self.settings.child('x_binning').value(),
+                            vbin=self.settings.child('y_binning').value(),
+                            hsub=self.settings.child('x_subsampling').value(),
+                            vsub=self.settings.child('y_subsampling').value())
+            if aoi == self.aoi and all(self.roi_kwds[key] == value for key, value in roi_kwds.items()) \
+                    and 'left' in self.roi_kwds:
+                return
+            # the live video captures into buffers of the current image size, it is stopped before any change
+            live = self.live
+            self.stop_live()
+            # the maximum AOI depends on the binning and subsampling, set them first
+            self.controller._set_binning(roi_kwds['vbin'], roi_kwds['hbin'])
+            self.controller._set_subsampling(roi_kwds['vsub'], roi_kwds['hsub'])
+            self.controller._refresh_sizes()
+            roi_kwds.update(snap_aoi(self.controller, aoi, roi_kwds['hbin'] * roi_kwds['hsub'],
+                                     roi_kwds['vbin'] * roi_kwds['vsub']))
+            self.aoi = aoi
+            self.roi_kwds = roi_kwds
+            self.controller._set_AOI(roi_kwds['left'], roi_kwds['top'], roi_kwds['right'], roi_kwds['bot'])
+            if live:  # new buffers of the new size are allocated by instrumental
+                self.start_live()
+            self.settings.child('hdet').setValue(self.controller.width)
+            self.settings.child('vdet').setValue(self.controller.height)
+            self.emit_status(ThreadCommand('Update_Status', [f'Changed ROI: {roi_kwds}']))
+            self._prepare_view()
+        except Exception as e:
+            self.emit_status(ThreadCommand('Update_Status', [str(e), 'log']))
+
+    def _prepare_view(self):
+        """Update the axes to the current AOI, binning and subsampling and initialize the viewer
+
+        The axes are in unbinned sensor pixels, so that images of different ROIs are displayed at their place. They
+        are given to the emitted frames, the viewer is initialized with a small placeholder as only its
+        dimensionality matters.
+        """
+        width, height = self.controller.width, self.controller.height
+        hfactor, vfactor = self.factors()
+        self.x_axis = Axis('x', 'pxl', index=1, scaling=hfactor, offset=self.roi_kwds['left'] * hfactor, size=width)
+        self.y_axis = Axis('y', 'pxl', index=0, scaling=vfactor, offset=self.roi_kwds['top'] * vfactor, size=height)
+        self.data_grabed_signal_temp.emit([DataFromPlugins(name='Thorcam', data=[np.zeros((2, 2), dtype=np.uint8)],
+                                                           dim='Data2D')])
+        QtWidgets.QApplication.processEvents()
+
+    def axes(self):
+        """Copies of the current axes, to be given to emitted data"""
+        return [self.y_axis.copy(), self.x_axis.copy()] if self.x_axis is not None else []
 
     def ini_detector(self, controller=None):
         """Detector communication initialization
@@ -91,16 +222,7 @@ class DAQ_2DViewer_Thorlabs_DCx(DAQ_Viewer_base):
                 else:
                     self.controller = controller
             else:
-                camera_serial = self.settings.child('serial_number').value()
-                plugged_cameras = list_instruments(module='cameras.uc480')
-                selected_camera = None
-                # Find the paramset that has the selected serial number
-                for paramset in plugged_cameras:
-                    camera = instrument(paramset, reopen_policy='reuse')
-                    if camera.serial.decode("utf-8") == camera_serial:
-                        selected_camera = camera
-
-                self.controller = selected_camera
+                self.controller = cameras.open(self.settings.child('serial_number').value())
 
                 # Getting the current settings from the instrument.
                 # Exposure is weird
@@ -117,6 +239,16 @@ class DAQ_2DViewer_Thorlabs_DCx(DAQ_Viewer_base):
                 rangemax = self.controller._dev.Exposure(uc480module.lib.IS_EXPOSURE_CMD_GET_EXPOSURE_RANGE_MAX)
                 self.settings.child('exposure').setOpts(limits=[rangemin, rangemax])
 
+                self.update_rois(None)
+
+            callback = DCxCallback(self.wait_for_frame)
+            self.callback_thread = QtCore.QThread()
+            callback.moveToThread(self.callback_thread)
+            callback.data_sig.connect(self.emit_data)
+            self.callback_signal.connect(callback.wait_for_acquisition)
+            self.callback_thread.callback = callback
+            self.callback_thread.start()
+
             self.status.info = "Detector initialized"
             self.status.initialized = True
             self.status.controller = self.controller
@@ -133,7 +265,41 @@ class DAQ_2DViewer_Thorlabs_DCx(DAQ_Viewer_base):
         """
         Terminate the communication protocol
         """
-        self.controller.close()
+        self.stop_live()
+        if self.callback_thread is not None:
+            self.callback_thread.quit()
+            self.callback_thread.wait()
+            self.callback_thread = None
+        if self.settings.child('controller_status').value() == "Master":  # the camera may be shared with Slaves
+            cameras.close(self.settings.child('serial_number').value())
+
+    def set_framerate(self):
+        """Set the frame rate of the live video, the highest one allowed by the exposure if set to 0"""
+        framerate = self.settings.child('framerate').value()
+        if framerate <= 0:
+            framerate = 1000 / max(self.settings.child('exposure').value(), 1e-3)
+        self.controller._dev.SetFrameRate(framerate)
+
+    def start_live(self):
+        """Start the live video with the current settings, the camera then runs freely"""
+        # The instrumental library sets exposure and gain to its defaults if they are not given here
+        kwds = {'exposure_time': Q_(self.settings.child('exposure').value(), 'ms'),
+                'gain': self.settings.child('master_gain').value()}
+        framerate = self.settings.child('framerate').value()
+        self.controller.start_live_video(framerate=Q_(framerate, 'Hz') if framerate > 0 else None, **kwds,
+                                         **self.roi_kwds)
+        self.live = True
+
+    def stop_live(self):
+        if self.live:
+            self.controller.stop_live_video()
+            self.live = False
+
+    def wait_for_frame(self):
+        """Wait for the next frame of the live video. Called from the callback thread"""
+        # a frame is expected within an exposure, wait for a few of them
+        timeout = 1000 + 3 * self.settings.child('exposure').value()
+        return self.controller.wait_for_frame(timeout=Q_(timeout, 'ms'))
 
     def grab_data(self, Naverage=1, **kwargs):
         """
@@ -142,28 +308,59 @@ class DAQ_2DViewer_Thorlabs_DCx(DAQ_Viewer_base):
         Naverage: (int) Number of hardware averaging
         kwargs: (dict) of others optionals arguments
         """
-        #The instrumental library seems really broken AF unfortunately so I have to use this to acquire a frame otherwise
-        #it just uses the default values...
-        kwds = {'exposure_time': Q_(self.settings.child('exposure').value(), 'ms'),
-                'gain': self.settings.child('master_gain').value()}
+        try:
+            if not self.live:
+                self.start_live()
+            self.callback_signal.emit()  # will trigger the wait for the next frame
+        except Exception as e:
+            self.emit_status(ThreadCommand('Update_Status', [str(e), 'log']))
 
-        data = self.controller.grab_image(**kwds)
+    def emit_data(self):
+        """Read the newest frame of the live video and emit it, fired by the callback once a frame is available"""
+        try:
+            # lines of the buffer may be padded beyond the image width
+            data = self.controller.latest_frame()[:, :self.controller.width]
 
-        if len(data.shape) > 2:
-            data_list = [data[..., ind] for ind in range(data.shape[2])]
-        else:
-            data_list = [data]
+            if len(data.shape) > 2:
+                data_list = [data[..., ind] for ind in range(data.shape[2])]
+            else:
+                data_list = [data]
 
-        # data = self.controller.grab_image(exposure_time=Q_(self.settings.child('exposure').value(), 'ms'))
-        self.data_grabed_signal.emit([DataFromPlugins(name='Thorcam', data=data_list,
-                                                      dim='Data2D')])
+            self.dte_signal.emit(DataToExport('Thorcam', data=[DataFromPlugins(name='Thorcam', data=data_list,
+                                                                               dim='Data2D', axes=self.axes())]))
+            # To make sure that timed events are executed in continuous grab mode
+            QtWidgets.QApplication.processEvents()
+        except Exception as e:
+            self.emit_status(ThreadCommand('Update_Status', [str(e), 'log']))
 
     def stop(self):
 
-        self.controller.stop_live_video()
+        self.stop_live()
         # self.emit_status(ThreadCommand('Update_Status', ['Some info you want to log']))
         return ''
 
 
+class DCxCallback(QtCore.QObject):
+    """Callback object waiting for the frames of the live video in its own thread
+
+    Parameters
+    ----------
+    wait_fn: callable
+        blocking function waiting for a new frame, returning False on timeout
+    """
+    data_sig = QtCore.Signal()
+
+    def __init__(self, wait_fn):
+        super().__init__()
+        self.wait_fn = wait_fn
+
+    def wait_for_acquisition(self):
+        try:
+            if self.wait_fn():
+                self.data_sig.emit()
+        except Exception:  # camera stopped or closed while waiting
+            pass
+
+
 if __name__ == '__main__':
     main(__file__, init=False)
\ No newline at end of file
@@ -1,14 +1,20 @@
-import cv2
 from pymodaq.utils.daq_utils import ThreadCommand
-from pymodaq.utils.data import DataFromPlugins, Axis
+from pymodaq.utils.data import DataFromPlugins, Axis, DataToExport
 from pymodaq.control_modules.viewer_utility_classes import DAQ_Viewer_base, comon_parameters, main
 from pymodaq.utils.parameter import Parameter
 
 from pylablib.devices import Thorlabs
 from qtpy import QtWidgets, QtCore
 import numpy as np
+from datetime import datetime
+from pathlib import Path
 from time import perf_counter
 
+from pymodaq_plugins_thorlabs.hardware.tlcamera import (FrameRing, BayerDemosaic, FrameAverager, FramePipeline,
+                                                        DisplayThrottle, FrameRecorder, RoiPresets, list_cameras,
+                                                        open_camera, config)
+from pymodaq_plugins_thorlabs.hardware.beam_profile import BeamProfiler
+
 
 class DAQ_2DViewer_Thorlabs_TSI(DAQ_Viewer_base):
     """
@@ -17,14 +23,54 @@ class DAQ_2DViewer_Thorlabs_TSI(DAQ_Viewer_base):
 
     As in pylablib, the plugin will look for DLLs in the default Thorcam installation folder. Specifying a custom DLL folder is not implemented yet.
 
+    Simulated cameras (see hardware/simulated_tlcamera.py) can be listed along with the real ones by setting
+    simulated = true in the [TLCamera] section of the plugin configuration file.
+
     The plugin provides binning functionality as well as ROI (region of interest) selection, which are on handled the hardware side.
     To use ROIs, click on "Show/Hide ROI selection area" in the viewer panel (icon with dashed rectangle).
     Position the rectangle as you wish, either with mouse or by entering coordinates, then click "Update ROI" button.
 
     The "Clear ROI+Bin" button resets to default cameras parameters: no binning and full frame.
+
+    The current ROI and binning can be saved as a named preset (stored in the plugin configuration file) and applied
+    back later. Requesting the ROI and binning already set does not reconfigure the camera.
+
+    In "Newest" read mode only the last frame of the camera buffer is emitted at each wakeup. In "Batched" read mode,
+    every pending frame (up to the stack depth) is drained into a preallocated stack and emitted at once, along with
+    the camera frame index and timestamp of each frame (as in the burst modes below). Frames lost on the way are
+    reported in the "Frame buffer" group: skipped frames were overwritten in the camera buffer before being read,
+    dropped frames were read but not emitted.
+
+    Naverage is handled on the plugin side: frames are summed as they arrive on the callback thread and only the
+    averaged frame is emitted. In "Running" averaging mode, a running mean over Naverage frames is emitted for each
+    new frame instead.
+
+    With the worker pipeline enabled, frames are converted (and analysed by subclasses) in a pool of threads
+    while the camera keeps being read. When the workers lag behind, frames are either dropped (fine for a live
+    display) or the acquisition waits for them (to be used when saving, no frame is lost).
+
+    With the display throttle enabled, full resolution frames are still emitted for saving but not plotted. The
+    viewer is sent a downsampled preview instead, refreshed at most at the maximum display rate.
+
+    In burst modes, the camera is armed once and acquires a burst of frames for each trigger, sent either by
+    grab_data (software trigger) or by an external signal on the trigger input (hardware trigger). Each burst is read
+    as one block and emitted as a stack of frames along with the camera frame index and timestamp of each frame. This
+    is meant for scans: the camera is not restarted at each step. Naverage is not used in burst modes.
+
+    Recording writes every raw frame, with its frame index and timestamp, to a preallocated HDF5 or memory mapped
+    file from a dedicated thread, bypassing PyMoDAQ saving. All pending frames are then read whatever the read mode
+    and only downsampled previews are sent to the viewer, at most at the maximum display rate. Recording stops when
+    unchecked or once the requested number of frames has been written.
+
+    The beam profile mode emits the ISO 11146 second moment centroid, diameters, ellipticity and angle of the beam
+    along with each frame, in pixels of the image (it needs the laserbeamsize package). To keep up with the camera,
+    the analysis is done on a region around the previous beam, block-averaged down to a maximum size, and can be done
+    on one frame every N only (the other frames carry the latest result).
     """
 
-    serialnumbers = Thorlabs.list_cameras_tlcam()
+    hardware_averaging = True  # Naverage frames are averaged by the plugin, see FrameAverager
+
+    serialnumbers = list_cameras()
 
     params = comon_parameters + [
         {'title': 'Camera name:', 'name': 'camera_name', 'type': 'str', 'value': '', 'readonly': True},
@@ -39,14 +85,69 @@ class DAQ_2DViewer_Thorlabs_TSI(DAQ_Viewer_base):
         {'title': 'Y binning', 'name': 'y_binning', 'type': 'int', 'value': 1},
         {'title': 'Image width', 'name': 'hdet', 'type': 'int', 'value': 1, 'readonly': True},
         {'title': 'Image height', 'name': 'vdet', 'type': 'int', 'value': 1, 'readonly': True},
+        {'title': 'ROI presets', 'name': 'roi_presets', 'type': 'group', 'children':
+            [{'title': 'Preset', 'name': 'preset', 'type': 'list', 'limits': RoiPresets(config).names()},
+             {'title': 'Apply preset', 'name': 'apply_preset', 'type': 'bool_push', 'value': False},
+             {'title': 'Delete preset', 'name': 'delete_preset', 'type': 'bool_push', 'value': False},
+             {'title': 'New preset name', 'name': 'preset_name', 'type': 'str', 'value': ''},
+             {'title': 'Save current ROI', 'name': 'save_preset', 'type': 'bool_push', 'value': False}]
+        },
         {'title': 'Timing', 'name': 'timing_opts', 'type': 'group', 'children':
             [{'title': 'Exposure Time (ms)', 'name': 'exposure_time', 'type': 'int', 'value': 1},
             {'title': 'Compute FPS', 'name': 'fps_on', 'type': 'bool', 'value': True},
             {'title': 'FPS', 'name': 'fps', 'type': 'float', 'value': 0.0, 'readonly': True}]
+        },
+        {'title': 'Trigger', 'name': 'trigger_opts', 'type': 'group', 'children':
+            [{'title': 'Mode', 'name': 'trigger_mode', 'type': 'list',
+              'limits': ['Continuous', 'Software burst', 'External burst']},
+             {'title': 'Frames per burst', 'name': 'burst_frames', 'type': 'int', 'value': 10, 'min': 1},
+             {'title': 'Polarity', 'name': 'trigger_polarity', 'type': 'list', 'limits': ['rise', 'fall']},
+             {'title': 'Timeout (s)', 'name': 'trigger_timeout', 'type': 'float', 'value': 20., 'min': 0.1},
+             {'title': 'Bursts', 'name': 'bursts', 'type': 'int', 'value': 0, 'readonly': True}]
+        },
+        {'title': 'Frame buffer', 'name': 'buffer_opts', 'type': 'group', 'children':
+            [{'title': 'Read mode', 'name': 'read_mode', 'type': 'list', 'limits': ['Newest', 'Batched']},
+             {'title': 'Stack depth', 'name': 'stack_depth', 'type': 'int', 'value': 10, 'min': 1},
+             {'title': 'Skipped frames', 'name': 'frames_skipped', 'type': 'int', 'value': 0, 'readonly': True},
+             {'title': 'Dropped frames', 'name': 'frames_dropped', 'type': 'int', 'value': 0, 'readonly': True},
+             {'title': 'Reset counters', 'name': 'reset_counters', 'type': 'bool_push', 'value': False}]
+        },
+        {'title': 'Averaging', 'name': 'avg_opts', 'type': 'group', 'children':
+            [{'title': 'Mode', 'name': 'avg_mode', 'type': 'list', 'limits': FrameAverager.modes}]
+        },
+        {'title': 'Processing', 'name': 'processing_opts', 'type': 'group', 'children':
+            [{'title': 'Worker pipeline', 'name': 'use_pipeline', 'type': 'bool', 'value': False},
+             {'title': 'Workers', 'name': 'nworkers', 'type': 'int', 'value': 2, 'min': 1},
+             {'title': 'Queue size', 'name': 'queue_size', 'type': 'int', 'value': 4, 'min': 1},
+             {'title': 'When full', 'name': 'queue_policy', 'type': 'list', 'limits': FramePipeline.policies,
+              'tip': 'Drop: new frames are dropped while the workers are busy (live display)\n'
+                     'Wait: acquisition waits for the workers, no frame is lost (saving)'}]
+        },
+        {'title': 'Display', 'name': 'display_opts', 'type': 'group', 'children':
+            [{'title': 'Throttle display', 'name': 'throttle', 'type': 'bool', 'value': False},
+             {'title': 'Max display rate (Hz)', 'name': 'max_rate', 'type': 'float', 'value': 30., 'min': 1.},
+             {'title': 'Max preview size (px)', 'name': 'max_size', 'type': 'int', 'value': 512, 'min': 16}]
+        },
+        {'title': 'Recording', 'name': 'record_opts', 'type': 'group', 'children':
+            [{'title': 'Record raw frames', 'name': 'recording', 'type': 'bool', 'value': False},
+             {'title': 'Folder', 'name': 'rec_folder', 'type': 'browsepath', 'value': str(Path.home()),
+              'filetype': False},
+             {'title': 'Format', 'name': 'rec_format', 'type': 'list', 'limits': FrameRecorder.formats},
+             {'title': 'Frames to record', 'name': 'rec_nframes', 'type': 'int', 'value': 1000, 'min': 1},
+             {'title': 'Recorded frames', 'name': 'frames_recorded', 'type': 'int', 'value': 0, 'readonly': True},
+             {'title': 'File', 'name': 'rec_file', 'type': 'str', 'value': '', 'readonly': True}]
+        },
+        {'title': 'Beam profile', 'name': 'profile_opts', 'type': 'group', 'children':
+            [{'title': 'Beam profile', 'name': 'beam_profile', 'type': 'bool', 'value': False},
+             {'title': 'Analyse 1 frame every', 'name': 'profile_every', 'type': 'int', 'value': 1, 'min': 1},
+             {'title': 'Max analysis size (px)', 'name': 'profile_size', 'type': 'int', 'value': 256, 'min': 16},
+             {'title': 'Crop (diameters)', 'name': 'profile_crop', 'type': 'float', 'value': 4., 'min': 0.,
+              'tip': 'Size of the analysed region around the previous beam, 0 for the whole image'}]
         }
     ]
 
     callback_signal = QtCore.Signal()
+    settings_signal = QtCore.Signal(list)  # settings to update from the plugin thread, see update_settings
 
     def ini_attributes(self):
         self.controller: Thorlabs.ThorlabsTLCamera = None
@@ -58,6 +159,28 @@ class DAQ_2DViewer_Thorlabs_TSI(DAQ_Viewer_base):
 
         self.data_shape: str = ''
         self.callback_thread = None
+        self.roi_presets = RoiPresets(config)
+        self._applied_rois = {}  # requested ROI -> ROI actually set by the camera
+
+        self.frame_ring = FrameRing(self.settings.child('buffer_opts', 'stack_depth').value())
+        self.frames_skipped = 0
+        self.frames_dropped = 0
+        self._last_skipped = 0  # skipped frames reported by pylablib since the acquisition started
+        self.demosaic = BayerDemosaic()
+        self.averager = FrameAverager()
+        self.pipeline: FramePipeline = None
+        self.throttle = DisplayThrottle(self.settings['display_opts', 'max_rate'],
+                                        self.settings['display_opts', 'max_size'])
+        self.recorder: FrameRecorder = None
+        self._timestamp_clock = None  # frequency of the camera timestamps
+        self.bursts = 0
+        self.profiler = BeamProfiler(self.settings['profile_opts', 'profile_every'],
+                                     self.settings['profile_opts', 'profile_size'],
+                                     self.settings['profile_opts', 'profile_crop'])
+        self._reporting = False  # settings being updated by the plugin itself, see update_settings
+        # frames are read from the callback thread (and processed by the pipeline workers), settings are only
+        # changed from the plugin thread
+        self.settings_signal.connect(self.update_settings)
 
         # Disable "use ROI" option to avoid confusion with other buttons
         #self.settings.child('ROIselect', 'use_ROI').setOpts(visible=False)
@@ -76,19 +199,62 @@ class DAQ_2DViewer_Thorlabs_TSI(DAQ_Viewer_base):
         if param.name() == "fps_on":
             self.settings.child('timing_opts', 'fps').setOpts(visible=param.value())
 
+        if param.name() in ['trigger_mode', 'burst_frames', 'trigger_polarity']:
+            # the camera is armed again with the new parameters at the next grab
+            self.controller.clear_acquisition()
+            self.settings.child('trigger_opts', 'trigger_polarity').setOpts(
+                visible=self.settings['trigger_opts', 'trigger_mode'] == 'External burst')
+
+        if param.name() == "stack_depth":
+            self.frame_ring.set_depth(param.value())
+
+        if param.name() == "reset_counters":
+            if param.value():
+                self.frames_skipped = 0
+                self.frames_dropped = 0
+                self.frame_ring.reset_counters()
+                if self.pipeline is not None:
+                    self.pipeline.dropped = 0
+                self._update_frame_counters()
+                param.setValue(False)
+
+        if param.name() in ['use_pipeline', 'nworkers', 'queue_size', 'queue_policy']:
+            self.setup_pipeline()
+
+        if param.name() in ['throttle', 'max_rate', 'max_size']:
+            self.throttle.max_rate = self.settings['display_opts', 'max_rate']
+            self.throttle.max_size = self.settings['display_opts', 'max_size']
+            self.throttle.reset()
+
+        if param.name() == "beam_profile" and param.value() and not BeamProfiler.available:
+            self.emit_status(ThreadCommand('Update_Status', ['laserbeamsize is needed for the beam profile', 'log']))
+            param.setValue(False)
+
+        if param.name() in ['profile_every', 'profile_size', 'profile_crop']:
+            self.profiler.every = self.settings['profile_opts', 'profile_every']
+            self.profiler.max_size = self.settings['profile_opts', 'profile_size']
+            self.profiler.crop = self.settings['profile_opts', 'profile_crop']
+            self.profiler.reset()
+
+        if param.name() == "recording":
+            if param.value():
+                self.start_recording()
+            else:
+                self.stop_recording()
+
         if param.name() == "update_roi":
             if param.value():   # Switching on ROI
 
                 # We handle ROI and binning separately for clarity
-                (old_x, _, old_y, _, xbin, ybin) = self.controller.get_roi() # Get current binning
+                (hstart, _, vstart, _, hbin, vbin) = self.controller.get_roi()  # Get current ROI and binning
 
-                # Values need to be rescaled by binning factor and shifted by current x0,y0 to be correct.
-                new_x = (old_x + self.settings.child('ROIselect', 'x0').value())*xbin
-                new_y = (old_y + self.settings.child('ROIselect', 'y0').value())*xbin
-                new_width = self.settings.child('ROIselect', 'width').value()*ybin
-                new_height = self.settings.child('ROIselect', 'height').value()*ybin
+                # The rectangle is given in binned pixels of the current image, relative to the current ROI
+                new_x = hstart + self.settings.child('ROIselect', 'x0').value() * hbin
+                new_y = vstart + self.settings.child('ROIselect', 'y0').value() * vbin
+                new_width = self.settings.child('ROIselect', 'width').value() * hbin
+                new_height = self.settings.child('ROIselect', 'height').value() * vbin
 
-                new_roi = (new_x, new_width, xbin, new_y, new_height, ybin)
+                new_roi = (new_x, new_x + new_width, new_y, new_y + new_height, hbin, vbin)
                 self.update_rois(new_roi)
                 # recenter rectangle
                 self.settings.child('ROIselect', 'x0').setValue(0)
@@ -97,27 +263,67 @@ class DAQ_2DViewer_Thorlabs_TSI(DAQ_Viewer_base):
 
         if param.name() in ['x_binning', 'y_binning']:
             # We handle ROI and binning separately for clarity
-            (x0, w, y0, h, *_) = self.controller.get_roi()  # Get current ROI
+            (hstart, hend, vstart, vend, *_) = self.controller.get_roi()  # Get current ROI
             xbin = self.settings.child('x_binning').value()
             ybin = self.settings.child('y_binning').value()
-            new_roi = (x0, w, xbin, y0, h, ybin)
+            new_roi = (hstart, hend, vstart, vend, xbin, ybin)
             self.update_rois(new_roi)
 
         if param.name() == "clear_roi":
             if param.value():   # Switching on ROI
                 wdet, hdet = self.controller.get_detector_size()
-                # self.settings.child('ROIselect', 'x0').setValue(0)
-                # self.settings.child('ROIselect', 'width').setValue(wdet)
                 self.settings.child('x_binning').setValue(1)
-                #
-                # self.settings.child('ROIselect', 'y0').setValue(0)
-                # new_height = self.settings.child('ROIselect', 'height').setValue(hdet)
                 self.settings.child('y_binning').setValue(1)
 
-                new_roi = (0, wdet, 1, 0, hdet, 1)
+                new_roi = (0, wdet, 0, hdet, 1, 1)
                 self.update_rois(new_roi)
                 param.setValue(False)
 
+        if param.name() == "apply_preset":
+            if param.value():
+                name = self.settings['roi_presets', 'preset']
+                if name:
+                    self.update_rois(self.roi_presets.get(name))
+                param.setValue(False)
+
+        if param.name() == "save_preset":
+            if param.value():
+                name = self.settings['roi_presets', 'preset_name'] or f'ROI {len(self.roi_presets.names()) + 1}'
+                self.roi_presets.save(name, self.controller.get_roi())
+                self._update_preset_list(name)
+                param.setValue(False)
+
+        if param.name() == "delete_preset":
+            if param.value():
+                self.roi_presets.delete(self.settings['roi_presets', 'preset'])
+                self._update_preset_list()
+                param.setValue(False)
+
+    def update_settings(self, updates):
+        """Report values found by the plugin (frame counters, detected band, calibration...) in the settings
+
+        The values are set at once, so that commit_settings sees all of them. Emit settings_signal with the updates
+        to call it from another thread.
+
+        Parameters
+        ----------
+        updates: list of tuple
+            (path, value) of each setting, path being the tuple of the names of the setting and its parents
+        """
+        self._reporting = True
+        try:
+            with self.settings.treeChangeBlocker():
+                for path, value in updates:
+                    self.settings.child(*path).setValue(value)
+        finally:
+            self._reporting = False
+
+    def _update_preset_list(self, selected: str = None):
+        names = self.roi_presets.names()
+        self.settings.child('roi_presets', 'preset').setLimits(names)
+        if selected is not None:
+            self.settings.child('roi_presets', 'preset').setValue(selected)
+
     def ini_detector(self, controller=None):
         """Detector communication initialization
 
@@ -136,7 +342,7 @@ class DAQ_2DViewer_Thorlabs_TSI(DAQ_Viewer_base):
         # Initialize camera class
         if not self.settings.child('serial_number').value() == '':
             self.ini_detector_init(old_controller=controller,
-                                   new_controller=Thorlabs.ThorlabsTLCamera(self.settings.child('serial_number').value()))
+                                   new_controller=open_camera(self.settings.child('serial_number').value()))
         else:
             raise Exception('No compatible Thorlabs scientific camera was found.')
 
@@ -167,9 +373,11 @@ class DAQ_2DViewer_Thorlabs_TSI(DAQ_Viewer_base):
         self.settings.child('hdet').setValue(width)
         self.settings.child('vdet').setValue(height)
 
-        # Way to define a wait function with arguments
-        wait_func = lambda: self.controller.wait_for_frame(since='lastread', nframes=1, timeout=20.0)
-        callback = ThorlabsCallback(wait_func)
+        self._timestamp_clock = self.controller.get_timestamp_clock_frequency()
+        self.settings.child('trigger_opts', 'trigger_polarity').setOpts(
+            visible=self.settings['trigger_opts', 'trigger_mode'] == 'External burst')
+
+        callback = ThorlabsCallback(self.wait_for_frames, self.accumulate_frames)
 
         self.callback_thread = QtCore.QThread()  # creation of a Qt5 thread
         callback.moveToThread(self.callback_thread)  # callback object will live within this thread
@@ -181,11 +389,80 @@ class DAQ_2DViewer_Thorlabs_TSI(DAQ_Viewer_base):
         self.callback_thread.start()
 
         self._prepare_view()
+        self.setup_pipeline()
 
         info = "Initialized camera"
         initialized = True
         return info, initialized
 
+    def setup_pipeline(self):
+        """(Re)create the frame processing pipeline depending on the settings"""
+        if self.pipeline is not None:
+            self.pipeline.stop()
+            self.pipeline = None
+        spare = 0
+        if self.settings['processing_opts', 'use_pipeline']:
+            spare = self.settings['processing_opts', 'queue_size']
+            self.pipeline = FramePipeline(self.process_frame, self.dte_signal.emit,
+                                          nworkers=self.settings['processing_opts', 'nworkers'],
+                                          max_pending=spare,
+                                          policy=self.settings['processing_opts', 'queue_policy'],
+                                          error_fn=lambda e: self.emit_status(
+                                              ThreadCommand('Update_Status', [str(e), 'log'])))
+        # reused buffers must not be overwritten while the frames they hold are still queued
+        self.frame_ring.set_depth(spare=spare)
+        self.demosaic.set_nbuffers(4 + spare)
+        self.averager.nbuffers = 2 + spare
+
+    def start_recording(self):
+        """Create a new recording file, frames are recorded as they are read from the camera"""
+        try:
+            self.stop_recording()
+            folder = Path(self.settings['record_opts', 'rec_folder'])
+            folder.mkdir(parents=True, exist_ok=True)
+            name = self.settings['camera_name'].replace(' ', '_') or 'ThorCam'
+            self.recorder = FrameRecorder(folder.joinpath(f'{name}_{datetime.now():%Y%m%d_%H%M%S}'),
+                                          self.controller.get_data_dimensions(),
+                                          self.settings['record_opts', 'rec_nframes'],
+                                          fmt=self.settings['record_opts', 'rec_format'],
+                                          error_fn=lambda e: self.emit_status(
+                                              ThreadCommand('Update_Status', [str(e), 'log'])))
+            self.settings.child('record_opts', 'rec_file').setValue(str(self.recorder.path))
+            self.settings.child('record_opts', 'frames_recorded').setValue(0)
+            self.throttle.reset()
+            self.emit_status(ThreadCommand('Update_Status', [f'Recording frames to {self.recorder.path}']))
+        except Exception as e:
+            self.emit_status(ThreadCommand('Update_Status', [str(e), 'log']))
+            self.settings.child('record_opts', 'recording').setValue(False)
+
+    def stop_recording(self):
+        """Write the frames still queued and close the recording file"""
+        recorder, self.recorder = self.recorder, None
+        if recorder is None:
+            return
+        recorder.stop()
+        self.settings.child('record_opts', 'frames_recorded').setValue(recorder.recorded)
+        self.settings.child('record_opts', 'recording').setValue(False)
+        self.throttle.reset()
+        self.emit_status(ThreadCommand('Update_Status', [f'{recorder.recorded} frames recorded to {recorder.path}']))
+
+    def record_frames(self, frames, infos):
+        """Queue frames read from the camera for recording, stops the recording once the file is full
+
+        May be called from the callback thread, the recording is then stopped from the plugin thread.
+        """
+        recorder = self.recorder
+        if recorder is None:
+            return
+        for frame, info in zip(frames, infos):
+            recorder.record(frame, info.framestamp, self.frame_timestamp(info))
+        if recorder.full:
+            self.settings_signal.emit([(('record_opts', 'recording'), False)])
+
+    def frame_timestamp(self, info):
+        """Acquisition time of a frame in seconds from its pylablib frame info, host time if not supported"""
+        return info.pixelclock / self._timestamp_clock if self._timestamp_clock else perf_counter()
+
     def _prepare_view(self):
         """Preparing a data viewer by emitting temporary data. Typically, needs to be called whenever the
         ROIs are changed"""
@@ -200,7 +477,10 @@ class DAQ_2DViewer_Thorlabs_TSI(DAQ_Viewer_base):
 
         self.settings.child('hdet').setValue(width)
         self.settings.child('vdet').setValue(height)
-        mock_data = np.zeros((height, width))
+        if 'bayer' in self.settings['sensor'].lower():
+            self.demosaic.allocate((height, width))
+        self.throttle.reset()
+        self.profiler.reset()
 
         if width != 1 and height != 1:
             data_shape = 'Data2D'
@@ -209,25 +489,44 @@ class DAQ_2DViewer_Thorlabs_TSI(DAQ_Viewer_base):
 
         if data_shape != self.data_shape:
             self.data_shape = data_shape
-            # init the viewers
-            self.data_grabed_signal_temp.emit([DataFromPlugins(name='Thorlabs Camera',
-                                                               data=[np.squeeze(mock_data)],
-                                                               dim=self.data_shape,
-                                                               labels=[f'ThorCam_{self.data_shape}'])])
+            self.data_grabed_signal_temp.emit(self.placeholder_data())
             QtWidgets.QApplication.processEvents()
 
+    def placeholder_data(self):
+        """Build the temporary data initializing the viewers, a small placeholder is enough as only its
+        dimensionality matters
+
+        Returns
+        -------
+        list of DataFromPlugins
+        """
+        mock_data = np.zeros((2, 2) if self.data_shape == 'Data2D' else (2,), dtype=np.uint16)
+        return [DataFromPlugins(name='Thorlabs Camera', data=[mock_data], dim=self.data_shape,
+                                labels=[f'ThorCam_{self.data_shape}'])]
+
     def update_rois(self, new_roi):
-        # In pylablib, ROIs compare as tuples
-        (new_x, new_width, new_xbinning, new_y, new_height, new_ybinning) = new_roi
-        if new_roi != self.controller.get_roi():
-            # self.controller.set_attribute_value("ROIs",[new_roi])
-            self.controller.set_roi(hstart=new_x, hend=new_x + new_width, vstart=new_y, vend=new_y + new_height,
-                                    hbin=new_xbinning, vbin=new_ybinning)
-            self.emit_status(ThreadCommand('Update_Status', [f'Changed ROI: {new_roi}']))
-            self.controller.clear_acquisition()
-            self.controller.setup_acquisition()
-            # Finally, prepare view for displaying the new data
-            self._prepare_view()
+        """Set the ROI and binning of the camera, does nothing if they are already set
+
+        Parameters
+        ----------
+        new_roi: tuple of int
+            (hstart, hend, vstart, vend, hbin, vbin) in unbinned sensor pixels, as in pylablib
+        """
+        new_roi = tuple(int(value) for value in new_roi)
+        current_roi = tuple(self.controller.get_roi())
+        # the camera may adjust the requested ROI, compare with what it gave for the same request
+        if current_roi in (new_roi, self._applied_rois.get(new_roi)):
+            return
+        self.stop_recording()  # frames of a recording all have the same shape
+        # acquisition is cleared by pylablib while setting the ROI, and set up (and restarted) again afterwards
+        roi = tuple(self.controller.set_roi(*new_roi))
+        self._applied_rois[new_roi] = roi
+        (*_, hbin, vbin) = roi
+        self.settings.child('x_binning').setValue(hbin)
+        self.settings.child('y_binning').setValue(vbin)
+        self.emit_status(ThreadCommand('Update_Status', [f'Changed ROI: {roi}']))
+        # Finally, prepare view for displaying the new data
+        self._prepare_view()
 
     def grab_data(self, Naverage=1, **kwargs):
         """
@@ -237,16 +536,51 @@ class DAQ_2DViewer_Thorlabs_TSI(DAQ_Viewer_base):
         kwargs: (dict) of others optionals arguments
         """
         try:
+            avg_mode = self.settings['avg_opts', 'avg_mode']
+            if self.burst_mode:
+                Naverage = 1  # a burst is emitted as a whole
+            if avg_mode == 'Block' or Naverage != self.averager.navg or avg_mode != self.averager.mode:
+                self.averager.reset(Naverage, avg_mode)
+
             # Warning, acquisition_in_progress returns 1,0 and not a real bool
             if not self.controller.acquisition_in_progress():
-                self.controller.clear_acquisition()
-                self.controller.start_acquisition()
+                self.start_acquisition()
+            if self.settings['trigger_opts', 'trigger_mode'] == 'Software burst':
+                self.controller.send_software_trigger()
             #Then start the acquisition
             self.callback_signal.emit()  # will trigger the wait for acquisition
 
         except Exception as e:
             self.emit_status(ThreadCommand('Update_Status', [str(e), "log"]))
 
+    @property
+    def burst_mode(self):
+        return self.settings['trigger_opts', 'trigger_mode'] != 'Continuous'
+
+    def start_acquisition(self):
+        """Start the camera, or arm it for bursts of frames in the burst modes"""
+        self.controller.clear_acquisition()
+        trigger_mode = self.settings['trigger_opts', 'trigger_mode']
+        if trigger_mode == 'Continuous':
+            self.controller.set_trigger_mode('int')
+            self.controller.start_acquisition()
+        else:
+            if trigger_mode == 'External burst':
+                self.controller.set_trigger_mode('ext')
+                self.controller.setup_ext_trigger(self.settings['trigger_opts', 'trigger_polarity'])
+            else:
+                self.controller.set_trigger_mode('int')
+            nburst = self.settings['trigger_opts', 'burst_frames']
+            # the camera buffer can hold a few bursts
+            self.controller.start_acquisition(frames_per_trigger=nburst, auto_start=False, nframes=max(100, 4 * nburst))
+        self._last_skipped = 0
+
+    def wait_for_frames(self):
+        """Wait for the next frame, or for the next whole burst in the burst modes. Called from the callback thread"""
+        nframes = self.settings['trigger_opts', 'burst_frames'] if self.burst_mode else 1
+        return self.controller.wait_for_frame(since='lastread', nframes=nframes,
+                                              timeout=self.settings['trigger_opts', 'trigger_timeout'])
+
     def emit_data(self):
         """ Function used to emit data obtained by callback.
 
@@ -260,32 +594,30 @@ class DAQ_2DViewer_Thorlabs_TSI(DAQ_Viewer_base):
         daq_utils.ThreadCommand
         """
         try:
-            # Get  data from buffer
-            frame = self.controller.read_newest_image()
-            # Emit the frame.
-            if frame is not None:       # happens for last frame when stopping camera
-                if self.settings['output_color'] == 'RGB':
-                    rgb_image = cv2.cvtColor(frame, cv2.COLOR_BAYER_BG2RGB)
-                    self.data_grabed_signal.emit([DataFromPlugins(name='Thorlabs Camera',
-                                                                  data=[np.squeeze(rgb_image[..., ind]) for ind in
-                                                                        range(3)],
-                                                                  dim=self.data_shape,
-                                                                  labels=[f'ThorCam_{self.data_shape}'])])
-                else:
-                    if 'monochrome' in self.settings['sensor'].lower():
-                        self.data_grabed_signal.emit([DataFromPlugins(name='Thorlabs Camera',
-                                                                      data=[np.squeeze(frame)],
-                                                                      dim=self.data_shape,
-                                                                      labels=[f'ThorCam_{self.data_shape}'])])
-                    else:
-                        grey_image = cv2.cvtColor(frame, cv2.COLOR_BAYER_BG2GRAY)
-                        self.data_grabed_signal.emit([DataFromPlugins(name='Thorlabs Camera',
-                                                                      data=[np.squeeze(grey_image)],
-                                                                      dim=self.data_shape,
-                                                                      labels=[f'ThorCam_{self.data_shape}'])])
-
-            if self.settings.child('timing_opts', 'fps_on').value():
-                self.update_fps()
+            if self.burst_mode:
+                self.emit_burst()
+                return
+            # Get  data from buffer, or from the averager which has already read it
+            infos = None
+            if self.averager.active:
+                frames = [self.averaged_frame()] if self.averager.done else []
+            else:
+                frames, infos = self.read_frames(return_info=True)
+            nframes = len(frames)
+            # Emit the frames.
+            if nframes == 0:
+                pass
+            elif self.recorder is not None:
+                # frames are saved by the recorder, the viewer only gets rate limited previews
+                if self.throttle.due():
+                    self.emit_frame(frames[-1])
+            elif infos is not None and self.settings['buffer_opts', 'read_mode'] == 'Batched':
+                self.emit_batch(frames, infos)
+            else:
+                self.emit_frame(frames[-1])
+
+            if self.settings.child('timing_opts', 'fps_on').value() and nframes > 0:
+                self.update_fps(nframes)
 
             # To make sure that timed events are executed in continuous grab mode
             QtWidgets.QApplication.processEvents()
@@ -293,9 +625,266 @@ class DAQ_2DViewer_Thorlabs_TSI(DAQ_Viewer_base):
         except Exception as e:
             self.emit_status(ThreadCommand('Update_Status', [str(e), 'log']))
 
-    def update_fps(self):
+    def emit_burst(self):
+        """Read the oldest burst of the camera buffer and emit it as a whole"""
+        frames, infos = self.read_burst()
+        if len(frames) == 0:
+            return
+        self.bursts += 1
+        self.settings.child('trigger_opts', 'bursts').setValue(self.bursts)
+        self.dte_signal.emit(self.process_stack(frames, infos, 'burst'))
+        if self.settings.child('timing_opts', 'fps_on').value():
+            self.update_fps(len(frames))
+        QtWidgets.QApplication.processEvents()
+
+    def read_burst(self):
+        """Read the frames of the oldest burst not read yet, the next bursts are left in the camera buffer
+
+        Returns
+        -------
+        list of ndarray: the frames of the burst
+        list of TFrameInfo: the pylablib info of each frame
+        """
+        self._count_skipped()
+        nburst = self.settings['trigger_opts', 'burst_frames']
+        rng = self.controller.get_new_images_range()
+        if rng is None:
+            return [], []
+        frames, infos = self.controller.read_multiple_images(rng=(rng[0], min(rng[1], rng[0] + nburst)),
+                                                             missing_frame='skip', return_info=True)
+        if frames is None or len(frames) == 0:
+            return [], []
+        self.record_frames(frames, infos)
+        self._update_frame_counters()
+        return frames, infos
+
+    def _count_skipped(self):
+        """Update the skipped frames counter from the camera frames status
+
+        Returns
+        -------
+        TFramesStatus: the pylablib frames status
+        """
+        status = self.controller.get_frames_status()
+        if status.skipped < self._last_skipped:  # acquisition has been restarted in between
+            self._last_skipped = 0
+        self.frames_skipped += status.skipped - self._last_skipped
+        self._last_skipped = status.skipped
+        return status
+
+    def read_frames(self, return_info=False):
+        """Read the pending frames from the camera buffer depending on the read mode
+
+        While recording, all the pending frames are read and recorded whatever the read mode. pylablib returns new
+        arrays, they are copied into a stack of the frame ring in "Batched" read mode so that they can be emitted
+        together.
+
+        Parameters
+        ----------
+        return_info: bool
+            if True, the pylablib info of the frames is returned as well
+
+        Returns
+        -------
+        list of ndarray or ndarray: the frames to be emitted, oldest first, as a stack in "Batched" read mode. Empty
+            when stopping the camera
+        list of TFrameInfo: the info of each frame, only if return_info is True
+        """
+        status = self._count_skipped()
+
+        batched = self.settings['buffer_opts', 'read_mode'] == 'Batched'
+        if batched or self.recorder is not None:
+            frames, infos = self.controller.read_multiple_images(missing_frame='skip', return_info=True)
+            if frames is None or len(frames) == 0:
+                frames, infos = [], []
+            self.record_frames(frames, infos)
+            if batched:
+                nframes = len(frames)
+                frames = self.frame_ring.fill(frames) if nframes > 0 else []
+                infos = infos[nframes - len(frames):]  # the frames beyond the stack depth are dropped
+            else:
+                frames, infos = frames[-1:], infos[-1:]
+        else:
+            # only the newest frame is read, the older unread ones are lost
+            self.frames_dropped += max(status.unread - 1, 0)
+            newest = self.controller.read_newest_image(return_info=True)
+            # None happens for last frame when stopping camera
+            frames, infos = ([newest[0]], [newest[1]]) if newest is not None else ([], [])
+        self._update_frame_counters()
+        return (frames, infos) if return_info else frames
+
+    def accumulate_frames(self):
+        """Add the pending frames to the averager. Called from the callback thread after each wait for a frame
+
+        Returns
+        -------
+        bool: True if data is ready to be emitted
+        """
+        if not self.averager.active:
+            return True
+        for frame in self.read_frames():
+            self.averager.add(frame)
+        return self.averager.done
+
+    def averaged_frame(self):
+        """Return the averaged frame, rounded back to integers for Bayer sensors so that it can be demosaiced"""
+        if 'monochrome' in self.settings['sensor'].lower():
+            return self.averager.mean()
+        return self.averager.mean(np.uint16)
+
+    def _update_frame_counters(self):
+        """Report the frame counters in the settings, may be called from the callback thread"""
+        dropped = self.frames_dropped + self.frame_ring.dropped
+        if self.pipeline is not None:
+            dropped += self.pipeline.dropped
+        updates = [(('buffer_opts', 'frames_skipped'), self.frames_skipped),
+                   (('buffer_opts', 'frames_dropped'), dropped)]
+        recorder = self.recorder
+        if recorder is not None:
+            updates.append((('record_opts', 'frames_recorded'), recorder.recorded))
+        self.settings_signal.emit(updates)
+
+    def convert_frame(self, frame: np.ndarray):
+        """Convert a raw camera frame depending on the sensor type and output color
+
+        Returns
+        -------
+        list of ndarray: the channels of the frame, views of the demosaic output buffers for Bayer sensors
+        """
+        if self.settings['output_color'] == 'RGB':
+            return [np.squeeze(channel) for channel in self.demosaic.rgb(frame)]
+        elif 'monochrome' in self.settings['sensor'].lower():
+            return [np.squeeze(frame)]
+        else:
+            return [np.squeeze(self.demosaic.grey(frame))]
+
+    def image_data(self, channels):
+        """Build the data of a camera image
+
+        With the display throttle enabled, the full resolution image is only saved and a downsampled preview, with
+        axes scaled back to camera pixels, is plotted instead. While recording, only the preview is emitted. In beam
+        profile mode, the beam profile of the image is added.
+
+        The channels may be views of reused buffers (demosaic or averaging outputs), which could be overwritten
+        before the data queued for the viewer or saving is read: the full resolution image is emitted as a copy.
+
+        Parameters
+        ----------
+        channels: list of ndarray
+            the image channels as returned by convert_frame
+
+        Returns
+        -------
+        list of DataFromPlugins
+        """
+        recording = self.recorder is not None
+        profile = [self.profile_data(channels)] \
+            if self.settings['profile_opts', 'beam_profile'] and self.data_shape == 'Data2D' else []
+        if not (self.settings['display_opts', 'throttle'] or recording) or self.data_shape != 'Data2D':
+            return [DataFromPlugins(name='Thorlabs Camera', data=[channel.copy() for channel in channels],
+                                    dim=self.data_shape, labels=[f'ThorCam_{self.data_shape}'])] + profile
+
+        preview = self.preview_data(channels)
+        if recording:
+            return [preview] + profile
+        return [DataFromPlugins(name='Thorlabs Camera', data=[channel.copy() for channel in channels], dim='Data2D',
+                                labels=[f'ThorCam_{self.data_shape}'], do_plot=False), preview] + profile
+
+    def profile_data(self, channels):
+        """Build the beam profile data of an image, see BeamProfiler"""
+        return DataFromPlugins(name='Beam profile', dim='Data0D', labels=BeamProfiler.labels,
+                               data=[np.array([value]) for value in self.profiler.analyse(channels)])
+
+    def preview_data(self, channels):
+        """Build the data of the downsampled preview of an image, with axes scaled back to camera pixels"""
+        previews, factor = self.throttle.preview(channels)
+        height, width = previews[0].shape
+        return DataFromPlugins(name='Thorlabs Camera preview', data=previews, dim='Data2D',
+                               labels=[f'ThorCam_{self.data_shape}'], do_save=False,
+                               axes=[Axis('y', 'pxl', index=0, scaling=factor, offset=0, size=height),
+                                     Axis('x', 'pxl', index=1, scaling=factor, offset=0, size=width)])
+
+    def process_stack(self, frames, infos, kind: str):
+        """Convert a burst or a batch of raw camera frames into the data to be emitted
+
+        The converted frames are stacked along a frame navigation axis and emitted along with the camera frame index,
+        the timestamp and the time since the first frame of each frame. With the display throttle enabled or while
+        recording, the stack is not plotted and a preview of the last frame is emitted instead.
+
+        Parameters
+        ----------
+        frames: list of ndarray or ndarray
+            the raw frames, oldest first
+        infos: list of TFrameInfo
+            the pylablib info of each frame
+        kind: str
+            either 'burst' or 'batch', used in the data names
+
+        Returns
+        -------
+        DataToExport
+        """
+        nframes = len(frames)
+        stacks = None
+        for ind, frame in enumerate(frames):
+            channels = self.convert_frame(frame)
+            if stacks is None:
+                stacks = [np.empty((nframes,) + channel.shape, dtype=channel.dtype) for channel in channels]
+            for stack, channel in zip(stacks, channels):
+                stack[ind] = channel
+
+        recording = self.recorder is not None
+        throttled = self.settings['display_opts', 'throttle'] or recording
+        frame_axis = Axis('frame', '', data=np.arange(nframes, dtype=float), index=0)
+        timestamps = np.array([self.frame_timestamp(info) for info in infos])
+        data = [DataFromPlugins(name=f'Thorlabs Camera {kind}', data=stacks, dim='DataND', nav_indexes=(0,),
+                                labels=[f'ThorCam_{self.data_shape}'], axes=[frame_axis],
+                                do_plot=not throttled, do_save=not recording),
+                DataFromPlugins(name=f'{kind.capitalize()} frames', dim='Data1D', axes=[frame_axis.copy()],
+                                data=[np.array([info.framestamp for info in infos], dtype=float),
+                                      timestamps, timestamps - timestamps[0]],
+                                labels=['Frame index', 'Timestamp (s)', 'Time since first frame (s)'])]
+        if throttled:
+            data.append(self.preview_data([stack[-1] for stack in stacks]))
+        return DataToExport('Thorlabs Camera', data=data)
+
+    def process_frame(self, frame: np.ndarray):
+        """Convert a raw camera frame into the data to be emitted. May be called from the pipeline worker threads
+
+        Returns
+        -------
+        DataToExport
+        """
+        return DataToExport('Thorlabs Camera', data=self.image_data(self.convert_frame(frame)))
+
+    def process_batch(self, frames, infos):
+        """Convert the frames read at once in "Batched" read mode into the data to be emitted, see process_stack.
+        May be called from the pipeline worker threads
+
+        Returns
+        -------
+        DataToExport
+        """
+        return self.process_stack(frames, infos, 'batch')
+
+    def emit_frame(self, frame: np.ndarray):
+        """Process and emit a raw camera frame, through the worker pipeline if enabled"""
+        if self.pipeline is not None:
+            self.pipeline.submit(frame)
+        else:
+            self.dte_signal.emit(self.process_frame(frame))
+
+    def emit_batch(self, frames, infos):
+        """Process and emit the frames read at once in "Batched" read mode as a single data, through the worker
+        pipeline if enabled"""
+        if self.pipeline is not None:
+            self.pipeline.submit(frames, infos, process_fn=self.process_batch)
+        else:
+            self.dte_signal.emit(self.process_batch(frames, infos))
+
+    def update_fps(self, nframes: int = 1):
         current_tick = perf_counter()
-        frame_time = current_tick-self.last_tick
+        frame_time = (current_tick-self.last_tick) / nframes
 
         if self.last_tick != 0.0 and frame_time != 0.0:
             # We don't update FPS for the first frame, and we also avoid divisions by zero
@@ -316,6 +905,10 @@ class DAQ_2DViewer_Thorlabs_TSI(DAQ_Viewer_base):
         Terminate the communication protocol
         """
         # Terminate the communication
+        self.stop_recording()
+        if self.pipeline is not None:
+            self.pipeline.stop()
+            self.pipeline = None
         self.controller.close()
         self.controller = None  # Garbage collect the controller
         self.status.initialized = False
@@ -323,26 +916,40 @@ class DAQ_2DViewer_Thorlabs_TSI(DAQ_Viewer_base):
         self.status.info = ""
 
     def stop(self):
-        """Stop the acquisition."""
+        """Stop the acquisition, the camera is armed again at the next grab in burst modes"""
         self.controller.clear_acquisition()
         return ''
 
 
 class ThorlabsCallback(QtCore.QObject):
-    """Callback object """
+    """Callback object
+
+    Parameters
+    ----------
+    wait_fn: callable
+        blocking function waiting for a new frame
+    accumulate_fn: callable
+        optional function called after each new frame, returning True when data is ready to be emitted. Used to
+        accumulate several frames within this thread before emitting them
+    """
     data_sig = QtCore.Signal()
 
-    def __init__(self, wait_fn):
+    def __init__(self, wait_fn, accumulate_fn=None):
         super().__init__()
         # Set the wait function
         self.wait_fn = wait_fn
+        self.accumulate_fn = accumulate_fn
 
     def wait_for_acquisition(self):
         try:
-            new_data = self.wait_fn()
-            if new_data is not False:  # will be returned if the main thread called CancelWait
-                self.data_sig.emit()
-        except Thorlabs.ThorlabsTimeoutError:
+            while True:
+                new_data = self.wait_fn()
+                if new_data is False:  # will be returned if the main thread called CancelWait
+                    break
+                if self.accumulate_fn is None or self.accumulate_fn():
+                    self.data_sig.emit()
+                    break
+        except (Thorlabs.ThorlabsTimeoutError, Thorlabs.ThorlabsTLCameraTimeoutError):
             pass
 
 
@@ -1,74 +1,114 @@
-from qtpy.QtCore import QThread, Slot, QRectF
-from qtpy import QtWidgets
 import numpy as np
-from pymodaq.control_modules.viewer_utility_classes import DAQ_Viewer_base, main, comon_parameters
+from pylablib.devices import Thorlabs
 
+from pymodaq.control_modules.viewer_utility_classes import main
 from pymodaq.utils.daq_utils import ThreadCommand
-from pymodaq.utils.data import DataFromPlugins, Axis, DataToExport
+from pymodaq.utils.data import DataFromPlugins, DataToExport
 from pymodaq.utils.parameter import Parameter
-from pymodaq.utils.parameter.utils import iter_children
 
-import laserbeamsize as lbs
-import numba
-from pymodaq_plugins_thorlabs.daq_viewer_plugins.plugins_2D.daq_2Dviewer_Thorlabs_TSI import DAQ_2DViewer_Thorlabs_TSI, main
+from pymodaq_plugins_thorlabs.daq_viewer_plugins.plugins_2D.daq_2Dviewer_Thorlabs_TSI import DAQ_2DViewer_Thorlabs_TSI
+from pymodaq_plugins_thorlabs.hardware.autocorrelation import (PulseEstimator, TraceProjector, TraceAverager,
+                                                                DelayCalibration, PULSE_SHAPES)
+from pymodaq_plugins_thorlabs.hardware.tlcamera import LatestWorker, config
 
+C_MM_FS = 2.99792458e-4  # speed of light in mm/fs
 
-from scipy.optimize import curve_fit
 
-from pylablib.devices import Thorlabs
-from qtpy import QtWidgets, QtCore
 class DAQ_2DViewer_Thorlabs_TSI_autocorrelator(DAQ_2DViewer_Thorlabs_TSI):
-
-    serialnumbers = Thorlabs.list_cameras_tlcam()
-    params = comon_parameters + [
-        {'title': 'Camera name:', 'name': 'camera_name', 'type': 'str', 'value': '', 'readonly': True},
-        {'title': 'Serial number:', 'name': 'serial_number', 'type': 'list', 'limits': serialnumbers},
-        #{'title': 'Sensor type:', 'name': 'sensor', 'type': 'str', 'value': '', 'readonly': True},
-        #this will be used once pylablib accepts PR52
-        {'title': 'Sensor type:', 'name': 'sensor', 'type': 'list', 'limits': ['Monochrome', 'Bayer']},
-        {'title': 'Ouput Color:', 'name': 'output_color', 'type': 'list', 'limits': ['RGB', 'MonoChrome']},
-        {'title': 'Update ROI', 'name': 'update_roi', 'type': 'bool_push', 'value': False},
-        {'title': 'Clear ROI+Bin', 'name': 'clear_roi', 'type': 'bool_push', 'value': False},
-        {'title': 'X binning', 'name': 'x_binning', 'type': 'int', 'value': 1},
-        {'title': 'Y binning', 'name': 'y_binning', 'type': 'int', 'value': 1},
-        {'title': 'Image width', 'name': 'hdet', 'type': 'int', 'value': 1, 'readonly': True},
-        {'title': 'Image height', 'name': 'vdet', 'type': 'int', 'value': 1, 'readonly': True},
-        {'title': 'Timing', 'name': 'timing_opts', 'type': 'group', 'children':
-            [{'title': 'Exposure Time (ms)', 'name': 'exposure_time', 'type': 'int', 'value': 1},
-            {'title': 'Compute FPS', 'name': 'fps_on', 'type': 'bool', 'value': True},
-            {'title': 'FPS', 'name': 'fps', 'type': 'float', 'value': 0.0, 'readonly': True}]
-        },
+    """Single shot autocorrelator built on a Thorlabs scientific camera
+
+    The camera image is averaged along one axis into an autocorrelation trace, modelled by the autocorrelation
+    profile of the selected pulse shape. Its parameters are estimated by the selected engine (see
+    hardware/autocorrelation.py, where user-defined pulse shapes can be registered). The pulse duration (FWHM) is
+    deduced from the trace width with the deconvolution factor of the shape, and the time taken by the estimation is
+    emitted along with it. Traces without a peak give a NaN duration instead of an error.
+
+    Only the band of the image holding the trace needs to be averaged: it can be set manually (in pixels of the
+    image, independently of the camera ROI) or found automatically from the first frames.
+
+    A dark trace can be captured (beam blocked) and subtracted from the traces, which can also be averaged over the
+    last frames, either exponentially or with a moving average. The fit is done on the corrected, averaged trace.
+
+    In "Batched" read mode, the traces of all the frames read at once are averaged (see above) but only the newest
+    frame is emitted, along with its trace and fit.
+
+    In "Background" fit mode, the image and trace are emitted as soon as they are available while the fit runs in
+    its own thread at most at the maximum fit rate, always on the latest trace (older ones are dropped), so a slow fit
+    does not lower the frame rate. Each completed fit is emitted on its own, with the fitted trace, the pulse duration
+    and the fit time. Fits of traces taken before a change of the pulse shape, estimator or band are discarded.
+    Single grabs (as in scans) are always fitted with their own trace.
+
+    The pixel to femtosecond conversion can be calibrated from the peak positions of the traces at a series of known
+    delays: either set by hand (set each delay displayed as the next one, then push "Record delay"), or by a LTS150
+    stage in a double pass delay line, driven by the plugin. The plugin opens the stage itself, with the serial number
+    and scaling of the [LTS150] section of the plugin configuration file: a stage already used by a LTS150 actuator
+    (in the dashboard for instance) is to be moved from there with the manual control. The conversion factor and its
+    uncertainty are given by a linear fit and saved in the plugin configuration file, so that later sessions start
+    calibrated.
+    """
+
+    params = DAQ_2DViewer_Thorlabs_TSI.params + [
         {'title': 'Autocorrelation parameters', 'name': 'ac_param', 'type': 'group', 'children':
-            [{'title': 'Gaussian', 'name': 'GS', 'type': 'bool', 'value': True},
-             {'title': 'Sech²', 'name': 'Sec2', 'type': 'bool', 'value': False},
+            [{'title': 'Pulse shape', 'name': 'shape', 'type': 'list', 'limits': list(PULSE_SHAPES)},
              {'title': 'Vertical average', 'name': 'av_axis_v', 'type': 'bool', 'value': True},
              {'title': 'Horizontal average', 'name': 'av_axis_h', 'type': 'bool', 'value': False},
-             {'title': 'Pixel to femtosecond conversion', 'name': 'PxFs', 'type': 'float', 'value': 0.764, 'readonly': False}]
+             {'title': 'Signal band', 'name': 'band_mode', 'type': 'list', 'limits': TraceProjector.modes,
+              'tip': 'Part of the image averaged into the trace (rows for a vertical average)'},
+             {'title': 'Band start (px)', 'name': 'band_start', 'type': 'int', 'value': 0, 'min': 0},
+             {'title': 'Band stop (px)', 'name': 'band_stop', 'type': 'int', 'value': 100, 'min': 1},
+             {'title': 'Frames to find the band', 'name': 'auto_frames', 'type': 'int', 'value': 5, 'min': 1},
+             {'title': 'Find band again', 'name': 'detect_band', 'type': 'bool_push', 'value': False},
+             {'title': 'Pixel to femtosecond conversion', 'name': 'PxFs', 'type': 'float',
+              'value': config('TLCamera', 'autocorrelator', 'PxFs'), 'readonly': False},
+             {'title': 'Conversion uncertainty', 'name': 'PxFs_error', 'type': 'float',
+              'value': config('TLCamera', 'autocorrelator', 'PxFs_error'), 'readonly': True},
+             {'title': 'Calibration', 'name': 'calibration', 'type': 'group', 'expanded': False, 'children':
+                 [{'title': 'Delays (fs)', 'name': 'cal_delays', 'type': 'str', 'value': '-300, -150, 0, 150, 300',
+                   'tip': 'Comma separated delays at which the peak position is recorded'},
+                  {'title': 'Traces per delay', 'name': 'cal_frames', 'type': 'int', 'value': 10, 'min': 1},
+                  {'title': 'Delay control', 'name': 'cal_control', 'type': 'list', 'limits': ['Manual', 'LTS150']},
+                  {'title': 'Stage serial number', 'name': 'cal_serial', 'type': 'str',
+                   'value': config('LTS150', 'serial_number')},
+                  {'title': 'Zero delay position (mm)', 'name': 'cal_zero', 'type': 'float', 'value': 0.},
+                  {'title': 'Start calibration', 'name': 'start_cal', 'type': 'bool_push', 'value': False},
+                  {'title': 'Record delay', 'name': 'record_delay', 'type': 'bool_push', 'value': False,
+                   'tip': 'Manual control: push once the delay is set to the next delay'},
+                  {'title': 'Next delay (fs)', 'name': 'cal_next', 'type': 'float', 'value': 0., 'readonly': True},
+                  {'title': 'Stop calibration', 'name': 'stop_cal', 'type': 'bool_push', 'value': False}]
+              },
+             {'title': 'Trace averaging', 'name': 'trace_avg_mode', 'type': 'list', 'limits': TraceAverager.modes},
+             {'title': 'Averaged traces', 'name': 'trace_navg', 'type': 'int', 'value': 10, 'min': 1},
+             {'title': 'Dark frames', 'name': 'dark_frames', 'type': 'int', 'value': 10, 'min': 1},
+             {'title': 'Capture dark', 'name': 'capture_dark', 'type': 'bool_push', 'value': False,
+              'tip': 'Block the beam, the next frames are averaged into the dark trace'},
+             {'title': 'Subtract dark', 'name': 'subtract_dark', 'type': 'bool', 'value': True},
+             {'title': 'Fit mode', 'name': 'fit_mode', 'type': 'list', 'limits': ['Background', 'Every frame'],
+              'tip': 'Background: frames are emitted right away, fits run in their own thread on the latest trace\n'
+                     'and are emitted when done\nEvery frame: each frame is emitted once its trace is fitted'},
+             {'title': 'Max fit rate (Hz)', 'name': 'fit_rate', 'type': 'float', 'value': 10., 'min': 0.},
+             {'title': 'Estimator', 'name': 'estimator', 'type': 'list', 'limits': PulseEstimator.engines,
+              'tip': 'Moments: centroid and second moment of the trace\n'
+                     'Log-parabola: parabola fitted to the log of the trace around its peak\n'
+                     'Warm fit: gaussian fit seeded with the previous trace parameters'}]
          }
     ]
 
-    callback_signal = QtCore.Signal()
-    def gaus(self, x, a, x0, dx):
-        return a * np.exp(-(x - x0) ** 2 / (dx ** 2))
-    #def grab_data(self, Naverage=1, **kwargs):
-
     def ini_attributes(self):
-        self.controller: Thorlabs.ThorlabsTLCamera = None
-
-        self.x_axis = None
-        self.y_axis = None
-        self.last_tick = 0.0  # time counter used to compute FPS
-        self.fps = 0.0
-
-        self.data_shape: str = ''
-        self.callback_thread = None
-
-        self.factor = 1/1.41
-        self.avaxis = 0
-
-        # Disable "use ROI" option to avoid confusion with other buttons
-        #self.settings.child('ROIselect', 'use_ROI').setOpts(visible=False)
-
+        super().ini_attributes()
+
+        self.avaxis = 0 if self.settings['ac_param', 'av_axis_v'] else 1
+        self.estimator = PulseEstimator(self.settings['ac_param', 'estimator'], self.settings['ac_param', 'shape'])
+        self.projector = TraceProjector(self.avaxis, self.settings['ac_param', 'band_mode'],
+                                        (self.settings['ac_param', 'band_start'],
+                                         self.settings['ac_param', 'band_stop']),
+                                        auto_frames=self.settings['ac_param', 'auto_frames'])
+        self.trace_averager = TraceAverager(self.settings['ac_param', 'trace_avg_mode'],
+                                            self.settings['ac_param', 'trace_navg'])
+        self.trace_averager.subtract_dark = self.settings['ac_param', 'subtract_dark']
+        self.fit_worker: LatestWorker = None
+        self._live = False
+        self.calibration: DelayCalibration = None
+        self._stage = None
 
     def commit_settings(self, param: Parameter):
         """Apply the consequences of a change of value in the detector settings
@@ -78,59 +118,43 @@ class DAQ_2DViewer_Thorlabs_TSI_autocorrelator(DAQ_2DViewer_Thorlabs_TSI):
         param: Parameter
             A given parameter (within detector_settings) whose value has been changed by the user
         """
-        if param.name() == "exposure_time":
-            self.controller.set_exposure(param.value()/1000)
+        super().commit_settings(param)
 
-        if param.name() == "fps_on":
-            self.settings.child('timing_opts', 'fps').setOpts(visible=param.value())
+        if param.name() == 'shape':
+            self.estimator.set_shape(param.value())
+            self.clear_fit()
 
-        if param.name() == "update_roi":
-            if param.value():   # Switching on ROI
+        if param.name() in ['trace_avg_mode', 'trace_navg']:
+            self.trace_averager.reset(self.settings['ac_param', 'trace_avg_mode'],
+                                      self.settings['ac_param', 'trace_navg'])
 
-                # We handle ROI and binning separately for clarity
-                (old_x, _, old_y, _, xbin, ybin) = self.controller.get_roi() # Get current binning
+        if param.name() == 'capture_dark':
+            if param.value():
+                self.trace_averager.capture_dark(self.settings['ac_param', 'dark_frames'])
+                param.setValue(False)
 
-                # Values need to be rescaled by binning factor and shifted by current x0,y0 to be correct.
-                new_x = (old_x + self.settings.child('ROIselect', 'x0').value())*xbin
-                new_y = (old_y + self.settings.child('ROIselect', 'y0').value())*xbin
-                new_width = self.settings.child('ROIselect', 'width').value()*ybin
-                new_height = self.settings.child('ROIselect', 'height').value()*ybin
+        if param.name() == 'subtract_dark':
+            self.trace_averager.subtract_dark = param.value()
 
-                new_roi = (new_x, new_width, xbin, new_y, new_height, ybin)
-                self.update_rois(new_roi)
-                # recenter rectangle
-                self.settings.child('ROIselect', 'x0').setValue(0)
-                self.settings.child('ROIselect', 'y0').setValue(0)
+        if param.name() == 'start_cal':
+            if param.value():
+                self.start_calibration()
                 param.setValue(False)
 
-        if param.name() in ['x_binning', 'y_binning']:
-            # We handle ROI and binning separately for clarity
-            (x0, w, y0, h, *_) = self.controller.get_roi()  # Get current ROI
-            xbin = self.settings.child('x_binning').value()
-            ybin = self.settings.child('y_binning').value()
-            new_roi = (x0, w, xbin, y0, h, ybin)
-            self.update_rois(new_roi)
-
-        if param.name() == "clear_roi":
-            if param.value():   # Switching on ROI
-                wdet, hdet = self.controller.get_detector_size()
-                # self.settings.child('ROIselect', 'x0').setValue(0)
-                # self.settings.child('ROIselect', 'width').setValue(wdet)
-                self.settings.child('x_binning').setValue(1)
-                #
-                # self.settings.child('ROIselect', 'y0').setValue(0)
-                # new_height = self.settings.child('ROIselect', 'height').setValue(hdet)
-                self.settings.child('y_binning').setValue(1)
-
-                new_roi = (0, wdet, 1, 0, hdet, 1)
-                self.update_rois(new_roi)
+        if param.name() == 'record_delay':
+            if param.value():
+                if self.calibration is not None and not self.calibration.done:
+                    self.trace_averager.reset()  # traces of the previous delay are not averaged in
+                    self.calibration.collect()
                 param.setValue(False)
 
-        if param.name() == "GS":
-            self.settings.child('ac_param', 'Sec2').setValue(not param.value())
+        if param.name() == 'stop_cal':
+            if param.value():
+                self.stop_calibration()
+                param.setValue(False)
 
-        if param.name() == 'Sec2':
-            self.settings.child('ac_param', 'GS').setValue(not param.value())
+        if param.name() == 'fit_rate' and self.fit_worker is not None:
+            self.fit_worker.max_rate = param.value()
 
         if param.name() == "av_axis_v":
             self.settings.child('ac_param', 'av_axis_h').setValue(not param.value())
@@ -138,154 +162,233 @@ class DAQ_2DViewer_Thorlabs_TSI_autocorrelator(DAQ_2DViewer_Thorlabs_TSI):
         if param.name() == 'av_axis_h':
             self.settings.child('ac_param', 'av_axis_v').setValue(not param.value())
 
+        if param.name() == 'estimator':
+            self.estimator.set_engine(param.value())
+            self.clear_fit()
+
+        band = (self.settings['ac_param', 'band_start'], self.settings['ac_param', 'band_stop'])
+        if param.name() in ['band_start', 'band_stop'] and self._reporting:
+            pass  # band found in Auto mode and reported in the settings
+        elif param.name() in ['av_axis_v', 'av_axis_h', 'update_roi', 'clear_roi', 'x_binning', 'y_binning',
+                              'apply_preset', 'band_mode', 'band_start', 'band_stop', 'auto_frames', 'detect_band']:
+            self.estimator.reset()  # the previous trace does not seed the fit of the new one anymore
+            self.avaxis = 0 if self.settings['ac_param', 'av_axis_v'] else 1
+            self.projector.auto_frames = self.settings['ac_param', 'auto_frames']
+            self.projector.reset(self.avaxis, self.settings['ac_param', 'band_mode'], band)
+            # averaged and dark traces of a different band are meaningless
+            self.trace_averager.reset()
+            self.trace_averager.clear_dark()
+            self.clear_fit()
+            if param.name() == 'detect_band' and param.value():
+                param.setValue(False)
 
-    def _prepare_view(self):
-        """Preparing a data viewer by emitting temporary data. Typically, needs to be called whenever the
-        ROIs are changed"""
-        # wx = self.settings.child('rois', 'width').value()
-        # wy = self.settings.child('rois', 'height').value()
-        # bx = self.settings.child('rois', 'x_binning').value()
-        # by = self.settings.child('rois', 'y_binning').value()
-        #
-        # sizex = wx // bx
-        # sizey = wy // by
-        height, width = self.controller.get_data_dimensions()
-
-        self.settings.child('hdet').setValue(width)
-        self.settings.child('vdet').setValue(height)
-        mock_data = np.zeros((height, width))
-
-        if width != 1 and height != 1:
-            data_shape = 'Data2D'
-        else:
-            data_shape = 'Data1D'
-
-        if data_shape != self.data_shape:
-            self.data_shape = data_shape
-            # init the viewers
-
-
-            data = [np.squeeze(mock_data)]
-            dwa2D = DataFromPlugins(name='Thorlabs Camera',
-                                                               data=data,
-                                                               dim=self.data_shape,
-                                                               labels=[f'ThorCam_{self.data_shape}'])
-            data_mean = np.mean(data[0], axis=0)
-            data_fit = data_mean
-
-            dwa1D = DataFromPlugins(name='Autoccorelation trace',
-                                                      data=[data_mean, data_fit],
-                                                      dim='Data1D',
-                                                      labels=['Trace', 'Gaussian fit'])
-
-
-            dwa0D = DataFromPlugins(name='Pulse duration',
-                                                      data=[np.array([0])],
-                                                      dim='Data0D',
-                                                      labels=['Pulse duration (fs)'],
-                                                        unit='fs')
-
-            dataa = DataToExport('Autocorrelator', data=[dwa2D, dwa1D, dwa0D])
-            self.dte_signal.emit(dataa)
-
-            QtWidgets.QApplication.processEvents()
+    def ini_detector(self, controller=None):
+        info, initialized = super().ini_detector(controller)
+        self.fit_worker = LatestWorker(lambda item: item + (self.fit_trace(*item),),
+                                       self.settings['ac_param', 'fit_rate'], result_fn=self.emit_fit,
+                                       error_fn=lambda e: self.emit_status(
+                                           ThreadCommand('Update_Status', [str(e), 'log'])))
+        return info, initialized
 
-    def emit_data(self):
-        """ Function used to emit data obtained by callback.
+    def clear_fit(self):
+        """Discard the pending and running background fits, done on traces that are out of date"""
+        if self.fit_worker is not None:
+            self.fit_worker.clear()
 
-        Parameter
-        ---------
-        status: bool
-            If True a frame is available, If False, a Timeout occured while waiting for the frame
+    def emit_fit(self, result):
+        """Emit a completed background fit, called from the fit worker thread
 
-        See Also
-        --------
-        daq_utils.ThreadCommand
+        Parameters
+        ----------
+        result: tuple
+            the positions of the trace points, the fitted trace and the output of fit_trace
         """
+        x, trace, fit = result
+        self.dte_signal.emit(DataToExport('Autocorrelator', data=self.fit_data(x, trace, fit, 'Fitted trace')))
+
+    def grab_data(self, Naverage=1, **kwargs):
+        self._live = kwargs.get('live', False)
+        super().grab_data(Naverage, **kwargs)
+
+    def close(self):
+        self.stop_calibration()
+        if self.fit_worker is not None:
+            self.fit_worker.stop()
+            self.fit_worker = None
+        super().close()
+
+    def start_calibration(self):
+        """Start stepping through the calibration delays, by hand or with the stage depending on the settings"""
         try:
-            # Get  data from buffer
-            frame = self.controller.read_newest_image()
-            # Emit the frame.
-            if frame is not None:       # happens for last frame when stopping camera
-                if self.settings['output_color'] == 'RGB':
-
-                    rgb_image = cv2.cvtColor(frame, cv2.COLOR_BAYER_BG2RGB)
-                    data = [np.squeeze(rgb_image[..., ind]) for ind in range(3)]
-
-
-                    dwa2D = DataFromPlugins(name='Thorlabs Camera',
-                                                                  data=data,
-                                                                  dim='Data2D',
-                                                                  labels=[f'ThorCam_{self.data_shape}'])
-
-
-
-                else:
-                    if 'monochrome' in self.settings['sensor'].lower():
-                        data = [np.squeeze(frame)]
-                        dwa2D = DataFromPlugins(name='Thorlabs Camera',
-                                                data=data,
-                                                dim='Data2D',
-                                                labels=[f'ThorCam_{self.data_shape}'])
-                    else:
-                        grey_image = cv2.cvtColor(frame, cv2.COLOR_BAYER_BG2GRAY)
-                        data = [np.squeeze(grey_image)]
-                        dwa2D = DataFromPlugins(name='Thorlabs Camera',
-                                                data=data,
-                                                dim='Data2D',
-                                                labels=[f'ThorCam_{self.data_shape}'])
-
-                if self.settings.child('ac_param', 'av_axis_v').value() == True:
-                    self.avaxis = 0
-                else:
-                    self.avaxis = 1
-
-                data_mean = np.mean(data[0], axis=self.avaxis)
-                x = np.linspace(0, len(data_mean)-1, len(data_mean))
-                popt, pcov = curve_fit(self.gaus, x, data_mean, p0=[1, 1, 1])
-                data_fit = self.gaus(x, popt[0],popt[1], popt[2] )
-
-                dwa1D = DataFromPlugins(name='Autoccorelation trace',
-                                                          data=[data_mean, data_fit],
-                                                          dim='Data1D',
-                                                          labels=['Trace', 'Gaussian fit'])
-
-
-                if self.settings.child('ac_param', 'GS').value() == True:
-                    self.factor = 1/1.41
-                else:
-                    self.factor = 0.65
-
-                PxFs = self.settings.child('ac_param', 'PxFs').value()
-                dwa0D = DataFromPlugins(name='Pulse duration',
-                                                          data=[np.array([popt[2]*PxFs*self.factor])],
-                                                          dim='Data0D',
-                                                          labels=['Pulse duration (fs)'],
-                                                            unit='fs')
-
-            dataa = DataToExport('Autocorrelator', data=[dwa2D, dwa1D, dwa0D])
-            self.dte_signal.emit(dataa)
-
-
-            if self.settings.child('timing_opts', 'fps_on').value():
-                self.update_fps()
-
-            # To make sure that timed events are executed in continuous grab mode
-            QtWidgets.QApplication.processEvents()
-
+            self.stop_calibration()
+            delays = [float(delay) for delay in self.settings['ac_param', 'calibration', 'cal_delays'].split(',')]
+            self.calibration = DelayCalibration(delays, self.settings['ac_param', 'calibration', 'cal_frames'])
+            self.settings_signal.emit([(('ac_param', 'calibration', 'cal_next'), self.calibration.current_delay)])
+            if self.settings['ac_param', 'calibration', 'cal_control'] == 'LTS150':
+                self._stage = self.open_stage()
+                self.calibration.run(self.move_delay, self.apply_calibration,
+                                     error_fn=lambda e: self.emit_status(
+                                         ThreadCommand('Update_Status', [str(e), 'log'])),
+                                     timeout=self.settings['trigger_opts', 'trigger_timeout'])
+                self.emit_status(ThreadCommand('Update_Status', ['Calibration started']))
+            else:
+                self.emit_status(ThreadCommand('Update_Status', [
+                    f'Calibration started, set the delay to {self.calibration.current_delay} fs and record it']))
         except Exception as e:
             self.emit_status(ThreadCommand('Update_Status', [str(e), 'log']))
 
+    def open_stage(self):
+        """Open the LTS150 stage of the delay line, with the scaling of the configuration file"""
+        serial = self.settings['ac_param', 'calibration', 'cal_serial']
+        try:
+            return Thorlabs.KinesisMotor(serial, scale=(config('LTS150', 'pos_scale'), config('LTS150', 'speed_scale'),
+                                                        config('LTS150', 'acc_scale')))
+        except Thorlabs.ThorlabsError as e:
+            raise IOError(f'The LTS150 stage {serial} could not be opened ({e}). If it is used by an actuator, move '
+                          f'it from there with the manual delay control') from e
+
+    def stop_calibration(self):
+        if self.calibration is not None:
+            self.calibration.stop()
+            self.calibration = None
+        if self._stage is not None:
+            self._stage.close()
+            self._stage = None
+
+    def move_delay(self, delay: float):
+        """Set the delay (fs) with the stage of a double pass delay line, called from the calibration thread"""
+        self.settings_signal.emit([(('ac_param', 'calibration', 'cal_next'), delay)])
+        self._stage.move_to(self.settings['ac_param', 'calibration', 'cal_zero'] + delay * C_MM_FS / 2)
+        self._stage.wait_move()
+        self.trace_averager.reset()
+
+    def apply_calibration(self, pxfs: float, error: float):
+        """Use a new pixel to femtosecond conversion and save it in the configuration file. May be called from the
+        calibration thread or the pipeline workers"""
+        self.settings_signal.emit([(('ac_param', 'PxFs'), pxfs), (('ac_param', 'PxFs_error'), error)])
+        config['TLCamera', 'autocorrelator', 'PxFs'] = float(pxfs)
+        config['TLCamera', 'autocorrelator', 'PxFs_error'] = float(error)
+        config.save()
+        self.emit_status(ThreadCommand('Update_Status', [f'Calibrated: {pxfs:.4g} +- {error:.2g} fs/px']))
+
+    def calibrate(self, calibration: DelayCalibration, popt):
+        """Give the peak position of a trace to a running calibration, popt being None if it has no peak"""
+        if not calibration.add(popt[1] if popt is not None else np.nan):
+            return
+        if calibration.done:
+            if self._stage is None:  # manual control, otherwise handled by the calibration thread
+                self.apply_calibration(*calibration.fit())
+        else:
+            self.settings_signal.emit([(('ac_param', 'calibration', 'cal_next'), calibration.current_delay)])
+
+    def setup_pipeline(self):
+        super().setup_pipeline()
+        spare = self.settings['processing_opts', 'queue_size'] if self.pipeline is not None else 0
+        self.projector.nbuffers = 4 + spare
+        self.trace_averager.nbuffers = 4 + spare
+
+    def placeholder_data(self):
+        """Add the autocorrelation trace, pulse duration and fit time to the placeholders of the camera image"""
+        return super().placeholder_data() + [
+            DataFromPlugins(name='Autocorrelation trace', data=[np.zeros((2,)), np.zeros((2,))], dim='Data1D',
+                            labels=['Trace', f'{self.estimator.shape.name} fit']),
+            DataFromPlugins(name='Pulse duration', data=[np.array([0.])], dim='Data0D',
+                            labels=['Pulse duration (fs)'], unit='fs'),
+            DataFromPlugins(name='Fit time', data=[np.array([0.])], dim='Data0D', labels=['Fit time (ms)'])]
+
+    def fit_trace(self, x: np.ndarray, trace: np.ndarray):
+        """Estimate the parameters of a trace, called from the fit worker thread in Background fit mode
+
+        Returns
+        -------
+        ndarray or None: the parameters (a, x0, dx, y0), None if there is no peak in the trace
+        float: the fit time in seconds
+        """
+        return self.estimator.estimate(x, trace)
 
+    def project_trace(self, channels):
+        """Project a converted camera frame into its dark subtracted, averaged autocorrelation trace
 
+        May be called from the pipeline worker threads, values to report in the settings are sent to the plugin
+        thread through settings_signal.
 
+        Returns
+        -------
+        ndarray: the positions of the trace points (px)
+        ndarray: the trace, a buffer of the trace averager
+        """
+        x, data_mean = self.projector.project(channels[0])
+        capturing_dark = self.trace_averager.capturing_dark
+        data_mean = self.trace_averager.add(data_mean)
+        if capturing_dark and not self.trace_averager.capturing_dark:
+            self.emit_status(ThreadCommand('Update_Status', ['Dark trace captured']))
+        if self.projector.mode == 'Auto' and self.projector.detected and \
+                self.projector.band != (self.settings['ac_param', 'band_start'],
+                                        self.settings['ac_param', 'band_stop']):
+            self.settings_signal.emit([(('ac_param', 'band_start'), self.projector.band[0]),
+                                       (('ac_param', 'band_stop'), self.projector.band[1])])
+        return x, data_mean
+
+    def process_batch(self, frames, infos):
+        """Add the traces of the older frames of a batch to the trace average, the newest frame only is emitted
+        along with its trace and fit, see process_frame"""
+        for frame in frames[:-1]:
+            self.project_trace(self.convert_frame(frame))
+        return self.process_frame(frames[-1])
+
+    def process_frame(self, frame: np.ndarray):
+        """Return the camera frame together with its projected autocorrelation trace, its fit and the pulse duration
+
+        In live Background fit mode, the trace is handed to the fit worker and the fit is emitted later by emit_fit.
+        May be called from the pipeline worker threads, see project_trace.
+        """
+        data = self.convert_frame(frame)
+        x, data_mean = self.project_trace(data)
+        calibration = self.calibration
+        calibrating = calibration is not None and calibration.collecting
+        if self.settings['ac_param', 'fit_mode'] == 'Background' and self._live and self.fit_worker is not None \
+                and not calibrating:
+            data_mean = data_mean.copy()  # the trace buffer is reused
+            self.fit_worker.submit((x, data_mean))
+            dwa1D = DataFromPlugins(name='Autocorrelation trace', data=[data_mean], dim='Data1D', labels=['Trace'])
+            return DataToExport('Autocorrelator', data=self.image_data(data) + [dwa1D])  # fit emitted by emit_fit
+
+        fit = self.fit_trace(x, data_mean)
+        if calibrating:
+            self.calibrate(calibration, fit[0])
+        return DataToExport('Autocorrelator',
+                            data=self.image_data(data) + self.fit_data(x, data_mean, fit, 'Autocorrelation trace'))
+
+    def fit_data(self, x: np.ndarray, trace: np.ndarray, fit, name: str):
+        """Return the trace along with its fit, the pulse duration and the fit time
 
+        Parameters
+        ----------
+        x: ndarray
+            the positions of the trace points (px)
+        trace: ndarray
+            the fitted trace
+        fit: tuple
+            the output of fit_trace
+        name: str
+            the name of the trace data
+        """
+        popt, fit_time = fit
+        if popt is None:  # no peak in the trace
+            popt = np.array([0., 0., np.nan, 0.])
+            data_fit = np.full(x.shape, np.nan)
+        else:
+            data_fit = self.estimator.evaluate(x, popt)
 
+        dwa1D = DataFromPlugins(name=name, data=[trace, data_fit], dim='Data1D',
+                                labels=['Trace', f'{self.estimator.shape.name} fit'])
 
-
-
-
-
+        PxFs = self.settings.child('ac_param', 'PxFs').value()
+        dwa0D = DataFromPlugins(name='Pulse duration', data=[np.array([self.estimator.shape.duration(popt[2], PxFs)])],
+                                dim='Data0D', labels=['Pulse duration (fs)'], unit='fs')
+        dwa_time = DataFromPlugins(name='Fit time', data=[np.array([fit_time * 1e3])],
+                                   dim='Data0D', labels=['Fit time (ms)'])
+        return [dwa1D, dwa0D, dwa_time]
 
 if __name__ == '__main__':
     main(__file__)
@@ -0,0 +1,803 @@
+"""
+Pulse width estimation from the autocorrelation traces of the TSI autocorrelator plugin
+
+The trace is modelled by the autocorrelation profile of a pulse shape on top of a constant background:
+
+    y0 + a * profile((x - x0) / dx)
+
+and the estimators return the parameters (a, x0, dx, y0). They are meant to run at the camera frame rate, from the
+acquisition or the processing threads.
+
+Pulse shapes are registered in PULSE_SHAPES. Besides the built-in gaussian, sech² and lorentzian shapes, user-defined
+shapes can be added with register_pulse_shape, giving the profile, its derivative (both scalar functions compiled
+with numba) and the deconvolution factor between the autocorrelation and pulse durations:
+
+    register_pulse_shape('Cos²', lambda u: np.cos(u) ** 2 if abs(u) < np.pi / 2 else 0.,
+                         lambda u: -np.sin(2 * u) if abs(u) < np.pi / 2 else 0., factor=0.69)
+"""
+import functools
+import threading
+from time import perf_counter
+
+import numba
+import numpy as np
+from numba.core.registry import CPUDispatcher
+
+
+@numba.njit(cache=True)
+def _gaussian(u):
+    return np.exp(-u * u)
+
+
+@numba.njit(cache=True)
+def _gaussian_derivative(u):
+    return -2 * u * np.exp(-u * u)
+
+
+@numba.njit(cache=True)
+def _sech2(u):
+    c = np.cosh(min(abs(u), 350.))  # cosh overflows beyond, where sech² is 0 anyway
+    return 1 / (c * c)
+
+
+@numba.njit(cache=True)
+def _sech2_derivative(u):
+    return -2 * np.tanh(u) * _sech2(u)
+
+
+@numba.njit(cache=True)
+def _lorentzian(u):
+    return 1 / (1 + u * u)
+
+
+@numba.njit(cache=True)
+def _lorentzian_derivative(u):
+    d = 1 + u * u
+    return -2 * u / (d * d)
+
+
+@numba.njit(cache=True)
+def _evaluate(x, params, profile):
+    a, x0, dx, y0 = params[0], params[1], params[2], params[3]
+    out = np.empty(x.size)
+    for i in range(x.size):
+        out[i] = y0 + a * profile((x[i] - x0) / dx)
+    return out
+
+
+@numba.njit(cache=True)
+def _jacobian(x, params, profile, derivative):
+    a, x0, dx = params[0], params[1], params[2]
+    jac = np.empty((x.size, 4))
+    for i in range(x.size):
+        u = (x[i] - x0) / dx
+        d = derivative(u)
+        jac[i, 0] = profile(u)
+        jac[i, 1] = -a * d / dx
+        jac[i, 2] = -a * d * u / dx
+        jac[i, 3] = 1.
+    return jac
+
+
+@numba.njit(cache=True)
+def _fit(x, y, p0, profile, derivative, maxiter, tol):
+    """Levenberg-Marquardt least squares fit of the model, returns the parameters and whether it converged
+
+    The fit has not converged if no step lowering the cost can be found before the relative cost decrease falls below
+    tol, unless the model already matches the data (cost below tol times the sum of squares of the data).
+    """
+    params = p0.copy()
+    residuals = y - _evaluate(x, params, profile)
+    cost = np.dot(residuals, residuals)
+    damping = 1e-3
+    converged = False
+    for iteration in range(maxiter):
+        jac = _jacobian(x, params, profile, derivative)
+        hessian = jac.T @ jac
+        gradient = jac.T @ residuals
+        improved = False
+        while damping < 1e10:
+            matrix = hessian.copy()
+            for k in range(4):
+                matrix[k, k] += damping * hessian[k, k] + 1e-12
+            trial = params + np.linalg.solve(matrix, gradient)
+            if trial[2] != 0:
+                trial_residuals = y - _evaluate(x, trial, profile)
+                trial_cost = np.dot(trial_residuals, trial_residuals)
+                if trial_cost < cost:
+                    converged = cost - trial_cost <= tol * cost
+                    params, residuals, cost = trial, trial_residuals, trial_cost
+                    damping = max(damping / 10, 1e-12)
+                    improved = True
+                    break
+            damping *= 10
+        if converged:
+            return params, True
+        if not improved:
+            return params, cost <= tol * np.dot(y, y)
+    return params, False
+
+
+class PulseShape:
+    """Autocorrelation profile of a pulse shape
+
+    Parameters
+    ----------
+    name: str
+    profile: callable
+        the autocorrelation profile as a scalar function of u = (x - x0) / dx, maximum of 1 at u = 0
+    derivative: callable
+        derivative of the profile
+    factor: float
+        deconvolution factor, ratio between the pulse and autocorrelation full widths at half maximum
+
+    The constants of the profile used by the estimators are computed numerically at their first use, and the model
+    functions are compiled by numba at their first call (and cached on disk for the built-in shapes).
+    """
+
+    def __init__(self, name: str, profile, derivative, factor: float):
+        self.name = name
+        self.profile = profile if isinstance(profile, CPUDispatcher) else numba.njit(profile)
+        self.derivative = derivative if isinstance(derivative, CPUDispatcher) else numba.njit(derivative)
+        self.factor = factor
+
+    @functools.cached_property
+    def _constants(self):
+        """Constants of the profile used to turn the estimators results into the width parameter dx"""
+        u = np.linspace(0, 50, 500001)
+        f = _evaluate(u, np.array([1., 0., 1., 0.]), self.profile)
+        fwhm = 2 * u[np.argmax(f < 0.5)]  # full width at half maximum in units of dx
+        window = u <= 1.5 * fwhm
+        window_variance = np.sum(u[window] ** 2 * f[window]) / np.sum(f[window])
+        above = f >= 0.5
+        us = np.concatenate([-u[above][:0:-1], u[above]])
+        fs = np.concatenate([f[above][:0:-1], f[above]])
+        log_curvature, _, log_peak = np.polyfit(us, np.log(fs), 2, w=fs)
+        return fwhm, window_variance, log_curvature, log_peak
+
+    @property
+    def fwhm(self):
+        """Full width at half maximum of the profile, in units of dx"""
+        return self._constants[0]
+
+    @property
+    def window_variance(self):
+        """Second moment of the profile within 1.5 FWHM of its peak, in units of dx²"""
+        return self._constants[1]
+
+    @property
+    def log_curvature(self):
+        """Curvature of the parabola fitted to the log of the profile above half maximum"""
+        return self._constants[2]
+
+    @property
+    def log_peak(self):
+        """Value at the peak of the parabola fitted to the log of the profile above half maximum"""
+        return self._constants[3]
+
+    def __repr__(self):
+        return f'PulseShape({self.name})'
+
+    def evaluate(self, x: np.ndarray, params):
+        """Vectorised evaluation of the model y0 + a * profile((x - x0) / dx)"""
+        return _evaluate(np.asarray(x, dtype=float), np.asarray(params, dtype=float), self.profile)
+
+    def jacobian(self, x: np.ndarray, params):
+        """Jacobian of the model with respect to (a, x0, dx, y0), of shape (len(x), 4)"""
+        return _jacobian(np.asarray(x, dtype=float), np.asarray(params, dtype=float), self.profile,
+                         self.derivative)
+
+    def fit(self, x: np.ndarray, y: np.ndarray, p0, maxiter: int = 50, tol: float = 1e-8):
+        """Least squares fit of the model, compiled with numba
+
+        Returns
+        -------
+        ndarray: the fitted parameters (a, x0, dx, y0)
+        bool: True if the fit converged
+        """
+        params, converged = _fit(np.asarray(x, dtype=float), np.asarray(y, dtype=float),
+                                 np.asarray(p0, dtype=float), self.profile, self.derivative, maxiter, tol)
+        params[2] = abs(params[2])
+        return params, converged
+
+    def duration(self, dx: float, scaling: float = 1.):
+        """Pulse duration (FWHM) from the width parameter of the trace, scaled by the delay per unit of x"""
+        return self.factor * self.fwhm * dx * scaling
+
+    def compile(self):
+        """Compile the model functions for this shape and compute its constants, so that the first trace does not
+        wait for it"""
+        self._constants
+        x = np.linspace(-5, 5, 11)
+        self.fit(x, self.evaluate(x, [1., 0., 1., 0.]), [1., 0.1, 1.1, 0.], maxiter=2)
+
+
+PULSE_SHAPES = {}
+
+
+def register_pulse_shape(name: str, profile, derivative, factor: float):
+    """Add a pulse shape to the registry, see PulseShape for the parameters"""
+    PULSE_SHAPES[name] = PulseShape(name, profile, derivative, factor)
+    return PULSE_SHAPES[name]
+
+
+register_pulse_shape('Gaussian', _gaussian, _gaussian_derivative, 1 / np.sqrt(2))
+register_pulse_shape('Sech²', _sech2, _sech2_derivative, 0.6482)
+register_pulse_shape('Lorentzian', _lorentzian, _lorentzian_derivative, 0.5)
+
+
+class PulseEstimator:
+    """Estimate the parameters of autocorrelation traces for a given pulse shape
+
+    Engines:
+
+    * Moments: background from the edges of the trace, then centroid and second moment of the trace within
+      1.5 FWHM of the peak (the FWHM being first estimated from the half maximum crossings)
+    * Log-parabola: weighted least squares fit of a parabola to the logarithm of the points above half maximum
+    * Warm fit: least squares fit of the pulse shape model, seeded with the parameters found for the previous trace
+      (or with the moments when there is none or the previous fit failed)
+
+    The first two are closed form and scaled to the pulse shape through constants of its profile. The duration of
+    each estimation is returned along with its result, the estimator being shared by the processing threads.
+
+    Parameters
+    ----------
+    engine: str
+        one of the engines
+    shape: str
+        one of the registered pulse shapes
+    maxiter: int
+        maximum number of iterations of the warm started fit
+    """
+    engines = ['Moments', 'Log-parabola', 'Warm fit']
+
+    def __init__(self, engine: str = 'Log-parabola', shape: str = 'Gaussian', maxiter: int = 50):
+        self.engine = None
+        self.shape: PulseShape = None
+        self.maxiter = maxiter
+        self._last: np.ndarray = None
+        self._lock = threading.Lock()  # traces may be processed from several threads
+        self.set_engine(engine)
+        self.set_shape(shape)
+
+    def set_engine(self, engine: str):
+        if engine not in self.engines:
+            raise ValueError(f'Unknown estimator {engine}, should be one of {self.engines}')
+        self.engine = engine
+        self.reset()
+
+    def set_shape(self, shape: str):
+        if shape not in PULSE_SHAPES:
+            raise ValueError(f'Unknown pulse shape {shape}, should be one of {list(PULSE_SHAPES)}')
+        self.shape = PULSE_SHAPES[shape]
+        self.reset()
+
+    def reset(self):
+        """Forget the parameters used to seed the warm started fit"""
+        with self._lock:
+            self._last = None
+
+    def estimate(self, x: np.ndarray, y: np.ndarray):
+        """Estimate the parameters of a trace
+
+        Parameters
+        ----------
+        x: ndarray
+            positions of the trace points, evenly spaced
+        y: ndarray
+            the trace
+
+        Returns
+        -------
+        ndarray or None: the parameters (a, x0, dx, y0), None if there is no peak in the trace
+        float: the duration of the estimation in seconds
+        """
+        start = perf_counter()
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        if self.engine == 'Moments':
+            params = self.moments(x, y)
+        elif self.engine == 'Log-parabola':
+            params = self.log_parabola(x, y)
+        else:
+            params = self.warm_fit(x, y)
+        return params, perf_counter() - start
+
+    def evaluate(self, x: np.ndarray, params):
+        return self.shape.evaluate(x, params)
+
+    @staticmethod
+    def background(y: np.ndarray):
+        """Median of the first and last tenths of the trace"""
+        n = max(1, len(y) // 10)
+        return float(np.median(np.concatenate([y[:n], y[-n:]])))
+
+    @staticmethod
+    def half_max_width(x: np.ndarray, y: np.ndarray, peak: int):
+        """Full width at half maximum of a background free trace, interpolated between the points"""
+        half = y[peak] / 2
+        below = np.flatnonzero(y[:peak] < half)
+        if below.size:
+            i = below[-1]
+            left = x[i] + (half - y[i]) / (y[i + 1] - y[i]) * (x[i + 1] - x[i])
+        else:
+            left = x[0]
+        above = np.flatnonzero(y[peak:] < half)
+        if above.size:
+            i = peak + above[0]
+            right = x[i - 1] + (y[i - 1] - half) / (y[i - 1] - y[i]) * (x[i] - x[i - 1])
+        else:
+            right = x[-1]
+        return right - left
+
+    def moments(self, x: np.ndarray, y: np.ndarray):
+        y0 = self.background(y)
+        y = y - y0
+        peak = int(np.argmax(y))
+        if y[peak] <= 0:
+            return None
+        fwhm = self.half_max_width(x, y, peak)
+        window = np.abs(x - x[peak]) <= 1.5 * fwhm + abs(x[1] - x[0])
+        xw, yw = x[window], np.clip(y[window], 0, None)
+        weight = yw.sum()
+        if weight <= 0:
+            return None
+        x0 = float(np.dot(xw, yw) / weight)
+        variance = float(np.dot((xw - x0) ** 2, yw) / weight)
+        if variance > 0:
+            dx = np.sqrt(variance / self.shape.window_variance)
+        else:
+            dx = fwhm / self.shape.fwhm
+        return np.array([y[peak], x0, dx, y0])
+
+    def log_parabola(self, x: np.ndarray, y: np.ndarray):
+        y0 = self.background(y)
+        y = y - y0
+        peak = int(np.argmax(y))
+        if y[peak] <= 0:
+            return None
+        # contiguous points above half maximum around the peak
+        low = np.flatnonzero(y[:peak] < y[peak] / 2)
+        high = np.flatnonzero(y[peak:] < y[peak] / 2)
+        start = low[-1] + 1 if low.size else 0
+        stop = peak + high[0] if high.size else len(y)
+        if stop - start < 3:  # not enough points, peak narrower than the pixels
+            start, stop = max(0, peak - 1), min(len(y), peak + 2)
+            if stop - start < 3:
+                return self.moments(x, y + y0)
+        xs, ys = x[start:stop], y[start:stop]
+        # weights y as the noise on log(y) scales as 1/y
+        c2, c1, c0 = np.polyfit(xs - x[peak], np.log(np.clip(ys, 1e-12, None)), 2, w=ys)
+        if c2 >= 0:
+            return self.moments(x, y + y0)
+        x0 = -c1 / (2 * c2)
+        # the parabola fitted to the log of the profile itself gives the scaling to the shape
+        a = np.exp(c0 - c1 ** 2 / (4 * c2) - self.shape.log_peak)
+        return np.array([a, x[peak] + x0, np.sqrt(self.shape.log_curvature / c2), y0])
+
+    def warm_fit(self, x: np.ndarray, y: np.ndarray):
+        with self._lock:
+            p0 = self._last
+        if p0 is None:
+            p0 = self.moments(x, y)
+            if p0 is None:
+                return None
+        try:
+            params, converged = self.shape.fit(x, y, p0, maxiter=self.maxiter)
+        except (np.linalg.LinAlgError, ZeroDivisionError):
+            converged = False
+        if not converged:  # start again from the moments at the next trace
+            self.reset()
+            return self.moments(x, y)
+        with self._lock:
+            self._last = params
+        return params
+
+
+class TraceProjector:
+    """Average the signal band of camera images into autocorrelation traces
+
+    The band is a range of rows (or columns when averaging horizontally) of the image, independent of the camera
+    ROI. It is either the full frame, set manually or found automatically from the first frames: the profile across
+    the band is averaged over auto_frames frames and the band is set around its peak, where it rises above
+    threshold times the peak height over the background, with a margin.
+
+    Traces are averaged into a few preallocated buffers used in turn, and the x axis is kept until the trace length
+    changes.
+
+    Parameters
+    ----------
+    axis: int
+        image axis averaged into the trace, 0 for a vertical average (trace along the image rows)
+    mode: str
+        one of the modes
+    band: tuple of int
+        (start, stop) of the band in Manual mode
+    auto_frames: int
+        number of frames used to find the band in Auto mode
+    threshold: float
+        fraction of the profile peak height delimiting the band in Auto mode
+    nbuffers: int
+        number of trace buffers used in turn
+    """
+    modes = ['Full frame', 'Manual', 'Auto']
+
+    def __init__(self, axis: int = 0, mode: str = 'Full frame', band=(0, 0), auto_frames: int = 5,
+                 threshold: float = 0.2, nbuffers: int = 4):
+        self.axis = axis
+        self.mode = mode
+        self.band = tuple(band)
+        self.auto_frames = max(1, int(auto_frames))
+        self.threshold = threshold
+        self.nbuffers = max(1, int(nbuffers))
+        self.detected = False
+        self._profile: np.ndarray = None
+        self._nprofiles = 0
+        self._traces: np.ndarray = None
+        self._index = 0
+        self._x: np.ndarray = None
+        self._lock = threading.Lock()
+        self.reset(axis, mode, band)
+
+    def reset(self, axis: int = None, mode: str = None, band=None):
+        """Change the projection, the band is searched again in Auto mode"""
+        with self._lock:
+            if axis is not None:
+                self.axis = axis
+            if mode is not None:
+                if mode not in self.modes:
+                    raise ValueError(f'Unknown band mode {mode}, should be one of {self.modes}')
+                self.mode = mode
+            if band is not None:
+                self.band = tuple(int(value) for value in band)
+            self.detected = False
+            self._profile = None
+            self._nprofiles = 0
+
+    def x(self, length: int):
+        """Positions of the trace points, cached until the trace length changes"""
+        if self._x is None or self._x.size != length:
+            self._x = np.arange(length, dtype=float)
+        return self._x
+
+    def band_slice(self, height: int):
+        """Slice of the band along the averaged axis, the full frame if not (yet) defined"""
+        if self.mode == 'Full frame' or (self.mode == 'Auto' and not self.detected):
+            return slice(0, height)
+        start, stop = max(0, min(self.band[0], height - 1)), min(self.band[1], height)
+        return slice(start, max(stop, start + 1))
+
+    def project(self, image: np.ndarray):
+        """Average the band of an image into a trace
+
+        Returns
+        -------
+        ndarray: the x axis, shared between traces of the same length
+        ndarray: the trace, a buffer reused after nbuffers calls
+        """
+        if self.mode == 'Auto' and not self.detected:
+            self._accumulate_profile(image)
+        height, length = image.shape[self.axis], image.shape[1 - self.axis]
+        band = self.band_slice(height)
+        view = image[band, :] if self.axis == 0 else image[:, band]
+        with self._lock:
+            if self._traces is None or self._traces.shape[1] != length:
+                self._traces = np.empty((self.nbuffers, length))
+                self._index = 0
+            trace = self._traces[self._index]
+            self._index = (self._index + 1) % self.nbuffers
+        np.mean(view, axis=self.axis, out=trace)
+        return self.x(length), trace
+
+    def _accumulate_profile(self, image: np.ndarray):
+        profile = np.mean(image, axis=1 - self.axis)
+        with self._lock:
+            if self._profile is None or self._profile.shape != profile.shape:
+                self._profile = np.zeros(profile.shape)
+                self._nprofiles = 0
+            self._profile += profile
+            self._nprofiles += 1
+            if self._nprofiles >= self.auto_frames:
+                self.band = self.detect_band(self._profile, self.threshold)
+                self.detected = True
+
+    @staticmethod
+    def detect_band(profile: np.ndarray, threshold: float = 0.2):
+        """Find the band around the peak of a profile across the trace
+
+        Returns
+        -------
+        tuple of int: (start, stop) of the band
+        """
+        n = max(1, len(profile) // 10)
+        background = np.median(np.concatenate([profile[:n], profile[-n:]]))
+        signal = profile - background
+        peak = int(np.argmax(signal))
+        level = threshold * signal[peak]
+        below = np.flatnonzero(signal[:peak] < level)
+        above = np.flatnonzero(signal[peak:] < level)
+        start = below[-1] + 1 if below.size else 0
+        stop = peak + above[0] if above.size else len(profile)
+        margin = max(2, (stop - start) // 10)
+        return int(max(0, start - margin)), int(min(len(profile), stop + margin))
+
+
+class TraceAverager:
+    """Dark subtraction and rolling average of autocorrelation traces
+
+    A dark trace is captured once by averaging the next dark_frames traces (taken with the beam blocked) and kept
+    until cleared, then subtracted from each trace. Traces are averaged either exponentially, with a weight of
+    1/navg, or over the last navg traces held in a ring buffer along with their running sum.
+
+    Parameters
+    ----------
+    mode: str
+        one of the modes
+    navg: int
+        number of averaged traces
+    nbuffers: int
+        number of output buffers used in turn
+    """
+    modes = ['None', 'Exponential', 'Moving']
+
+    def __init__(self, mode: str = 'None', navg: int = 10, nbuffers: int = 4):
+        self.mode = mode
+        self.navg = max(1, int(navg))
+        self.nbuffers = max(1, int(nbuffers))
+        self.subtract_dark = True
+        self.dark: np.ndarray = None
+        self._dark_acc: np.ndarray = None
+        self._dark_count = 0
+        self._dark_frames = 0
+        self._ring: np.ndarray = None
+        self._sum: np.ndarray = None
+        self._count = 0
+        self._index = 0
+        self._out: np.ndarray = None
+        self._out_index = 0
+        self._lock = threading.Lock()  # traces may be processed from several threads
+        self.reset(mode, navg)
+
+    @property
+    def capturing_dark(self):
+        return self._dark_frames > 0
+
+    def reset(self, mode: str = None, navg: int = None):
+        """Restart the averaging, optionally with a new mode and number of traces"""
+        with self._lock:
+            if mode is not None:
+                if mode not in self.modes:
+                    raise ValueError(f'Unknown averaging mode {mode}, should be one of {self.modes}')
+                self.mode = mode
+            if navg is not None:
+                self.navg = max(1, int(navg))
+            self._ring = None
+            self._count = 0
+
+    def capture_dark(self, nframes: int = 10):
+        """Average the next nframes traces into the dark trace"""
+        with self._lock:
+            self._dark_acc = None
+            self._dark_count = 0
+            self._dark_frames = max(1, int(nframes))
+
+    def clear_dark(self):
+        with self._lock:
+            self.dark = None
+            self._dark_frames = 0
+
+    def _allocate(self, length: int):
+        if self._ring is None or self._ring.shape != (self.navg, length):
+            self._ring = np.zeros((self.navg, length))
+            self._sum = np.zeros(length)
+            self._count = 0
+            self._index = 0
+        if self._out is None or self._out.shape != (self.nbuffers, length):
+            self._out = np.empty((self.nbuffers, length))
+            self._out_index = 0
+
+    def add(self, trace: np.ndarray):
+        """Add a trace and return the dark subtracted average
+
+        Traces added while capturing the dark trace are returned as they are, without being averaged.
+
+        Returns
+        -------
+        ndarray: the averaged trace, a buffer reused after nbuffers calls
+        """
+        with self._lock:
+            length = trace.shape[0]
+            self._allocate(length)
+            if self._dark_frames > 0:
+                if self._dark_acc is None or self._dark_acc.shape != trace.shape:
+                    self._dark_acc = np.zeros(length)
+                self._dark_acc += trace
+                self._dark_count += 1
+                if self._dark_count >= self._dark_frames:
+                    self.dark = self._dark_acc / self._dark_count
+                    self._dark_frames = 0
+                    # restart the averaging, the dark traces are not to be averaged with the next ones
+                    self._ring[:] = 0
+                    self._sum[:] = 0
+                    self._count = 0
+                    self._index = 0
+                dark_trace = True
+            else:
+                dark_trace = False
+            out = self._out[self._out_index]
+            self._out_index = (self._out_index + 1) % self.nbuffers
+
+            if dark_trace or self.mode == 'None':
+                out[:] = trace
+            elif self.mode == 'Exponential':
+                if self._count == 0:
+                    self._sum[:] = trace
+                else:
+                    # sum += (trace - sum) / n without temporary arrays
+                    np.subtract(trace, self._sum, out=out)
+                    out *= 1 / min(self._count + 1, self.navg)
+                    self._sum += out
+                self._count += 1
+                out[:] = self._sum
+            elif self.mode == 'Moving':
+                slot = self._ring[self._index]
+                self._sum -= slot
+                slot[:] = trace
+                self._sum += slot
+                self._index = (self._index + 1) % self.navg
+                self._count = min(self._count + 1, self.navg)
+                np.multiply(self._sum, 1 / self._count, out=out)
+
+            if self.subtract_dark and self.dark is not None and self.dark.shape == out.shape:
+                out -= self.dark
+            return out
+
+
+def linear_calibration(positions, delays):
+    """Least squares fit of the delays by a linear function of the trace peak positions
+
+    Parameters
+    ----------
+    positions: array-like
+        peak positions of the traces (px)
+    delays: array-like
+        the corresponding delays (fs)
+
+    Returns
+    -------
+    float: the slope, in fs per px, as a positive conversion factor
+    float: its standard error, NaN with less than 3 points
+    float: the intercept (fs)
+    """
+    positions = np.asarray(positions, dtype=float)
+    delays = np.asarray(delays, dtype=float)
+    npoints = positions.size
+    if npoints < 2 or np.ptp(positions) == 0:
+        raise ValueError('At least two different peak positions are needed for the calibration')
+    design = np.column_stack((positions, np.ones(npoints)))
+    (slope, intercept), *_ = np.linalg.lstsq(design, delays, rcond=None)
+    if npoints > 2:
+        residuals = delays - design @ (slope, intercept)
+        covariance = residuals @ residuals / (npoints - 2) * np.linalg.inv(design.T @ design)
+        error = np.sqrt(covariance[0, 0])
+    else:
+        error = np.nan
+    return abs(slope), error, intercept
+
+
+class DelayCalibration:
+    """Calibration of the trace axis of the autocorrelator from the peak positions at a series of known delays
+
+    The delay between the two arms is stepped through the given delays, either by hand (call collect once each
+    delay is set) or by an actuator (run does it all in its own thread, calling move_fn with each delay). At each
+    delay, the peak positions of the next nframes traces, given to add, are averaged. Once all the delays are done,
+    fit gives the conversion factor from trace pixels to femtoseconds.
+
+    Parameters
+    ----------
+    delays: sequence of float
+        the delays (fs)
+    nframes: int
+        number of traces averaged at each delay
+    """
+
+    def __init__(self, delays, nframes: int = 10):
+        self.delays = np.asarray(delays, dtype=float)
+        if self.delays.size < 2:
+            raise ValueError('At least two delays are needed for the calibration')
+        self.nframes = max(1, int(nframes))
+        self.positions = np.full(self.delays.size, np.nan)
+        self.index = 0
+        self._peaks = []
+        self._collecting = False
+        self._collected = threading.Event()
+        self._stopped = threading.Event()
+        self._thread: threading.Thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def done(self):
+        return self.index >= self.delays.size
+
+    @property
+    def collecting(self):
+        return self._collecting
+
+    @property
+    def current_delay(self):
+        return None if self.done else self.delays[self.index]
+
+    def collect(self):
+        """Start averaging the peak positions at the current delay"""
+        with self._lock:
+            if not self.done:
+                self._peaks = []
+                self._collected.clear()
+                self._collecting = True
+
+    def add(self, position: float):
+        """Add the peak position of a trace at the current delay, NaN positions (no peak) are ignored
+
+        Returns
+        -------
+        bool: True if this completed the current delay
+        """
+        with self._lock:
+            if not self._collecting or not np.isfinite(position):
+                return False
+            self._peaks.append(position)
+            if len(self._peaks) < self.nframes:
+                return False
+            self.positions[self.index] = np.mean(self._peaks)
+            self.index += 1
+            self._collecting = False
+        self._collected.set()
+        return True
+
+    def fit(self):
+        """Return the conversion factor (fs/px) and its uncertainty from the delays done, see linear_calibration"""
+        valid = np.isfinite(self.positions)
+        pxfs, error, _ = linear_calibration(self.positions[valid], self.delays[valid])
+        return pxfs, error
+
+    def run(self, move_fn, done_fn=None, error_fn=None, timeout: float = 60.):
+        """Step through the delays with an actuator, in a dedicated thread
+
+        Parameters
+        ----------
+        move_fn: callable
+            function setting the delay (fs), returning once it is reached
+        done_fn: callable
+            function called with the conversion factor and its uncertainty once all delays are done
+        error_fn: callable
+            function called with the exception if the calibration fails
+        timeout: float
+            maximum time to get the traces at each delay (s)
+        """
+        def steps():
+            try:
+                while not self.done and not self._stopped.is_set():
+                    move_fn(self.current_delay)
+                    self.collect()
+                    deadline = perf_counter() + timeout
+                    while not self._collected.wait(0.1):
+                        if self._stopped.is_set():
+                            return
+                        if perf_counter() > deadline:
+                            raise TimeoutError(f'No trace peak found at delay {self.current_delay} fs')
+                if self.done and done_fn is not None:
+                    done_fn(*self.fit())
+            except Exception as e:
+                if error_fn is not None:
+                    error_fn(e)
+
+        self._thread = threading.Thread(target=steps, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop stepping the delays"""
+        self._stopped.set()
+        self._collecting = False
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+            self._thread = None
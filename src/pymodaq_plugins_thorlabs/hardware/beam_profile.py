@@ -0,0 +1,131 @@
+"""
+Beam profile analysis of the camera frames of the TSI plugins
+
+The beam centroid, its diameters along the principal axes and its orientation are computed from the second moments
+of the image (ISO 11146) by laserbeamsize. To keep up with live acquisition, the analysis is done on a reduced image:
+the frame is cropped around the beam found on the previous analysed frame and block-averaged down to a maximum size,
+and only one frame every N may be analysed (the others carry the latest result).
+"""
+import threading
+
+import numpy as np
+
+try:
+    import laserbeamsize as lbs
+except ImportError:
+    lbs = None
+
+
+class BeamProfiler:
+    """Second moment beam profile of camera images
+
+    Results are given in pixels of the analysed image (whatever the cropping and downsampling), as an array of
+    channels in the order given by labels. Ellipticity is the ratio of the minor and major diameters and the angle is
+    the orientation of the major axis (degrees). They are NaN when no beam could be found.
+
+    Parameters
+    ----------
+    every: int
+        analyse one image every that many, the others get the latest result
+    max_size: int
+        maximum number of pixels of the analysed image along each dimension, larger ones are block-averaged
+    crop: float
+        size of the analysed region around the previous beam, in beam diameters. 0 to analyse the whole image
+    """
+    labels = ['Centroid x (px)', 'Centroid y (px)', 'Major diameter (px)', 'Minor diameter (px)', 'Ellipticity',
+              'Angle (deg)']
+    available = lbs is not None
+
+    def __init__(self, every: int = 1, max_size: int = 256, crop: float = 4.):
+        self.every = every
+        self.max_size = max_size
+        self.crop = crop
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Forget the previous beam, the next image is analysed as a whole"""
+        with self._lock:
+            self._count = 0
+            self._result = np.full(len(self.labels), np.nan)
+
+    @property
+    def result(self):
+        with self._lock:
+            return self._result.copy()
+
+    def window(self, shape):
+        """Return the region of an image to analyse, around the previous beam
+
+        Returns
+        -------
+        tuple of slice: the (rows, columns) slices of the region
+        """
+        height, width = shape
+        with self._lock:
+            x0, y0, d_major = self._result[:3]
+        if self.crop <= 0 or not np.isfinite(d_major) or d_major <= 0:
+            return slice(0, height), slice(0, width)
+        half = max(self.crop * d_major / 2, 8)
+        rows = slice(max(0, int(y0 - half)), min(height, int(np.ceil(y0 + half)) + 1))
+        columns = slice(max(0, int(x0 - half)), min(width, int(np.ceil(x0 + half)) + 1))
+        if rows.stop - rows.start < 8 or columns.stop - columns.start < 8:  # beam leaving the image
+            return slice(0, height), slice(0, width)
+        return rows, columns
+
+    def downsample(self, image: np.ndarray):
+        """Block-average an image down to max_size pixels along its largest dimension
+
+        Returns
+        -------
+        ndarray: the float downsampled image
+        int: the downsampling factor
+        """
+        factor = max(1, -(-max(image.shape) // max(1, int(self.max_size))))
+        if factor == 1:
+            return image.astype(float), 1
+        height, width = image.shape[0] // factor, image.shape[1] // factor
+        blocks = image[:height * factor, :width * factor].reshape(height, factor, width, factor)
+        return blocks.mean(axis=(1, 3)), factor
+
+    def analyse(self, channels):
+        """Compute the beam profile of an image, every N calls only
+
+        Parameters
+        ----------
+        channels: list of ndarray
+            the image channels (several ones, as RGB, are summed)
+
+        Returns
+        -------
+        ndarray: the profile channels, the latest result when the image is not analysed
+        """
+        if not self.available:
+            raise ImportError('laserbeamsize is needed for the beam profile analysis')
+        with self._lock:
+            due = self._count % max(1, int(self.every)) == 0
+            self._count += 1
+        if not due:
+            return self.result
+
+        rows, columns = self.window(channels[0].shape)
+        image, factor = self.downsample(channels[0][rows, columns])
+        for channel in channels[1:]:
+            image += self.downsample(channel[rows, columns])[0]
+
+        result = np.full(len(self.labels), np.nan)
+        try:
+            xc, yc, dx, dy, phi = lbs.beam_size(image)
+        except (ValueError, FloatingPointError, ZeroDivisionError):
+            xc = yc = dx = dy = phi = np.nan
+        if np.all(np.isfinite([xc, yc, dx, dy])) and max(dx, dy) > 0:
+            # back to pixels of the whole image, from the center of the averaged blocks
+            result[0] = columns.start + xc * factor + (factor - 1) / 2
+            result[1] = rows.start + yc * factor + (factor - 1) / 2
+            result[2] = max(dx, dy) * factor
+            result[3] = min(dx, dy) * factor
+            result[4] = result[3] / result[2]
+            result[5] = np.degrees(phi if dx >= dy else phi + np.pi / 2)
+        with self._lock:
+            self._result = result
+        return result.copy()
@@ -27,6 +27,9 @@ Installation:
   under the environment variable VXIPNPPATH or VXIPNPPATH64
   >>>import os
   >>>os.environ['VXIPNPPATH']
+
+The TLPM.py wrapper and its dll are only loaded when first needed (see load_tlpm), and the connected devices are
+listed by the discovery object, which caches the list for a few seconds.
 """
 
 import os
@@ -35,32 +38,50 @@ import importlib
 from pathlib import Path
 import ctypes
 import functools
+import threading
+from time import perf_counter
+
+import numpy as np
 
 from pymodaq.utils import daq_utils as utils
+from pymodaq.utils.daq_utils import ThreadCommand
 from pymodaq.utils.logger import set_logger, get_module_name
 logger = set_logger(get_module_name(__file__))
-if utils.is_64bits():
-    path_dll = str(Path(os.environ['VXIPNPPATH64']).joinpath('Win64', 'Bin'))
-else:
-    path_dll = str(Path(os.environ['VXIPNPPATH']).joinpath('WinNT', 'Bin'))
-os.add_dll_directory(path_dll)
+
+TLPM = None  # the TLPM.py wrapper module, once loaded
 
 
 def tlpm_path(tlpm: Path):
     return Path(os.environ['VXIPNPPATH']).joinpath('WinNT', 'TLPM', tlpm, 'Python')
 
 
-module_error = True
-for example_str in ['Example', 'Examples']:
+def load_tlpm():
+    """Locate and import the TLPM.py wrapper (and its dll) provided by Thorlabs, only the first time
+
+    Returns
+    -------
+    module: the TLPM wrapper module
+    """
+    global TLPM
+    if TLPM is not None:
+        return TLPM
     try:
-        path_python_wrapper = tlpm_path(example_str)
-        sys.path.insert(0, str(path_python_wrapper))
-        import TLPM
-        module_error = False
-        break
-    except ModuleNotFoundError as e:
-        pass
-if module_error:
+        if utils.is_64bits():
+            path_dll = str(Path(os.environ['VXIPNPPATH64']).joinpath('Win64', 'Bin'))
+        else:
+            path_dll = str(Path(os.environ['VXIPNPPATH']).joinpath('WinNT', 'Bin'))
+        os.add_dll_directory(path_dll)
+    except (KeyError, OSError, AttributeError) as e:
+        raise ModuleNotFoundError(f'The TLPM library could not be located on your system: {e}')
+
+    for example_str in ['Example', 'Examples']:
+        try:
+            path_python_wrapper = tlpm_path(example_str)
+            sys.path.insert(0, str(path_python_wrapper))
+            TLPM = importlib.import_module('TLPM')
+            return TLPM
+        except ModuleNotFoundError as e:
+            pass
     error = f"The *TLPM.py* python wrapper of thorlabs TLPM dll could not be located on your system. Check if present"\
             f" in one of these path:\n"\
             f"{tlpm_path('Example')}\n"\
@@ -97,24 +118,29 @@ class DeviceInfo:
 class GetInfos:
     def __init__(self, tlpm=None):
         if tlpm is None:
-            tlpm = TLPM.TLPM()
+            tlpm = load_tlpm().TLPM()
         self._tlpm = tlpm
         self._Ndevices = 0
+        # ctypes arguments of the enumeration, allocated once
+        self._count = ctypes.c_uint32()
+        self._name = ctypes.create_string_buffer(1024)
+        self._model = ctypes.create_string_buffer(1024)
+        self._serial = ctypes.create_string_buffer(1024)
+        self._manufacturer = ctypes.create_string_buffer(1024)
+        self._available = ctypes.c_int16()
 
     @error_handling(0)
     def get_connected_ressources_number(self):
-        deviceCount = ctypes.c_uint32()
-        self._tlpm.findRsrc(ctypes.byref(deviceCount))
-        self._Ndevices = deviceCount.value
+        self._tlpm.findRsrc(ctypes.byref(self._count))
+        self._Ndevices = self._count.value
         return self._Ndevices
 
     def get_devices_name(self):
         self.get_connected_ressources_number()
         names = []
-        resource_name = ctypes.create_string_buffer(1024)
         for ind in range(self._Ndevices):
-            self._tlpm.getRsrcName(ctypes.c_int(ind), resource_name)
-            names.append(resource_name.value.decode())
+            self._tlpm.getRsrcName(ctypes.c_int(ind), self._name)
+            names.append(self._name.value.decode())
         return names
 
     @error_handling(DeviceInfo())
@@ -122,94 +148,305 @@ class GetInfos:
         self.get_connected_ressources_number()
         if index >= self._Ndevices:
             return DeviceInfo()
-        modelName = ctypes.create_string_buffer(1024)
-        serialNumber = ctypes.create_string_buffer(1024)
-        manufacturer = ctypes.create_string_buffer(1024)
-        is_available = ctypes.c_int16()
-        self._tlpm.getRsrcInfo(index, modelName, serialNumber, manufacturer, ctypes.byref(is_available))
-        return DeviceInfo(modelName.value.decode(), serialNumber.value.decode(),
-                          manufacturer.value.decode(), bool(is_available.value))
+        self._tlpm.getRsrcInfo(index, self._model, self._serial, self._manufacturer, ctypes.byref(self._available))
+        return DeviceInfo(self._model.value.decode(), self._serial.value.decode(),
+                          self._manufacturer.value.decode(), bool(self._available.value))
+
 
+class TLPMDiscovery:
+    """Cached list of the connected devices, enumerated again when older than ttl seconds or on request
 
-infos = GetInfos()
-Ndevices = infos.get_connected_ressources_number()
-DEVICE_NAMES = infos.get_devices_name()
+    Parameters
+    ----------
+    ttl: float
+        time to live of the list (s)
+    """
+
+    def __init__(self, ttl: float = 5.):
+        self.ttl = ttl
+        self._infos: GetInfos = None
+        self._names: list = None
+        self._tick = 0.
+        self._lock = threading.Lock()
+
+    @property
+    def infos(self):
+        """The GetInfos of the discovery TLPM session, created at first use"""
+        if self._infos is None:
+            self._infos = GetInfos()
+        return self._infos
+
+    def device_names(self, refresh: bool = False):
+        """Return the resource names of the connected devices
+
+        Parameters
+        ----------
+        refresh: bool
+            if True, enumerate the devices again whatever the age of the cached list
+        """
+        with self._lock:
+            now = perf_counter()
+            if refresh or self._names is None or now - self._tick > self.ttl:
+                self._names = self.infos.get_devices_name()
+                self._tick = now
+            return list(self._names)
+
+    def device_index(self, name: str):
+        """Return the index of a device from its resource name, enumerating again if it is not found"""
+        names = self.device_names()
+        if name not in names:
+            names = self.device_names(refresh=True)
+        return names.index(name)
+
+    def device_info(self, index: int):
+        with self._lock:
+            return self.infos.get_devices_info(index)
+
+
+discovery = TLPMDiscovery()
+
+
+class TLPMDevicesMixin:
+    """Fill the devices parameter of the TLPM plugins from the discovery
+
+    The device lists of the plugin parameters are empty at class level, so that importing a plugin does not load the
+    TLPM library: they are filled when the plugin is created and on request (refresh_devices).
+    """
+
+    def update_devices(self, refresh=False):
+        """Fill the list of devices from the (cached) discovery, keeping the selected ones still connected"""
+        try:
+            names = discovery.device_names(refresh)
+        except Exception as e:  # TLPM library not found for instance
+            self.emit_status(ThreadCommand('Update_Status', [str(e), 'log']))
+            return
+        param = self.settings.child('devices')
+        if param.type() == 'itemselect':
+            selected = [name for name in param.value()['selected'] if name in names] or names[:2]
+            param.setValue(dict(all_items=names, selected=selected))
+        else:
+            selected = param.value()
+            param.setLimits(names)
+            if selected in names:
+                param.setValue(selected)
+
+
+def __getattr__(name):
+    # module attributes of the previous versions, now computed when requested
+    if name == 'DEVICE_NAMES':
+        return discovery.device_names()
+    if name == 'Ndevices':
+        return len(discovery.device_names())
+    raise AttributeError(f'module {__name__} has no attribute {name}')
 
 
 class CustomTLPM:
     def __init__(self, index=None):
         super().__init__()
         self._index = index
-        self._tlpm = TLPM.TLPM()
+        self._tlpm = load_tlpm().TLPM()
         self.infos = GetInfos(self._tlpm)
+        self.resource_name = ''  # of the opened device
+        # ctypes arguments allocated once and reused by each call instead of a new ctypes value each time
+        self._power = ctypes.c_double()
+        self._power_ref = ctypes.byref(self._power)
+        self._resource = ctypes.create_string_buffer(1024)
+        self._message = ctypes.create_string_buffer(1024)
+        self._count = ctypes.c_int16()
+        self._wavelength = ctypes.c_double()
+        self._wavelength_max = ctypes.c_double()
 
     def __enter__(self):
-        device_name = self.infos.get_devices_name()[self._index]
-        self.open(device_name)
+        self.open_by_index()
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.close()
 
     def open_by_index(self, index=None):
+        """Open a device from its index in the (cached) list of the discovery, see TLPMDiscovery
+
+        Returns
+        -------
+        bool: False if the device could not be opened
+        """
         if index is not None:
             self._index = index
-        device_name = self.infos.get_devices_name()[self._index]
-        self.open(device_name)
+        return self.open(discovery.device_names()[self._index])
 
     @error_handling(False)
     def open(self, resource_name: str, id_query=True, reset=True):
-        resource = ctypes.create_string_buffer(1024)
-        resource.value = resource_name.encode()
-        id_query = ctypes.c_bool(id_query)
-        reset = ctypes.c_bool(reset)
-        self._tlpm.open(resource, id_query, reset)
+        self._resource.value = resource_name.encode()
+        self._tlpm.open(self._resource, ctypes.c_bool(id_query), ctypes.c_bool(reset))
+        self.resource_name = resource_name
         return True
 
     @error_handling()
     def close(self):
         self._tlpm.close()
+        self.resource_name = ''
 
     @error_handling('')
     def get_calibration(self):
-        message = ctypes.create_string_buffer(1024)
-        self._tlpm.getCalibrationMsg(message)
-        return message.value.decode()
+        self._tlpm.getCalibrationMsg(self._message)
+        return self._message.value.decode()
 
     @error_handling(0.)
     def get_power(self):
-        power = ctypes.c_double()
-        self._tlpm.measPower(ctypes.byref(power))
-        return power.value
+        self._tlpm.measPower(self._power_ref)
+        return self._power.value
+
+    def read_power_into(self, out: np.ndarray, index: int = 0):
+        """Measure the power into an element of a preallocated array, errors are raised
+
+        Parameters
+        ----------
+        out: ndarray
+            float array receiving the measurement
+        index: int
+            index of the element of out receiving the measurement
+        """
+        self._tlpm.measPower(self._power_ref)
+        out[index] = self._power.value
+
+    def read_powers(self, out: np.ndarray):
+        """Fill an array with successive power measurements, taken back to back
+
+        Parameters
+        ----------
+        out: ndarray
+            preallocated float array, its size is the number of measurements
+
+        Returns
+        -------
+        ndarray: out, NaN from the first failed measurement on
+        """
+        for ind in range(out.size):
+            try:
+                self.read_power_into(out, ind)
+            except Exception as e:
+                logger.debug(f'The function measPower returned the error: {e}')
+                out[ind:] = np.nan
+                break
+        return out
+
+    def read_batch(self, count: int):
+        """Take count successive power measurements, see read_powers
+
+        Returns
+        -------
+        ndarray: the powers (W), NaN from the first failed measurement on
+        """
+        return self.read_powers(np.empty((count,)))
+
+    @property
+    @error_handling(1)
+    def average_count(self):
+        """Number of samples averaged by the console for each measurement"""
+        self._tlpm.getAvgCnt(ctypes.byref(self._count))
+        return self._count.value
+
+    @average_count.setter
+    @error_handling()
+    def average_count(self, count: int):
+        self._count.value = count
+        self._tlpm.setAvgCnt(self._count)
 
     @property
     @error_handling((500, 800))
     def wavelength_range(self):
-        wavelength_min = ctypes.c_double()
-        wavelength_max = ctypes.c_double()
-
-        self._tlpm.getWavelength(TLPM.TLPM_ATTR_MIN_VAL, ctypes.byref(wavelength_min))
-        self._tlpm.getWavelength(TLPM.TLPM_ATTR_MAX_VAL, ctypes.byref(wavelength_max))
-        return wavelength_min.value, wavelength_max.value
+        self._tlpm.getWavelength(TLPM.TLPM_ATTR_MIN_VAL, ctypes.byref(self._wavelength))
+        self._tlpm.getWavelength(TLPM.TLPM_ATTR_MAX_VAL, ctypes.byref(self._wavelength_max))
+        return self._wavelength.value, self._wavelength_max.value
 
     @property
     @error_handling(-1)
     def wavelength(self):
-        wavelength = ctypes.c_double()
-        self._tlpm.getWavelength(TLPM.TLPM_ATTR_SET_VAL, ctypes.byref(wavelength))
-        return wavelength.value
+        self._tlpm.getWavelength(TLPM.TLPM_ATTR_SET_VAL, ctypes.byref(self._wavelength))
+        return self._wavelength.value
 
     @wavelength.setter
     @error_handling()
     def wavelength(self, wavelength: float):
-        wavelength = ctypes.c_double(wavelength)
-        self._tlpm.setWavelength(wavelength)
+        self._wavelength.value = wavelength
+        self._tlpm.setWavelength(self._wavelength)
+
+
+class PowerStream:
+    """Read a power meter continuously in a background thread into a ring buffer of (timestamp, power) samples
+
+    Parameters
+    ----------
+    tlpm: CustomTLPM
+        the opened power meter. Other calls to it must hold the lock of the stream while it runs
+    rate: float
+        maximum sampling rate (Hz), 0 to read as fast as the meter answers
+    size: int
+        number of samples kept in the ring buffer, older ones are overwritten
+    """
+
+    def __init__(self, tlpm: CustomTLPM, rate: float = 100., size: int = 10000):
+        self.tlpm = tlpm
+        self.rate = rate
+        self.size = max(1, int(size))
+        self.lock = threading.Lock()  # held during each measurement
+        self.overwritten = 0  # samples overwritten before being read
+        self._times = np.zeros((self.size,))
+        self._powers = np.zeros((self.size,))
+        self._written = 0  # total number of samples written
+        self._read = 0  # total number of samples read
+        self._buffer_lock = threading.Lock()
+        self._new_sample = threading.Condition(self._buffer_lock)
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        sample = np.zeros((1,))  # the reader may be copying any sample of the ring buffer during a measurement
+        next_tick = perf_counter()
+        while not self._stopped.is_set():
+            try:
+                with self.lock:
+                    self.tlpm.read_power_into(sample)
+                    timestamp = perf_counter()
+            except Exception as e:
+                logger.debug(f'The function measPower returned the error: {e}')
+                self._stopped.wait(0.1)
+                continue
+            with self._new_sample:
+                index = self._written % self.size
+                self._times[index] = timestamp
+                self._powers[index] = sample[0]
+                self._written += 1
+                self._new_sample.notify_all()
+            if self.rate > 0:
+                next_tick = max(next_tick + 1 / self.rate, timestamp)
+                self._stopped.wait(next_tick - perf_counter())
+
+    def read(self, timeout: float = 1.):
+        """Return the samples written since the previous call, waiting for one if there are none yet
+
+        Returns
+        -------
+        ndarray: the timestamps (s, perf_counter clock), oldest first
+        ndarray: the powers (W)
+        """
+        with self._new_sample:
+            self._new_sample.wait_for(lambda: self._written > self._read, timeout)
+            start = max(self._read, self._written - self.size)
+            self.overwritten += start - self._read
+            indexes = np.arange(start, self._written) % self.size
+            self._read = self._written
+            return self._times[indexes], self._powers[indexes]
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
 
 
 if __name__ == '__main__':
     from time import sleep
-    print(Ndevices)
-    print(DEVICE_NAMES)
+    print(discovery.device_names())
 
     with CustomTLPM(0) as tlpm:
         print(tlpm.wavelength)
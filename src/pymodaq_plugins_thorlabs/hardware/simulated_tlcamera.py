@@ -0,0 +1,371 @@
+"""
+Simulated Thorlabs scientific camera
+
+Drop-in replacement of pylablib's ThorlabsTLCamera implementing the calls used by the TSI plugins, so that they can
+be run and profiled without a camera attached (and on platforms without the ThorCam SDK). Frames are produced at a
+configurable rate from the time elapsed since the acquisition started, with the same ring buffer semantics as the
+real driver: frames not read before being overwritten are counted as skipped.
+
+Triggered acquisitions are simulated as well: software triggers start a burst of frames_per_trigger frames, and
+external trigger pulses are simulated at a fixed rate. As on the camera, triggers arriving during a burst are ignored.
+
+Simulated cameras are listed along with the real ones when enabled in the plugin configuration file:
+
+[TLCamera]
+simulated = true
+"""
+import threading
+from time import perf_counter, sleep
+
+import numpy as np
+from pylablib.devices import Thorlabs
+from pylablib.devices.Thorlabs.TLCamera import TDeviceInfo, TFrameInfo
+from pylablib.devices.interface.camera import TFramesStatus
+
+
+class SimulatedTLCamera:
+    """Synthetic Thorlabs scientific camera
+
+    Parameters
+    ----------
+    serial: str
+        one of the serial numbers returned by serial_numbers, defines the simulated pattern
+    sensor: str
+        either 'Bayer' or 'Monochrome'
+    width: int
+        number of pixels of the sensor along x
+    height: int
+        number of pixels of the sensor along y
+    frame_rate: float
+        maximum frame rate in Hz, the actual rate is also limited by the exposure time
+    bit_depth: int
+        number of bits of the pixel values
+    nbank: int
+        number of different frames generated in advance and played in turn
+    ext_trigger_rate: float
+        rate of the simulated external trigger pulses in Hz
+    """
+    patterns = ['Spot', 'Autocorrelation']
+    serial_prefix = 'Simulated '
+    TimeoutError = Thorlabs.ThorlabsTLCameraTimeoutError
+    Error = Thorlabs.ThorlabsTLCameraError
+
+    def __init__(self, serial: str = 'Simulated Spot', sensor: str = 'Bayer', width: int = 1440, height: int = 1080,
+                 frame_rate: float = 30., bit_depth: int = 10, nbank: int = 8, ext_trigger_rate: float = 10.):
+        if not self.is_simulated(serial):
+            raise ValueError(f'{serial} is not the serial number of a simulated camera')
+        self.serial = serial
+        self.pattern = serial[len(self.serial_prefix):]
+        if self.pattern not in self.patterns:
+            raise ValueError(f'Unknown simulated pattern {self.pattern}, should be one of {self.patterns}')
+        self.sensor = sensor
+        self.frame_rate = frame_rate
+        self.bit_depth = bit_depth
+        self.nbank = max(1, int(nbank))
+        self.ext_trigger_rate = ext_trigger_rate
+        self._detector_size = (width, height)
+
+        self._exposure = 1e-3
+        self._roi = (0, width, 0, height, 1, 1)
+        self._bank: np.ndarray = None
+        self._rng = np.random.default_rng(0)
+
+        self._nframes = 100  # ring buffer size
+        self._setup = False
+        self._armed = False
+        self._t0 = 0.
+        self._acquired = 0
+        self._read = 0
+        self._skipped = 0
+        self._last_wait = 0
+        self._trigger_mode = 'int'
+        self._trigger_polarity = 'rise'
+        self._frames_per_trigger = None  # None for a free running acquisition
+        self._auto_start = True
+        self._triggers = []  # start times of the bursts
+        self._next_pulse = 0.
+        self._lock = threading.Lock()
+
+    @classmethod
+    def serial_numbers(cls):
+        return [f'{cls.serial_prefix}{pattern}' for pattern in cls.patterns]
+
+    @classmethod
+    def is_simulated(cls, serial: str):
+        return str(serial).startswith(cls.serial_prefix)
+
+    # Device
+    def open(self):
+        pass
+
+    def close(self):
+        self.clear_acquisition()
+
+    def is_opened(self):
+        return True
+
+    def get_device_info(self):
+        return TDeviceInfo('SIMULATED', f'Simulated TLCamera ({self.pattern})', self.serial, '')
+
+    # Exposure and timings
+    def get_exposure(self):
+        return self._exposure
+
+    def set_exposure(self, exposure):
+        with self._lock:
+            self._restart_clock()
+            self._exposure = max(float(exposure), 1e-6)
+        return self.get_exposure()
+
+    def get_frame_period(self):
+        return max(1 / self.frame_rate, self._exposure)
+
+    def get_timestamp_clock_frequency(self):
+        """Frame timestamps (pixelclock field of the frame info) are given in ns"""
+        return 1e9
+
+    # Trigger
+    def get_trigger_mode(self):
+        return self._trigger_mode
+
+    def set_trigger_mode(self, mode):
+        if mode not in ['int', 'ext', 'bulb']:
+            raise ValueError(f'Unknown trigger mode {mode}')
+        self.clear_acquisition()
+        self._trigger_mode = mode
+        return self.get_trigger_mode()
+
+    def get_ext_trigger_parameters(self):
+        return self._trigger_polarity
+
+    def setup_ext_trigger(self, polarity):
+        if polarity not in ['rise', 'fall']:
+            raise ValueError(f'Unknown trigger polarity {polarity}')
+        self._trigger_polarity = polarity
+        return self.get_ext_trigger_parameters()
+
+    def send_software_trigger(self):
+        with self._lock:
+            if self._armed and self._trigger_mode == 'int' and self._frames_per_trigger is not None:
+                self._trigger(perf_counter())
+
+    def _trigger(self, now):
+        """Start a new burst, unless the previous one is still running"""
+        if not self._triggers or now >= self._triggers[-1] + self._frames_per_trigger * self.get_frame_period():
+            self._triggers.append(now)
+
+    # ROI
+    def get_detector_size(self):
+        return self._detector_size
+
+    def get_roi(self):
+        return self._roi
+
+    def set_roi(self, hstart=0, hend=None, vstart=0, vend=None, hbin=1, vbin=1):
+        wdet, hdet = self._detector_size
+        hbin, vbin = max(1, int(hbin)), max(1, int(vbin))
+        hend = wdet if hend is None else min(int(hend), wdet)
+        vend = hdet if vend is None else min(int(vend), hdet)
+        hstart, vstart = max(0, min(int(hstart), hend - hbin)), max(0, min(int(vstart), vend - vbin))
+        # as on the real camera, the ROI is a whole number of binned pixels
+        hend = hstart + max(1, (hend - hstart) // hbin) * hbin
+        vend = vstart + max(1, (vend - vstart) // vbin) * vbin
+        # as pylablib, acquisition is cleared while applying the ROI and set up (and restarted) again afterwards
+        setup, armed = self._setup, self._armed
+        self.clear_acquisition()
+        self._roi = (hstart, hend, vstart, vend, hbin, vbin)
+        self._bank = None
+        if setup:
+            self.setup_acquisition(self._nframes)
+        if armed:
+            self.start_acquisition(self._frames_per_trigger, self._auto_start)
+        return self.get_roi()
+
+    def get_data_dimensions(self):
+        hstart, hend, vstart, vend, hbin, vbin = self._roi
+        return (vend - vstart) // vbin, (hend - hstart) // hbin
+
+    # Acquisition
+    def setup_acquisition(self, nframes=100):
+        self._nframes = max(1, int(nframes))
+        self._setup = True
+
+    def clear_acquisition(self):
+        self.stop_acquisition()
+        self._setup = False
+
+    def start_acquisition(self, frames_per_trigger='default', auto_start=True, nframes=None):
+        self.stop_acquisition()
+        if nframes is not None or not self._setup:
+            self.setup_acquisition(nframes or self._nframes)
+        if self._bank is None:
+            self._bank = self._make_bank()
+        if frames_per_trigger == 'default':
+            frames_per_trigger = None if self._trigger_mode == 'int' else 1
+        with self._lock:
+            self._frames_per_trigger = frames_per_trigger or None
+            self._auto_start = auto_start
+            self._acquired = self._read = self._skipped = self._last_wait = 0
+            self._triggers = []
+            self._restart_clock()
+            self._next_pulse = self._t0 + 1 / self.ext_trigger_rate
+            if self._triggered and self._trigger_mode == 'int' and auto_start:
+                self._trigger(self._t0)
+            self._armed = True
+
+    @property
+    def _triggered(self):
+        return self._frames_per_trigger is not None or self._trigger_mode != 'int'
+
+    def stop_acquisition(self):
+        with self._lock:
+            if self._armed:
+                self._update()
+                self._armed = False
+
+    def acquisition_in_progress(self):
+        return self._armed
+
+    def _restart_clock(self):
+        """Keep the frames already acquired when the frame period changes"""
+        if self._armed:
+            self._update()
+            if self._triggered:  # frames are timed from the triggers
+                return
+        self._t0 = perf_counter() - self._acquired * self.get_frame_period()
+
+    def _update(self):
+        """Update the acquired frames counter and drop the frames overwritten in the ring buffer"""
+        if self._armed:
+            self._acquired = self._count_acquired(perf_counter())
+        oldest = self._acquired - self._nframes
+        if self._read < oldest:
+            self._skipped += oldest - self._read
+            self._read = oldest
+
+    def _count_acquired(self, now):
+        period = self.get_frame_period()
+        if not self._triggered:
+            return int((now - self._t0) / period)
+        if self._trigger_mode != 'int':  # simulated external pulses
+            while self._next_pulse <= now:
+                self._trigger(self._next_pulse)
+                self._next_pulse += 1 / self.ext_trigger_rate
+        if not self._triggers:
+            return 0
+        nburst = self._frames_per_trigger or 1
+        return (len(self._triggers) - 1) * nburst + min(nburst, int((now - self._triggers[-1]) / period))
+
+    def _frame_time(self, index: int):
+        """Time of the end of exposure of a frame, from the start of the acquisition"""
+        period = self.get_frame_period()
+        if not self._triggered:
+            return (index + 1) * period
+        nburst = self._frames_per_trigger or 1
+        return self._triggers[index // nburst] - self._t0 + (index % nburst + 1) * period
+
+    def get_frames_status(self):
+        with self._lock:
+            self._update()
+            return TFramesStatus(self._acquired, self._acquired - self._read, self._skipped, self._nframes)
+
+    def get_new_images_range(self):
+        with self._lock:
+            self._update()
+            return (self._read, self._acquired) if self._acquired > self._read else None
+
+    def wait_for_frame(self, since='lastread', nframes=1, timeout=20., error_on_stopped=False):
+        if not self._armed:
+            if error_on_stopped:
+                raise self.Error('waiting for a frame while acquisition is stopped')
+            return False
+        with self._lock:
+            self._update()
+            if since == 'lastread':
+                target = self._read + nframes
+            elif since == 'lastwait':
+                target = self._last_wait + nframes
+            elif since == 'now':
+                target = self._acquired + nframes
+            else:
+                target = nframes
+        t_end = None if timeout is None else perf_counter() + timeout
+        while True:
+            if not self._armed:  # acquisition stopped from another thread
+                return False
+            with self._lock:
+                self._update()
+                if self._acquired >= target:
+                    self._last_wait = self._acquired
+                    return True
+                if self._triggered:
+                    wait = 0.001
+                else:
+                    wait = self._t0 + target * self.get_frame_period() - perf_counter()
+            if t_end is not None and perf_counter() >= t_end:
+                raise self.TimeoutError
+            sleep(min(max(wait, 0.), 0.01))
+
+    # Frames
+    def read_multiple_images(self, rng=None, peek=False, missing_frame='skip', return_info=False, return_rng=False):
+        with self._lock:
+            if self._bank is None:
+                result = (None, None, None)
+            else:
+                self._update()
+                first, last = (self._read, self._acquired) if rng is None else rng
+                first, last = max(first, self._acquired - self._nframes), min(last, self._acquired)
+                indexes = range(first, max(first, last))
+                frames = [self._frame(ind) for ind in indexes]
+                infos = [TFrameInfo(ind, ind, int(self._frame_time(ind) * 1e9), 0, 0) for ind in indexes]
+                if not peek:
+                    self._read = max(self._read, indexes.stop)
+                result = (frames, infos, (indexes.start, indexes.stop))
+        result = tuple(res for res, inc in zip(result, [True, return_info, return_rng]) if inc)
+        return result[0] if len(result) == 1 else result
+
+    def read_newest_image(self, peek=False, return_info=False):
+        rng = self.get_new_images_range()
+        if rng is None:
+            return None
+        frames, infos = self.read_multiple_images(rng=(rng[1] - 1, rng[1]), peek=peek, return_info=True)
+        if not frames:
+            return None
+        if not peek:
+            with self._lock:
+                self._read = max(self._read, rng[1])
+        return (frames[0], infos[0]) if return_info else frames[0]
+
+    def _frame(self, index: int):
+        return self._bank[index % self.nbank].copy()
+
+    def _make_bank(self):
+        """Generate the frames played in turn for the current ROI"""
+        hstart, hend, vstart, vend, hbin, vbin = self._roi
+        wdet, hdet = self._detector_size
+        # centers of the (binned) pixels in sensor coordinates
+        x = hstart + (np.arange((hend - hstart) // hbin) + 0.5) * hbin
+        y = vstart + (np.arange((vend - vstart) // vbin) + 0.5) * vbin
+        xx, yy = np.meshgrid(x, y)
+
+        if self.sensor.lower() == 'bayer':  # BG pattern, blue and red pixels less sensitive than green ones
+            cfa = np.array([[0.6, 1.], [1., 0.8]])[(yy // vbin).astype(int) % 2, (xx // hbin).astype(int) % 2]
+        else:
+            cfa = 1.
+
+        max_value = 2 ** self.bit_depth - 1
+        bank = np.empty((self.nbank,) + xx.shape, dtype=np.uint16)
+        for ind in range(self.nbank):
+            x0, y0 = wdet / 2 + self._rng.normal(0, wdet / 200), hdet / 2 + self._rng.normal(0, hdet / 200)
+            if self.pattern == 'Spot':
+                w = min(wdet, hdet) / 8
+                image = np.exp(-2 * ((xx - x0) ** 2 + (yy - y0) ** 2) / w ** 2)
+            else:
+                # single shot autocorrelation trace: a horizontal band, gaussian along x with interference fringes
+                band = np.exp(-((yy - y0) / (hdet / 20)) ** 2)
+                envelope = np.exp(-((xx - x0) / (wdet / 10)) ** 2)
+                image = band * envelope * (1 + 0.3 * np.cos(2 * np.pi * xx / 6))
+            image = 0.02 + 0.75 * image * cfa
+            image += self._rng.normal(0, 0.01, image.shape)
+            bank[ind] = np.clip(image * max_value, 0, max_value)
+        return bank
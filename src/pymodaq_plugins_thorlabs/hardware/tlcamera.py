@@ -0,0 +1,717 @@
+"""
+Helpers around the pylablib ThorlabsTLCamera driver used by the Thorlabs scientific camera plugins
+(Zelux, Kiralux, Quantalux).
+
+These objects only deal with numpy arrays and the pylablib camera API so that the acquisition path can be shared
+between DAQ_2DViewer_Thorlabs_TSI and its subclasses.
+"""
+from concurrent.futures import ThreadPoolExecutor, CancelledError
+from pathlib import Path
+import queue
+import threading
+from time import perf_counter
+
+import cv2
+import numpy as np
+from pylablib.devices import Thorlabs
+
+try:
+    import h5py
+except ImportError:  # only needed to record frames in HDF5 files
+    h5py = None
+
+from pymodaq_plugins_thorlabs.utils import Config
+from pymodaq_plugins_thorlabs.hardware.simulated_tlcamera import SimulatedTLCamera
+
+config = Config()
+
+
+def list_cameras():
+    """Return the serial numbers of the connected cameras, followed by the simulated ones if enabled in the config"""
+    try:
+        serial_numbers = list(Thorlabs.list_cameras_tlcam())
+    except (OSError, Thorlabs.ThorlabsTLCameraError):  # ThorCam SDK not available on this system
+        serial_numbers = []
+    if config('TLCamera', 'simulated'):
+        serial_numbers += SimulatedTLCamera.serial_numbers()
+    return serial_numbers
+
+
+def open_camera(serial_number: str):
+    """Open the camera with the given serial number, either a real or a simulated one"""
+    if SimulatedTLCamera.is_simulated(serial_number):
+        return SimulatedTLCamera(serial_number, **config('TLCamera', 'simulation'))
+    return Thorlabs.ThorlabsTLCamera(serial_number)
+
+
+class RoiPresets:
+    """Named ROI and binning presets of the TLCamera, saved in the plugin configuration file
+
+    Presets are stored in the [TLCamera.roi_presets] section with the pylablib layout:
+    (hstart, hend, vstart, vend, hbin, vbin), in unbinned sensor pixels.
+    """
+
+    def __init__(self, config: Config):
+        self.config = config
+
+    def _presets(self):
+        return self.config('TLCamera', 'roi_presets')
+
+    def names(self):
+        return list(self._presets())
+
+    def get(self, name: str):
+        return tuple(int(value) for value in self._presets()[name])
+
+    def save(self, name: str, roi):
+        self.config['TLCamera', 'roi_presets', name] = [int(value) for value in roi]
+        self.config.save()
+
+    def delete(self, name: str):
+        self._presets().pop(name, None)
+        self.config.save()
+
+
+class FrameRing:
+    """Preallocated stacks of frames the camera buffer is drained into
+
+    The frames read at each wakeup are copied into the next of a few preallocated stacks and returned together as a
+    view of it. There are two stacks, so that the batch emitted at one wakeup is not overwritten while the next one
+    is being read, plus some spare stacks for batches still queued for processing.
+
+    Parameters
+    ----------
+    depth: int
+        maximum number of frames read from the camera buffer at each wakeup
+    spare: int
+        number of additional stacks
+    """
+
+    def __init__(self, depth: int = 10, spare: int = 0):
+        self.depth = max(1, int(depth))
+        self.spare = max(0, int(spare))
+        self._stacks: np.ndarray = None
+        self._index = 0
+        self.dropped = 0
+
+    @property
+    def shape(self):
+        return None if self._stacks is None else self._stacks.shape[2:]
+
+    def allocate(self, shape, dtype=np.uint16):
+        """(Re)allocate the stacks for frames of the given shape and dtype, does nothing if already done"""
+        shape = (2 + self.spare, self.depth) + tuple(shape)
+        if self._stacks is None or self._stacks.shape != shape or self._stacks.dtype != dtype:
+            self._stacks = np.empty(shape, dtype=dtype)
+            self._index = 0
+
+    def set_depth(self, depth: int = None, spare: int = None):
+        if depth is not None:
+            self.depth = max(1, int(depth))
+        if spare is not None:
+            self.spare = max(0, int(spare))
+        if self._stacks is not None:
+            shape, dtype = self._stacks.shape[2:], self._stacks.dtype
+            self._stacks = None
+            self.allocate(shape, dtype)
+
+    def reset_counters(self):
+        self.dropped = 0
+
+    def fill(self, frames):
+        """Copy the newest frames of a batch into the next stack
+
+        Frames beyond the depth are the oldest ones of the batch, they are discarded and counted as dropped.
+
+        Parameters
+        ----------
+        frames: list of ndarray or ndarray
+            the frames returned by the camera, oldest first
+
+        Returns
+        -------
+        ndarray: view of the stack holding the frames, oldest first along the first axis
+        """
+        nframes = len(frames)
+        if nframes > self.depth:
+            self.dropped += nframes - self.depth
+            frames = frames[nframes - self.depth:]
+            nframes = self.depth
+        if self._stacks is None or np.shape(frames[0]) != self.shape:
+            self.allocate(np.shape(frames[0]), frames[0].dtype)
+        stack = self._stacks[self._index, :nframes]
+        for slot, frame in zip(stack, frames):
+            np.copyto(slot, frame, casting='unsafe')
+        self._index = (self._index + 1) % self._stacks.shape[0]
+        return stack
+
+
+class BayerDemosaic:
+    """Bayer to RGB or grey conversion writing into preallocated output buffers
+
+    Output buffers are allocated once for the current frame shape (which depends on ROI and binning) and reused,
+    cv2 writing directly into them through its ``dst`` argument. A few buffers are used in turn so that a frame being
+    processed is not overwritten by the conversion of the next ones, in the other processing threads. The outputs
+    are to be copied when emitted, as the emitted data may be read at any later time. The buffers of the last few
+    shapes are kept so that switching back and forth between ROIs does not reallocate them.
+
+    Parameters
+    ----------
+    nbuffers: int
+        number of output buffers used in turn
+    ncached: int
+        number of frame shapes whose buffers are kept
+    """
+    RGB_CODE = cv2.COLOR_BAYER_BG2RGB
+    GREY_CODE = cv2.COLOR_BAYER_BG2GRAY
+
+    def __init__(self, nbuffers: int = 4, ncached: int = 4):
+        self.nbuffers = max(1, int(nbuffers))
+        self.ncached = max(1, int(ncached))
+        self._rgb: np.ndarray = None
+        self._grey: np.ndarray = None
+        self._cache = {}  # (shape, dtype) -> (rgb, grey), least recently used first
+        self._index = 0
+        self._lock = threading.Lock()  # conversions may run from several processing threads
+
+    def allocate(self, shape, dtype=np.uint16):
+        """(Re)allocate the output buffers for raw frames of the given shape, does nothing if already done"""
+        shape = tuple(shape)
+        with self._lock:
+            if self._rgb is None or self._rgb.shape != (self.nbuffers,) + shape + (3,) or self._rgb.dtype != dtype:
+                key = (shape, np.dtype(dtype))
+                buffers = self._cache.pop(key, None)
+                if buffers is None or buffers[0].shape[0] != self.nbuffers:
+                    buffers = (np.empty((self.nbuffers,) + shape + (3,), dtype=dtype),
+                               np.empty((self.nbuffers,) + shape, dtype=dtype))
+                self._cache[key] = buffers
+                while len(self._cache) > self.ncached:
+                    self._cache.pop(next(iter(self._cache)))
+                self._rgb, self._grey = buffers
+                self._index = 0
+
+    def set_nbuffers(self, nbuffers: int):
+        self.nbuffers = max(1, int(nbuffers))
+        if self._rgb is not None:
+            self.allocate(self._rgb.shape[1:3], self._rgb.dtype)
+
+    def _next_index(self, frame: np.ndarray):
+        self.allocate(frame.shape, frame.dtype)
+        with self._lock:
+            index = self._index
+            self._index = (self._index + 1) % self.nbuffers
+        return index
+
+    def rgb(self, frame: np.ndarray):
+        """Demosaic a raw Bayer frame
+
+        Returns
+        -------
+        list of ndarray: the red, green and blue planes as views of the output buffer
+        """
+        index = self._next_index(frame)
+        rgb_image = self._rgb[index]
+        cv2.cvtColor(frame, self.RGB_CODE, dst=rgb_image)
+        return [rgb_image[..., ind] for ind in range(3)]
+
+    def grey(self, frame: np.ndarray):
+        """Convert a raw Bayer frame to grey levels
+
+        Returns
+        -------
+        ndarray: a view of the output buffer
+        """
+        index = self._next_index(frame)
+        grey_image = self._grey[index]
+        cv2.cvtColor(frame, self.GREY_CODE, dst=grey_image)
+        return grey_image
+
+
+class FrameAverager:
+    """Streaming average of camera frames into a single float32 accumulator
+
+    In "Block" mode, navg frames are summed as they arrive and the average is available once they have all been
+    added. In "Running" mode, the accumulator is an exponential running mean with a weight of 1/navg, available
+    after each new frame. Averaged frames are returned in a few output buffers used in turn.
+
+    Parameters
+    ----------
+    navg: int
+        number of frames to average
+    mode: str
+        either 'Block' or 'Running'
+    nbuffers: int
+        number of output buffers used in turn
+    """
+    modes = ['Block', 'Running']
+
+    def __init__(self, navg: int = 1, mode: str = 'Block', nbuffers: int = 2):
+        self.nbuffers = max(1, int(nbuffers))
+        self.navg = 1
+        self.mode = mode
+        self.count = 0
+        self._acc: np.ndarray = None
+        self._tmp: np.ndarray = None
+        self._out: np.ndarray = None
+        self._out_index = 0
+        self.reset(navg, mode)
+
+    @property
+    def active(self):
+        """True if frames have to go through the accumulator"""
+        return self.navg > 1
+
+    @property
+    def done(self):
+        """True if an averaged frame is available"""
+        if self.mode == 'Running':
+            return self.count > 0
+        return self.count >= self.navg
+
+    def reset(self, navg: int = None, mode: str = None):
+        """Restart the averaging, optionally with a new number of frames and mode"""
+        if navg is not None:
+            self.navg = max(1, int(navg))
+        if mode is not None:
+            if mode not in self.modes:
+                raise ValueError(f'Unknown averaging mode {mode}, should be one of {self.modes}')
+            self.mode = mode
+        self.count = 0
+
+    def _allocate(self, shape):
+        if self._acc is None or self._acc.shape != shape:
+            self._acc = np.zeros(shape, dtype=np.float32)
+            self._tmp = np.zeros(shape, dtype=np.float32)
+            self.count = 0
+
+    def add(self, frame: np.ndarray):
+        """Add a frame to the accumulator, frames arriving once a block is complete are ignored
+
+        Returns
+        -------
+        bool: True if an averaged frame is available
+        """
+        self._allocate(frame.shape)
+        if self.count == 0:
+            np.copyto(self._acc, frame, casting='unsafe')
+        elif self.mode == 'Running':
+            # acc += (frame - acc) / navg without temporary arrays
+            np.subtract(frame, self._acc, out=self._tmp, casting='unsafe')
+            self._tmp *= 1 / min(self.count + 1, self.navg)
+            self._acc += self._tmp
+        elif self.count < self.navg:
+            np.add(self._acc, frame, out=self._acc, casting='unsafe')
+        else:
+            return True
+        self.count += 1
+        return self.done
+
+    def mean(self, dtype=np.float32):
+        """Return the averaged frame
+
+        Parameters
+        ----------
+        dtype: numpy dtype
+            type of the returned frame. Integer types are rounded, which is needed for instance to demosaic an
+            averaged raw Bayer frame
+
+        Returns
+        -------
+        ndarray: the averaged frame, a buffer reused after nbuffers calls
+        """
+        if self._out is None or self._out.shape != (self.nbuffers,) + self._acc.shape or self._out.dtype != dtype:
+            self._out = np.empty((self.nbuffers,) + self._acc.shape, dtype=dtype)
+            self._out_index = 0
+        out = self._out[self._out_index]
+        self._out_index = (self._out_index + 1) % self.nbuffers
+        if self.mode == 'Running':
+            np.copyto(self._tmp, self._acc)
+        else:
+            np.multiply(self._acc, 1 / self.count, out=self._tmp)
+        if np.issubdtype(dtype, np.integer):
+            np.rint(self._tmp, out=self._tmp)
+        np.copyto(out, self._tmp, casting='unsafe')
+        return out
+
+
+class DisplayThrottle:
+    """Rate limited and downsampled previews of the camera frames
+
+    A new preview is computed at most max_rate times per second by striding the frame down to at most max_size pixels
+    along its largest dimension. In between, the last preview is returned again so that the viewer keeps receiving
+    a small image instead of the full frame.
+
+    Parameters
+    ----------
+    max_rate: float
+        maximum rate of new previews (Hz)
+    max_size: int
+        maximum number of pixels of the previews along each dimension
+    """
+
+    def __init__(self, max_rate: float = 30., max_size: int = 512):
+        self.max_rate = max_rate
+        self.max_size = max_size
+        self._factor = 1
+        self._previews = None
+        self._last_tick = 0.
+        self._lock = threading.Lock()
+
+    def reset(self):
+        """Forget the last preview, the next frame will give a new one"""
+        with self._lock:
+            self._previews = None
+
+    def _due(self, now):
+        return self._previews is None or self.max_rate <= 0 or now - self._last_tick >= 1 / self.max_rate
+
+    def due(self):
+        """True if the next call to preview will compute a new preview"""
+        with self._lock:
+            return self._due(perf_counter())
+
+    def get_factor(self, shape):
+        """Return the integer downsampling factor for images of the given shape"""
+        return max(1, -(-max(shape) // max(1, int(self.max_size))))
+
+    def preview(self, channels):
+        """Return the preview of an image
+
+        Parameters
+        ----------
+        channels: list of ndarray
+            the channels of the full resolution image
+
+        Returns
+        -------
+        list of ndarray: the downsampled channels, new ones if the last preview is older than 1/max_rate
+        int: the downsampling factor of the preview
+        """
+        with self._lock:
+            now = perf_counter()
+            if self._due(now):
+                self._factor = self.get_factor(channels[0].shape)
+                # copies so that the preview does not refer to reused acquisition buffers
+                self._previews = [np.ascontiguousarray(channel[::self._factor, ::self._factor])
+                                  for channel in channels]
+                self._last_tick = now
+            return self._previews, self._factor
+
+
+class FramePipeline:
+    """Process camera frames in a pool of worker threads and emit the results in acquisition order
+
+    Frames are submitted from the acquisition thread, processed concurrently by the workers and handed to the emit
+    function by a dedicated emitter thread, in the order they were submitted. The number of frames submitted but not
+    emitted yet is bounded: when the pipeline is full, new frames are either dropped ("Drop" policy, fine for a live
+    display) or the submitting thread waits for a free slot ("Wait" policy, no frame is lost, use it when saving).
+
+    Parameters
+    ----------
+    process_fn: callable
+        function processing a frame and returning the data to emit (or None to emit nothing)
+    emit_fn: callable
+        function called with the processed data from the emitter thread
+    nworkers: int
+        number of processing threads
+    max_pending: int
+        maximum number of frames submitted and not yet emitted
+    policy: str
+        either 'Drop' or 'Wait'
+    error_fn: callable
+        optional function called with the exception raised while processing a frame
+    """
+    policies = ['Drop', 'Wait']
+
+    def __init__(self, process_fn, emit_fn, nworkers: int = 2, max_pending: int = 4, policy: str = 'Drop',
+                 error_fn=None):
+        if policy not in self.policies:
+            raise ValueError(f'Unknown pipeline policy {policy}, should be one of {self.policies}')
+        self.process_fn = process_fn
+        self.emit_fn = emit_fn
+        self.error_fn = error_fn
+        self.policy = policy
+        self.max_pending = max(1, int(max_pending))
+        self.dropped = 0
+
+        self._slots = threading.Semaphore(self.max_pending)
+        self._futures = queue.Queue()
+        self._pool = ThreadPoolExecutor(max_workers=max(1, int(nworkers)), thread_name_prefix='frame_processing')
+        self._emitter = threading.Thread(target=self._emit_loop, name='frame_emitter', daemon=True)
+        self._emitter.start()
+
+    def submit(self, frame: np.ndarray, *args, process_fn=None):
+        """Submit a frame for processing
+
+        Parameters
+        ----------
+        frame: ndarray
+            the frame, or any item accepted by the processing function
+        args:
+            additional arguments of the processing function
+        process_fn: callable
+            optional function processing this item instead of the one of the pipeline
+
+        Returns
+        -------
+        bool: False if the frame has been dropped
+        """
+        if not self._slots.acquire(blocking=self.policy == 'Wait'):
+            self.dropped += 1
+            return False
+        self._futures.put(self._pool.submit(process_fn or self.process_fn, frame, *args))
+        return True
+
+    def _emit_loop(self):
+        while True:
+            future = self._futures.get()
+            if future is None:
+                break
+            try:
+                data = future.result()
+                if data is not None:
+                    self.emit_fn(data)
+            except CancelledError:
+                pass
+            except Exception as e:
+                if self.error_fn is not None:
+                    self.error_fn(e)
+            finally:
+                self._slots.release()
+
+    def stop(self):
+        """Stop the threads. Frames not processed yet are cancelled, unless with the "Wait" policy"""
+        self._pool.shutdown(wait=True, cancel_futures=self.policy == 'Drop')
+        self._futures.put(None)
+        self._emitter.join()
+
+
+class FrameRecorder:
+    """Write raw camera frames to a preallocated file from a dedicated writer thread
+
+    Frames are copied into a few preallocated slots by the acquisition thread and written to disk by the writer
+    thread, along with their frame index and timestamp. When the writer lags behind, the acquisition waits for a
+    free slot, no frame is lost (the camera buffer absorbs the delay).
+
+    Files are either chunked HDF5 files (one chunk per frame, datasets "frames", "frame_index" and "timestamp") or
+    numpy memory maps: a .npy file of frames and a _meta.npy file holding the frame index and timestamp of each
+    recorded frame. The frames file of a memory map keeps its preallocated length, only the first frames, as many as
+    in the meta file, are valid.
+
+    Parameters
+    ----------
+    path: str or Path
+        file to create, its suffix is set depending on the format
+    shape: tuple of int
+        shape of the frames
+    nframes: int
+        maximum number of frames to record, the file is preallocated accordingly
+    dtype: numpy dtype
+        type of the frames
+    fmt: str
+        either 'HDF5' or 'Memmap'
+    nslots: int
+        number of frames that can be waiting for the writer
+    error_fn: callable
+        optional function called with the exception raised while writing a frame
+    """
+    formats = ['HDF5', 'Memmap']
+    suffixes = {'HDF5': '.h5', 'Memmap': '.npy'}
+    meta_dtype = np.dtype([('frame_index', np.int64), ('timestamp', np.float64)])
+
+    def __init__(self, path, shape, nframes: int, dtype=np.uint16, fmt: str = 'HDF5', nslots: int = 32,
+                 error_fn=None):
+        if fmt not in self.formats:
+            raise ValueError(f'Unknown recording format {fmt}, should be one of {self.formats}')
+        if fmt == 'HDF5' and h5py is None:
+            raise ImportError('h5py is needed to record frames in HDF5 files, use the Memmap format instead')
+        self.fmt = fmt
+        self.path = Path(path).with_suffix(self.suffixes[fmt])
+        self.shape = tuple(shape)
+        self.nframes = max(1, int(nframes))
+        self.error_fn = error_fn
+        self.submitted = 0
+        self.recorded = 0
+
+        self._slots = np.empty((max(1, int(nslots)),) + self.shape, dtype=dtype)
+        self._free = queue.Queue()
+        for slot in range(self._slots.shape[0]):
+            self._free.put(slot)
+        self._pending = queue.Queue()
+        self._stopped = False
+        self._open()
+
+        self._writer = threading.Thread(target=self._write_loop, name='frame_recorder', daemon=True)
+        self._writer.start()
+
+    @property
+    def full(self):
+        return self.submitted >= self.nframes
+
+    def _open(self):
+        dtype = self._slots.dtype
+        if self.fmt == 'HDF5':
+            self._file = h5py.File(self.path, 'w')
+            self._frames = self._file.create_dataset('frames', shape=(self.nframes,) + self.shape, dtype=dtype,
+                                                     maxshape=(None,) + self.shape, chunks=(1,) + self.shape)
+            self._index = self._file.create_dataset('frame_index', shape=(self.nframes,), dtype=np.int64,
+                                                    maxshape=(None,))
+            self._timestamp = self._file.create_dataset('timestamp', shape=(self.nframes,), dtype=np.float64,
+                                                        maxshape=(None,))
+            self._timestamp.attrs['units'] = 's'
+        else:
+            self._file = None
+            self._frames = np.lib.format.open_memmap(self.path, mode='w+', dtype=dtype,
+                                                     shape=(self.nframes,) + self.shape)
+            self._meta = np.zeros((self.nframes,), dtype=self.meta_dtype)
+
+    @property
+    def meta_path(self):
+        return self.path.with_name(f'{self.path.stem}_meta.npy')
+
+    def record(self, frame: np.ndarray, index: int, timestamp: float):
+        """Queue a frame for writing, waiting for a free slot if needed
+
+        Parameters
+        ----------
+        frame: ndarray
+            the raw frame, copied so that the camera buffer can be reused right away
+        index: int
+            frame index given by the camera
+        timestamp: float
+            acquisition time of the frame in seconds
+
+        Returns
+        -------
+        bool: False if the frame has not been recorded because the file is full or the recorder stopped
+        """
+        if self._stopped or self.full:
+            return False
+        if frame.shape != self.shape:
+            raise ValueError(f'Cannot record frames of shape {frame.shape} in a recording of shape {self.shape}')
+        slot = self._free.get()
+        np.copyto(self._slots[slot], frame, casting='unsafe')
+        self._pending.put((slot, index, timestamp))
+        self.submitted += 1
+        return True
+
+    def _write_loop(self):
+        while True:
+            item = self._pending.get()
+            if item is None:
+                break
+            slot, index, timestamp = item
+            try:
+                self._frames[self.recorded] = self._slots[slot]
+                if self.fmt == 'HDF5':
+                    self._index[self.recorded] = index
+                    self._timestamp[self.recorded] = timestamp
+                else:
+                    self._meta[self.recorded] = (index, timestamp)
+                self.recorded += 1
+            except Exception as e:
+                if self.error_fn is not None:
+                    self.error_fn(e)
+            finally:
+                self._free.put(slot)
+
+    def stop(self):
+        """Write the frames still queued and close the file"""
+        if self._stopped:
+            return
+        self._stopped = True
+        self._pending.put(None)
+        self._writer.join()
+        if self.fmt == 'HDF5':
+            for dataset in [self._frames, self._index, self._timestamp]:
+                dataset.resize(self.recorded, axis=0)
+            self._file.close()
+        else:
+            self._frames.flush()
+            del self._frames
+            np.save(self.meta_path, self._meta[:self.recorded])
+
+
+class LatestWorker:
+    """Process the latest submitted item in a background thread, at most max_rate times per second
+
+    Items submitted while the worker is busy or waiting replace the pending one, which is dropped: the worker always
+    processes the most recent item and never lags behind. The result of the last processing is kept in result, and
+    clear drops it along with the pending item and the item being processed, when they become out of date.
+
+    Parameters
+    ----------
+    process_fn: callable
+        function processing an item and returning its result
+    max_rate: float
+        maximum processing rate (Hz), no limit if 0
+    result_fn: callable
+        optional function called with each result from the worker thread
+    error_fn: callable
+        optional function called with the exception raised while processing an item
+    """
+
+    def __init__(self, process_fn, max_rate: float = 10., result_fn=None, error_fn=None):
+        self.process_fn = process_fn
+        self.max_rate = max_rate
+        self.result_fn = result_fn
+        self.error_fn = error_fn
+        self.dropped = 0
+        self._result = None
+        self._pending = None
+        self._generation = 0
+        self._last_start = 0.
+        self._condition = threading.Condition()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._loop, name='latest_worker', daemon=True)
+        self._thread.start()
+
+    @property
+    def result(self):
+        with self._condition:
+            return self._result
+
+    def submit(self, item):
+        with self._condition:
+            if self._pending is not None:
+                self.dropped += 1
+            self._pending = item
+            self._condition.notify()
+
+    def clear(self):
+        """Drop the pending item and the last result, the result of the item being processed is dropped too"""
+        with self._condition:
+            self._pending = None
+            self._result = None
+            self._generation += 1
+
+    def _loop(self):
+        while not self._stopped.is_set():
+            with self._condition:
+                while self._pending is None and not self._stopped.is_set():
+                    self._condition.wait()
+            if self.max_rate > 0 and self._stopped.wait(self._last_start + 1 / self.max_rate - perf_counter()):
+                break
+            with self._condition:
+                item, self._pending = self._pending, None
+                generation = self._generation
+            if item is None:  # cleared while waiting
+                continue
+            self._last_start = perf_counter()
+            try:
+                result = self.process_fn(item)
+                with self._condition:
+                    if generation != self._generation:
+                        continue
+                    self._result = result
+                if self.result_fn is not None:
+                    self.result_fn(result)
+            except Exception as e:
+                if self.error_fn is not None:
+                    self.error_fn(e)
+
+    def stop(self):
+        self._stopped.set()
+        with self._condition:
+            self._condition.notify()
+        self._thread.join()
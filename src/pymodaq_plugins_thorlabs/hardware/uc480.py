@@ -0,0 +1,111 @@
+"""
+Discovery of the Thorlabs DCx cameras (uc480 driver of the instrumental library) used by DAQ_2DViewer_Thorlabs_DCx
+
+Cameras are enumerated once, when their serial numbers are first needed, and their serial numbers are read from the
+paramsets returned by instrumental without opening them. Cameras opened by the plugins are kept by serial number so
+that they are opened only once.
+
+The AOI (area of interest) of the uc480 cameras must follow position and size increments that depend on the camera
+model, snap_aoi rounds a requested AOI accordingly.
+"""
+import threading
+
+from instrumental import instrument, list_instruments
+from instrumental.drivers.cameras.uc480 import lib, BIN_H_CODE_FROM_NUM, SUBSAMP_H_CODE_FROM_NUM
+
+BINNINGS = sorted(BIN_H_CODE_FROM_NUM)
+SUBSAMPLINGS = sorted(SUBSAMP_H_CODE_FROM_NUM)
+
+
+def _decode(serial):
+    return serial.decode('utf-8') if isinstance(serial, bytes) else str(serial)
+
+
+class CameraCache:
+    """Lazy enumeration of the DCx cameras, and their opened handles keyed by serial number"""
+
+    def __init__(self):
+        self._paramsets: dict = None
+        self._handles = {}
+        self._lock = threading.Lock()
+
+    def _enumerate(self):
+        paramsets = {}
+        for paramset in list_instruments(module='cameras.uc480'):
+            if 'serial' in paramset.keys():
+                paramsets[_decode(paramset['serial'])] = paramset
+            else:  # not given by the driver, the camera has to be opened to get it
+                camera = instrument(paramset, reopen_policy='reuse')
+                serial = _decode(camera.serial)
+                paramsets[serial] = paramset
+                self._handles[serial] = camera
+        return paramsets
+
+    def serial_numbers(self, refresh: bool = False):
+        """Return the serial numbers of the connected cameras, enumerated at the first call or if refresh is True"""
+        with self._lock:
+            if self._paramsets is None or refresh:
+                self._paramsets = self._enumerate()
+            return list(self._paramsets)
+
+    def open(self, serial: str):
+        """Return the camera with the given serial number, opening it only if it is not open yet"""
+        self.serial_numbers()
+        with self._lock:
+            if serial not in self._handles:
+                if serial not in self._paramsets:
+                    raise ValueError(f'No DCx camera with serial number {serial}')
+                self._handles[serial] = instrument(self._paramsets[serial], reopen_policy='reuse')
+            return self._handles[serial]
+
+    def close(self, serial: str):
+        """Close the camera with the given serial number, if open"""
+        with self._lock:
+            camera = self._handles.pop(serial, None)
+        if camera is not None:
+            camera.close()
+
+
+cameras = CameraCache()
+
+
+def snap_aoi(camera, aoi, hfactor: int = 1, vfactor: int = 1):
+    """Convert an AOI in sensor pixels into the AOI of the binned and subsampled image, as accepted by the camera
+
+    The binning and subsampling must already be set on the camera. The AOI is enlarged to the position and size
+    increments of the camera and kept within the image.
+
+    Parameters
+    ----------
+    camera: UC480_Camera
+        the instrumental camera
+    aoi: tuple of int or None
+        (x0, y0, x1, y1) in unbinned sensor pixels, None for the full frame
+    hfactor, vfactor: int
+        horizontal and vertical binning times subsampling factors
+
+    Returns
+    -------
+    dict: left, top, right and bot keywords of instrumental, in pixels of the image
+    """
+    max_width, max_height = camera._get_max_img_size()
+    if aoi is None:
+        return dict(left=0, top=0, right=max_width, bot=max_height)
+    pos_inc = camera._dev.AOI(lib.AOI_IMAGE_GET_POS_INC)
+    size_inc = camera._dev.AOI(lib.AOI_IMAGE_GET_SIZE_INC)
+    size_min = camera._dev.AOI(lib.AOI_IMAGE_GET_SIZE_MIN)
+
+    def snap(start, stop, pos_step, size_step, min_size, max_size):
+        pos_step, size_step = max(1, pos_step), max(1, size_step)
+        start = max(0, start) // pos_step * pos_step
+        size = max(min_size, -(-(stop - start) // size_step) * size_step)
+        size = min(size, max_size // size_step * size_step)
+        start = min(start, (max_size - size) // pos_step * pos_step)
+        return start, start + size
+
+    x0, y0, x1, y1 = aoi
+    left, right = snap(x0 // hfactor, -(-x1 // hfactor), pos_inc.s32X, size_inc.s32Width, size_min.s32Width,
+                       max_width)
+    top, bot = snap(y0 // vfactor, -(-y1 // vfactor), pos_inc.s32Y, size_inc.s32Height, size_min.s32Height,
+                    max_height)
+    return dict(left=left, top=top, right=right, bot=bot)
@@ -0,0 +1,181 @@
+import threading
+
+import numpy as np
+import pytest
+
+from pymodaq_plugins_thorlabs.hardware.autocorrelation import (PULSE_SHAPES, PulseEstimator, TraceAverager,
+                                                               TraceProjector, DelayCalibration, linear_calibration)
+
+PARAMS = np.array([100., 150.3, 12., 5.])  # a, x0, dx, y0
+
+
+def trace(shape='Gaussian', params=PARAMS, noise=0., length=300, seed=0):
+    x = np.arange(length, dtype=float)
+    y = PULSE_SHAPES[shape].evaluate(x, params)
+    if noise:
+        y = y + np.random.default_rng(seed).normal(0, noise, length)
+    return x, y
+
+
+class TestPulseShape:
+    @pytest.mark.parametrize('shape, fwhm', [('Gaussian', 2 * np.sqrt(np.log(2))),
+                                             ('Sech²', 2 * np.arccosh(np.sqrt(2))),
+                                             ('Lorentzian', 2.)])
+    def test_fwhm(self, shape, fwhm):
+        assert PULSE_SHAPES[shape].fwhm == pytest.approx(fwhm, abs=1e-3)
+
+    def test_duration(self):
+        shape = PULSE_SHAPES['Gaussian']
+        assert shape.duration(10., 2.) == pytest.approx(shape.factor * shape.fwhm * 20.)
+
+    @pytest.mark.parametrize('shape', list(PULSE_SHAPES))
+    def test_fit_converges(self, shape):
+        x, y = trace(shape, noise=1.)
+        params, converged = PULSE_SHAPES[shape].fit(x, y, PARAMS * [0.9, 1.01, 1.2, 0.5])
+        assert converged
+        assert params == pytest.approx(PARAMS, rel=0.05)
+
+    def test_exact_fit_converges(self):
+        x, y = trace()
+        params, converged = PULSE_SHAPES['Gaussian'].fit(x, y, PARAMS)
+        assert converged
+        assert params == pytest.approx(PARAMS)
+
+    def test_unfinished_fit_does_not_converge(self):
+        x, y = trace(noise=1.)
+        _, converged = PULSE_SHAPES['Gaussian'].fit(x, y, PARAMS * [0.5, 1.1, 2., 0.], maxiter=1)
+        assert not converged
+
+
+class TestPulseEstimator:
+    @pytest.mark.parametrize('engine', PulseEstimator.engines)
+    @pytest.mark.parametrize('shape', list(PULSE_SHAPES))
+    def test_recovers_parameters(self, engine, shape):
+        estimator = PulseEstimator(engine, shape)
+        x, y = trace(shape, noise=0.5)
+        params, fit_time = estimator.estimate(x, y)
+        assert fit_time >= 0
+        assert params[1] == pytest.approx(PARAMS[1], abs=0.5)
+        assert params[2] == pytest.approx(PARAMS[2], rel=0.1)
+
+    @pytest.mark.parametrize('engine', PulseEstimator.engines)
+    def test_no_peak(self, engine):
+        estimator = PulseEstimator(engine)
+        params, _ = estimator.estimate(np.arange(100.), np.zeros(100))
+        assert params is None
+
+    def test_unknown_engine_and_shape(self):
+        with pytest.raises(ValueError):
+            PulseEstimator('Median')
+        with pytest.raises(ValueError):
+            PulseEstimator(shape='Square')
+
+
+class TestTraceProjector:
+    def test_full_frame(self):
+        image = np.arange(12, dtype=float).reshape(3, 4)
+        x, projected = TraceProjector(0).project(image)
+        assert np.allclose(x, np.arange(4))
+        assert np.allclose(projected, image.mean(axis=0))
+
+    def test_manual_band(self):
+        image = np.arange(20, dtype=float).reshape(5, 4)
+        _, projected = TraceProjector(0, 'Manual', (1, 3)).project(image)
+        assert np.allclose(projected, image[1:3].mean(axis=0))
+
+    def test_auto_band(self):
+        image = np.zeros((100, 50))
+        image[40:50] = 10.
+        projector = TraceProjector(0, 'Auto', auto_frames=2)
+        projector.project(image)
+        assert not projector.detected
+        projector.project(image)
+        assert projector.detected
+        start, stop = projector.band
+        assert start <= 40 and 50 <= stop and stop - start < 20
+
+
+class TestTraceAverager:
+    def test_no_averaging(self):
+        averager = TraceAverager('None')
+        assert np.allclose(averager.add(np.ones(5)), 1.)
+
+    def test_moving_average(self):
+        averager = TraceAverager('Moving', navg=3)
+        means = [float(averager.add(np.full(5, value))[0]) for value in range(6)]
+        assert means == pytest.approx([0., 0.5, 1., 2., 3., 4.])
+
+    def test_exponential_average(self):
+        averager = TraceAverager('Exponential', navg=2)
+        means = [float(averager.add(np.full(5, value))[0]) for value in [0., 4., 8.]]
+        assert means == pytest.approx([0., 2., 5.])
+
+    def test_dark_subtraction(self):
+        averager = TraceAverager('Moving', navg=4)
+        averager.capture_dark(2)
+        averager.add(np.full(5, 1.))
+        assert averager.capturing_dark
+        averager.add(np.full(5, 3.))
+        assert not averager.capturing_dark
+        assert np.allclose(averager.dark, 2.)
+        # the dark traces are not averaged with the next ones
+        assert np.allclose(averager.add(np.full(5, 7.)), 5.)
+        assert np.allclose(averager.add(np.full(5, 9.)), 6.)
+        averager.subtract_dark = False
+        assert np.allclose(averager.add(np.full(5, 11.)), 9.)
+
+
+class TestCalibration:
+    def test_linear_calibration(self):
+        positions = np.array([10., 20., 30., 40.])
+        slope, error, intercept = linear_calibration(positions, -0.764 * positions + 30)
+        assert slope == pytest.approx(0.764)
+        assert error == pytest.approx(0., abs=1e-9)
+        assert intercept == pytest.approx(30.)
+
+    def test_linear_calibration_error(self):
+        rng = np.random.default_rng(0)
+        positions = np.linspace(0, 100, 50)
+        slope, error, _ = linear_calibration(positions, 0.764 * positions + rng.normal(0, 1, 50))
+        assert slope == pytest.approx(0.764, abs=5 * error)
+        assert 0 < error < 0.01
+
+    def test_two_points_have_no_error(self):
+        assert np.isnan(linear_calibration([0., 1.], [0., 1.])[1])
+
+    def test_same_positions(self):
+        with pytest.raises(ValueError):
+            linear_calibration([1., 1., 1.], [0., 1., 2.])
+
+    def test_manual_delays(self):
+        delays = [-100., 0., 100.]
+        calibration = DelayCalibration(delays, nframes=2)
+        for delay in delays:
+            assert calibration.current_delay == delay
+            assert not calibration.add(0.)  # not collecting yet
+            calibration.collect()
+            calibration.add(np.nan)  # traces without peak are ignored
+            calibration.add(150 + delay / 0.764 - 1)
+            assert calibration.add(150 + delay / 0.764 + 1)
+        assert calibration.done
+        pxfs, error = calibration.fit()
+        assert pxfs == pytest.approx(0.764)
+
+    def test_run_with_actuator(self):
+        calibration = DelayCalibration([0., 50., 100.], nframes=1)
+        finished = threading.Event()
+        results = []
+
+        def move(delay):
+            # the trace at the new delay comes after the calibration started collecting
+            threading.Timer(0.05, calibration.add, [delay / 0.5]).start()
+
+        def done(*result):
+            results.append(result)
+            finished.set()
+
+        calibration.run(move, done, timeout=5.)
+        assert finished.wait(5.)
+        calibration.stop()
+        assert calibration.done
+        assert results[0][0] == pytest.approx(0.5)
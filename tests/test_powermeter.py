@@ -0,0 +1,63 @@
+import time
+
+import numpy as np
+
+from pymodaq_plugins_thorlabs.hardware.powermeter import PowerStream
+
+
+class CountingMeter:
+    """Opened CustomTLPM whose measurements are 1, 2, 3..."""
+
+    def __init__(self):
+        self.count = 0
+
+    def read_power_into(self, out, index=0):
+        self.count += 1
+        out[index] = self.count
+
+
+def test_stream_reads_new_samples_in_order():
+    stream = PowerStream(CountingMeter(), rate=0, size=100000)
+    try:
+        time.sleep(0.05)
+        times, powers = stream.read()
+        more_times, more_powers = stream.read()
+    finally:
+        stream.stop()
+    assert len(powers) > 0 and len(more_powers) > 0
+    assert np.all(np.diff(np.concatenate([powers, more_powers])) == 1)
+    assert np.all(np.diff(np.concatenate([times, more_times])) >= 0)
+
+
+def test_stream_counts_overwritten_samples():
+    stream = PowerStream(CountingMeter(), rate=0, size=10)
+    try:
+        time.sleep(0.05)
+        _, powers = stream.read()
+    finally:
+        stream.stop()
+    assert len(powers) == 10
+    assert stream.overwritten == powers[0] - 1
+
+
+def test_stream_rate():
+    stream = PowerStream(CountingMeter(), rate=100, size=1000)
+    try:
+        stream.read()
+        time.sleep(0.3)
+        times, _ = stream.read()
+    finally:
+        stream.stop()
+    assert 15 <= len(times) <= 45
+    assert np.median(np.diff(times)) > 0.005
+
+
+def test_stream_read_timeout():
+    meter = CountingMeter()
+    meter.read_power_into = lambda out, index=0: time.sleep(0.5)
+    stream = PowerStream(meter, rate=0)
+    try:
+        _, powers = stream.read(timeout=0.01)
+    finally:
+        stream.stop()
+    assert len(powers) == 0
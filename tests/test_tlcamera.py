@@ -0,0 +1,248 @@
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from pymodaq_plugins_thorlabs.hardware.tlcamera import (FrameAverager, FrameRing, FramePipeline, FrameRecorder,
+                                                        LatestWorker, h5py)
+from pymodaq_plugins_thorlabs.hardware.simulated_tlcamera import SimulatedTLCamera
+
+
+def frames(n, shape=(4, 6), dtype=np.uint16):
+    return [np.full(shape, ind, dtype=dtype) for ind in range(n)]
+
+
+class TestFrameRing:
+    def test_fill_returns_a_stack_of_copies(self):
+        ring = FrameRing(depth=4)
+        batch = frames(3)
+        stack = ring.fill(batch)
+        batch[0][:] = 100
+        assert stack.shape == (3, 4, 6)
+        assert [int(view[0, 0]) for view in stack] == [0, 1, 2]
+
+    def test_drops_oldest_frames_beyond_depth(self):
+        ring = FrameRing(depth=2)
+        views = ring.fill(frames(5))
+        assert ring.dropped == 3
+        assert [int(view[0, 0]) for view in views] == [3, 4]
+
+    def test_previous_batch_not_overwritten(self):
+        ring = FrameRing(depth=2)
+        first = ring.fill(frames(2))
+        ring.fill([frame + 10 for frame in frames(2)])
+        assert [int(view[0, 0]) for view in first] == [0, 1]
+
+    def test_spare_stacks(self):
+        ring = FrameRing(depth=2, spare=1)
+        first = ring.fill(frames(2))
+        for ind in range(2):
+            ring.fill([frame + 10 for frame in frames(2)])
+            assert [int(view[0, 0]) for view in first] == [0, 1]
+        ring.fill([frame + 10 for frame in frames(2)])
+        assert [int(view[0, 0]) for view in first] == [10, 11]
+
+    def test_reallocates_on_shape_change(self):
+        ring = FrameRing(depth=2)
+        ring.fill(frames(1))
+        ring.fill(frames(1, shape=(3, 3)))
+        assert ring.shape == (3, 3)
+
+
+class TestFrameAverager:
+    def test_inactive_for_one_frame(self):
+        averager = FrameAverager(1)
+        assert not averager.active
+
+    def test_block_mean(self):
+        averager = FrameAverager(4, 'Block')
+        done = [averager.add(frame) for frame in frames(4)]
+        assert done == [False, False, False, True]
+        assert np.allclose(averager.mean(), 1.5)
+
+    def test_block_ignores_extra_frames(self):
+        averager = FrameAverager(2, 'Block')
+        for frame in frames(5):
+            averager.add(frame)
+        assert averager.count == 2
+        assert np.allclose(averager.mean(), 0.5)
+
+    def test_block_reset(self):
+        averager = FrameAverager(2, 'Block')
+        for frame in frames(2):
+            averager.add(frame)
+        averager.reset()
+        assert not averager.done
+        averager.add(np.full((4, 6), 10, dtype=np.uint16))
+        averager.add(np.full((4, 6), 20, dtype=np.uint16))
+        assert np.allclose(averager.mean(), 15)
+
+    def test_running_mean(self):
+        navg = 3
+        averager = FrameAverager(navg, 'Running')
+        expected = None
+        for frame in frames(10):
+            assert averager.add(frame)
+            if expected is None:
+                expected = frame.astype(float)
+            else:
+                expected += (frame - expected) / min(averager.count, navg)
+            assert np.allclose(averager.mean(), expected, atol=1e-4)
+
+    def test_running_is_plain_mean_until_full(self):
+        averager = FrameAverager(10, 'Running')
+        for frame in frames(4):
+            averager.add(frame)
+        assert np.allclose(averager.mean(), 1.5)
+
+    def test_integer_mean_is_rounded(self):
+        averager = FrameAverager(2, 'Block')
+        averager.add(np.full((2, 2), 1, dtype=np.uint16))
+        averager.add(np.full((2, 2), 2, dtype=np.uint16))
+        mean = averager.mean(np.uint16)
+        assert mean.dtype == np.uint16
+        assert np.all(mean == 2)
+
+    def test_output_buffers_used_in_turn(self):
+        averager = FrameAverager(2, 'Running', nbuffers=2)
+        averager.add(frames(1)[0])
+        first = averager.mean()
+        second = averager.mean()
+        third = averager.mean()
+        assert first is not second
+        assert np.shares_memory(first, third)
+
+    def test_unknown_mode(self):
+        with pytest.raises(ValueError):
+            FrameAverager(2, 'Median')
+
+    def test_simulated_camera_frames(self):
+        camera = SimulatedTLCamera('Simulated Spot', sensor='Monochrome', width=64, height=48, frame_rate=1000.)
+        camera.set_exposure(1e-4)
+        camera.start_acquisition()
+        try:
+            camera.wait_for_frame(nframes=4, timeout=5.)
+            images = camera.read_multiple_images()[:4]
+        finally:
+            camera.stop_acquisition()
+        averager = FrameAverager(len(images), 'Block')
+        for image in images:
+            averager.add(image)
+        assert averager.done
+        assert np.allclose(averager.mean(), np.mean(images, axis=0), atol=1e-3)
+
+
+class TestFramePipeline:
+    def test_emits_in_submission_order(self):
+        emitted = []
+
+        def process(frame):
+            time.sleep(0.01 * (5 - int(frame[0, 0]) % 5))  # later frames processed faster
+            return int(frame[0, 0])
+
+        pipeline = FramePipeline(process, emitted.append, nworkers=4, max_pending=20, policy='Wait')
+        for frame in frames(10):
+            pipeline.submit(frame)
+        pipeline.stop()
+        assert emitted == list(range(10))
+
+    def test_process_fn_of_an_item(self):
+        emitted = []
+        pipeline = FramePipeline(lambda frame: 'frame', emitted.append, policy='Wait')
+        pipeline.submit(frames(1)[0])
+        pipeline.submit(frames(2), [0, 1], process_fn=lambda batch, infos: len(batch) + len(infos))
+        pipeline.stop()
+        assert emitted == ['frame', 4]
+
+    def test_drop_policy(self):
+        release = threading.Event()
+
+        def process(frame):
+            release.wait(5)
+            return frame
+
+        pipeline = FramePipeline(process, lambda data: None, nworkers=1, max_pending=2, policy='Drop')
+        submitted = [pipeline.submit(frame) for frame in frames(5)]
+        release.set()
+        pipeline.stop()
+        assert submitted == [True, True, False, False, False]
+        assert pipeline.dropped == 3
+
+    def test_errors_reported(self):
+        errors = []
+
+        def process(frame):
+            raise RuntimeError('processing failed')
+
+        pipeline = FramePipeline(process, lambda data: None, policy='Wait', error_fn=errors.append)
+        pipeline.submit(frames(1)[0])
+        pipeline.stop()
+        assert len(errors) == 1
+
+
+class TestLatestWorker:
+    def test_results_reported(self):
+        done = threading.Event()
+        results = []
+
+        def report(result):
+            results.append(result)
+            done.set()
+
+        worker = LatestWorker(lambda item: 2 * item, max_rate=0, result_fn=report)
+        worker.submit(3)
+        assert done.wait(5)
+        worker.stop()
+        assert results == [6]
+        assert worker.result == 6
+
+    def test_clear_drops_the_result_being_processed(self):
+        started = threading.Event()
+        release = threading.Event()
+        results = []
+
+        def process(item):
+            started.set()
+            release.wait(5)
+            return item
+
+        worker = LatestWorker(process, max_rate=0, result_fn=results.append)
+        worker.submit(1)
+        assert started.wait(5)
+        worker.clear()
+        release.set()
+        worker.stop()
+        assert results == []
+        assert worker.result is None
+
+
+class TestFrameRecorder:
+    def test_memmap(self, tmp_path):
+        recorder = FrameRecorder(tmp_path.joinpath('frames'), (4, 6), nframes=3, fmt='Memmap', nslots=2)
+        for ind, frame in enumerate(frames(4)):
+            recorder.record(frame, ind, ind * 0.1)
+        assert recorder.full
+        recorder.stop()
+        assert recorder.recorded == 3
+        recorded = np.load(recorder.path)
+        meta = np.load(recorder.meta_path)
+        assert [int(frame[0, 0]) for frame in recorded] == [0, 1, 2]
+        assert list(meta['frame_index']) == [0, 1, 2]
+        assert np.allclose(meta['timestamp'], [0., 0.1, 0.2])
+
+    @pytest.mark.skipif(h5py is None, reason='h5py is not installed')
+    def test_hdf5_truncated_to_recorded_frames(self, tmp_path):
+        recorder = FrameRecorder(tmp_path.joinpath('frames'), (4, 6), nframes=10, fmt='HDF5')
+        for ind, frame in enumerate(frames(3)):
+            recorder.record(frame, ind, ind * 0.1)
+        recorder.stop()
+        with h5py.File(recorder.path, 'r') as file:
+            assert file['frames'].shape == (3, 4, 6)
+            assert list(file['frame_index']) == [0, 1, 2]
+
+    def test_wrong_shape(self, tmp_path):
+        recorder = FrameRecorder(tmp_path.joinpath('frames'), (4, 6), nframes=3, fmt='Memmap')
+        with pytest.raises(ValueError):
+            recorder.record(np.zeros((2, 2), dtype=np.uint16), 0, 0.)
+        recorder.stop()
@@ -0,0 +1,50 @@
+from types import SimpleNamespace
+
+import pytest
+
+uc480 = pytest.importorskip('pymodaq_plugins_thorlabs.hardware.uc480', exc_type=ImportError)
+
+
+class AOICamera:
+    """uc480 camera answering the AOI queries of snap_aoi"""
+
+    def __init__(self, width=1280, height=1024, pos_inc=(4, 2), size_inc=(8, 2), size_min=(32, 4)):
+        self.size = (width, height)
+        increments = {uc480.lib.AOI_IMAGE_GET_POS_INC: SimpleNamespace(s32X=pos_inc[0], s32Y=pos_inc[1]),
+                      uc480.lib.AOI_IMAGE_GET_SIZE_INC: SimpleNamespace(s32Width=size_inc[0],
+                                                                        s32Height=size_inc[1]),
+                      uc480.lib.AOI_IMAGE_GET_SIZE_MIN: SimpleNamespace(s32Width=size_min[0],
+                                                                        s32Height=size_min[1])}
+        self._dev = SimpleNamespace(AOI=increments.__getitem__)
+
+    def _get_max_img_size(self):
+        return self.size
+
+
+def test_full_frame():
+    assert uc480.snap_aoi(AOICamera(), None) == dict(left=0, top=0, right=1280, bot=1024)
+
+
+def test_snapped_to_increments():
+    aoi = uc480.snap_aoi(AOICamera(), (101, 51, 203, 150))
+    assert aoi['left'] % 4 == 0 and aoi['top'] % 2 == 0
+    assert (aoi['right'] - aoi['left']) % 8 == 0 and (aoi['bot'] - aoi['top']) % 2 == 0
+    # the snapped AOI holds the requested one
+    assert aoi['left'] <= 101 and aoi['top'] <= 51 and aoi['right'] >= 203 and aoi['bot'] >= 150
+
+
+def test_minimum_size():
+    aoi = uc480.snap_aoi(AOICamera(), (100, 100, 102, 101))
+    assert aoi['right'] - aoi['left'] >= 32 and aoi['bot'] - aoi['top'] >= 4
+
+
+def test_kept_within_image():
+    aoi = uc480.snap_aoi(AOICamera(), (1270, 1020, 1300, 1030))
+    assert aoi['right'] <= 1280 and aoi['bot'] <= 1024
+    assert aoi['right'] - aoi['left'] >= 32
+
+
+def test_binned_image_pixels():
+    camera = AOICamera(width=640, height=512)  # image size with a binning of 2
+    aoi = uc480.snap_aoi(camera, (200, 100, 400, 300), hfactor=2, vfactor=2)
+    assert aoi['left'] <= 100 and aoi['right'] >= 200 and aoi['top'] <= 50 and aoi['bot'] >= 150